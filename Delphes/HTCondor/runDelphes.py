@@ -14,9 +14,10 @@ This is mainly responsible for:
 import os
 import argparse
 import sys
-import shutil
 from subprocess import call
 import tarfile
+# transferred alongside this script, see runDelphes.condor
+import storage
 
 
 def runDelphes(in_args=sys.argv[1:]):
@@ -42,9 +43,19 @@ def runDelphes(in_args=sys.argv[1:]):
     parser.add_argument('--process', nargs=2, action='append',
                         help='File for Delphes to process, of the form: '
                         '<input file> <output file>')
+    parser.add_argument('--catalog',
+                        help="Catalog file, to mark output files as done "
+                        "once they have been copied.")
 
     args = parser.parse_args(args=in_args)
     print args
+
+    # catalog.py is transferred alongside this script, so import it before
+    # moving to the sandbox area
+    if args.catalog:
+        import catalog
+    store = storage.get_storage()
+
     # Make sandbox area to avoid names clashing, and stop auto transfer
     # back to submission node
     # -------------------------------------------------------------------------
@@ -57,7 +68,7 @@ def runDelphes(in_args=sys.argv[1:]):
     if args.copyToLocal:
         for (source, dest) in args.copyToLocal:
             print source, dest
-            copy_to_local(source, dest)
+        store.download(args.copyToLocal)
         print os.listdir(os.getcwd())
 
     # Setup Delphes
@@ -70,13 +81,16 @@ def runDelphes(in_args=sys.argv[1:]):
 
     # Run Delphes over files
     # -------------------------------------------------------------------------
+    # Outputs not copied, as Delphes failed making them
+    failed = []
     for input_file, output_file in args.process:
         # To save disk space, we copy over a single file, process it,
-        # then copy the result to its destination.
+        # then remove it. The (much smaller) results are copied to their
+        # destination all together at the end.
         in_local = os.path.basename(input_file)
         out_local = os.path.basename(output_file)
 
-        copy_to_local(input_file, in_local)
+        store.download([(input_file, in_local)])
 
         # unzip if necessary
         def need_unzip(filename):
@@ -99,44 +113,42 @@ def runDelphes(in_args=sys.argv[1:]):
                 raise RuntimeError('Cannot determine which exe to use for %s' % in_local)
 
         exe = args.exe if args.exe else determine_exe(os.path.splitext(in_local)[1])
-        call([exe, os.path.join('..', args.card), out_local, in_local])
-
-        copy_from_local(out_local, output_file)
-        os.remove(out_local)
+        delphes_code = call([exe, os.path.join('..', args.card), out_local, in_local])
         os.remove(in_local)
+        if delphes_code != 0:
+            # the output may be missing or truncated
+            print 'Delphes returned', delphes_code, 'not copying', out_local
+            failed.append(output_file)
+            continue
 
-    # Copy files from worker node area to /hdfs or /storage
+        store.queue_mkdir([os.path.dirname(output_file)])
+        store.queue_upload([(out_local, output_file)])
+
+    # Copy files from worker node area to /hdfs or /storage, making all the
+    # output directories first, then one put per directory
     # -------------------------------------------------------------------------
     if args.copyFromLocal:
         for (source, dest) in args.copyFromLocal:
             print source, dest
-            copy_from_local(source, dest)
-
-
-def copy_to_local(source, dest):
-    """Copy file from /hdfs, /storage, etc to local area."""
-    if source.startswith('/hdfs'):
-        source = source.replace('/hdfs', '')
-        call(['hadoop', 'fs', '-copyToLocal', source, dest])
-    else:
-        if os.path.isfile(source):
-            shutil.copy2(source, dest)
-        elif os.path.isdir(source):
-            shutil.copytree(source, dest)
-
-
-def copy_from_local(source, dest):
-    """Copy file from local area to e.g. /hdfs, /sorage, etc"""
-    if not os.path.isdir(os.path.dirname(dest)):
-        os.makedirs(os.path.dirname(dest))
-    if dest.startswith('/hdfs'):
-        dest = dest.replace('/hdfs', '')
-        call(['hadoop', 'fs', '-copyFromLocal', '-f', source, dest])
-    else:
-        if os.path.isfile(source):
-            shutil.copy2(source, dest)
-        elif os.path.isdir(source):
-            shutil.copytree(source, dest)
+            store.queue_mkdir([os.path.dirname(dest)])
+        store.queue_upload(args.copyFromLocal)
+    copied = store.flush()
+    print store.summary()
+
+    # Mark outputs as done in the catalog, which needs the local copies
+    # -------------------------------------------------------------------------
+    delphes_outputs = [(output_file, os.path.basename(output_file))
+                       for _, output_file in args.process]
+    if args.catalog:
+        catalog.mark_outputs_done(args.catalog, [(dest, source) for (source, dest) in copied
+                                                 if (dest, source) in delphes_outputs])
+    for _, out_local in delphes_outputs:
+        if os.path.isfile(out_local):
+            os.remove(out_local)
+
+    # Fail the job, so that DAGMan can retry it
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
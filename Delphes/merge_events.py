@@ -0,0 +1,495 @@
+#!/usr/bin/env python
+"""
+Merge lots of small per-seed LHE or HepMC files into fewer, larger chunks,
+suitable for passing to Delphes and for storing on /hdfs.
+
+Input files are streamed event-by-event, so nothing is decompressed to disk.
+The events are split into chunks of up to a target number of events
+(--nevents) and/or a target compressed size (--size), filling each chunk
+before starting the next. A file that doesn't fit in the rest of a chunk is
+split between chunks at an event boundary. Each chunk is then written by a
+separate process.
+
+For LHE files, the <init> block of each chunk is made from those of its input
+files: the cross section for each process (LPRUP) is the event-weighted
+average of the inputs, with errors combined accordingly. The weights are the
+numbers of events actually read from each file, so a truncated file counts
+for less, and an empty one not at all.
+The number of events in a filename (_n<N>_seed) is only used to plan the
+chunks, along with the file size to estimate the size of each event.
+A JSON file is written alongside each chunk, recording the input files (with
+the range of events used from each), number of events, and cross sections.
+
+e.g.:
+./merge_events.py --iDir /hdfs/user/<username>/NMSSMPheno/MG5_aMC/13TeV/pp13_bb/18_Nov_15/lhe --nevents 100000
+"""
+
+
+import os
+import re
+import sys
+import gzip
+import json
+import math
+import shutil
+import argparse
+import logging
+from multiprocessing import Pool, cpu_count
+
+
+logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+log = logging.getLogger(__name__)
+
+
+# Markers for start & end of event listings for each format.
+# Everything before the start marker is header, anything after the end marker
+# is footer.
+LHE_EVENT_START = '<event'
+LHE_END = '</LesHouchesEvents>'
+HEPMC_START = 'HepMC::IO_GenEvent-START_EVENT_LISTING'
+HEPMC_END = 'HepMC::IO_GenEvent-END_EVENT_LISTING'
+
+# Get nevents and seed from filenames made by the submission scripts,
+# e.g. ggh125_2a_4tau_ma1_8_13TeV_n10000_seed12.hepmc.gz
+FILENAME_RE = re.compile(r'^(?P<stem>.+)_n(?P<nevents>\d+)_seed(?P<seed>\d+)\.')
+
+
+def merge_events(in_args=sys.argv[1:]):
+    """Main function. Plan the chunks, then write them in parallel."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iDir',
+                        required=True,
+                        help='Input directory of per-seed lhe/hepmc files')
+    parser.add_argument('--type',
+                        choices=['hepmc', 'lhe'],
+                        help='Filetype to merge. If not specified, it will '
+                        'be guessed from the files in --iDir')
+    parser.add_argument('--oDir',
+                        help='Output directory for merged files. If not '
+                        'specified, one will be created automatically at '
+                        '<iDir>/../<type>_merged')
+    parser.add_argument('--nevents',
+                        type=int,
+                        help='Target number of events per output chunk')
+    parser.add_argument('--size',
+                        type=float,
+                        help='Target size per output chunk in MB (compressed)')
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=cpu_count(),
+                        help='Number of chunks to write in parallel. '
+                        'Defaults to the number of cores.')
+    parser.add_argument("--dry",
+                        help="Dry run, only print the chunks that would be made.",
+                        action='store_true')
+    parser.add_argument("-v",
+                        help="Display debug messages.",
+                        action='store_true')
+    args = parser.parse_args(args=in_args)
+
+    if args.v:
+        log.setLevel(logging.DEBUG)
+
+    log.debug('program args: %s' % args)
+
+    # Do some checks
+    # -------------------------------------------------------------------------
+    if not os.path.isdir(args.iDir):
+        raise RuntimeError('--iDir arg does not correspond to an actual directory')
+    if not args.nevents and not args.size:
+        raise RuntimeError('You must specify --nevents and/or --size')
+    if args.jobs < 1:
+        raise RuntimeError('--jobs must be >= 1')
+
+    args.iDir = args.iDir.rstrip('/')
+    if not args.type:
+        args.type = guess_type(args.iDir)
+    if not args.oDir:
+        args.oDir = os.path.join(os.path.dirname(args.iDir), '%s_merged' % args.type)
+
+    input_files = get_input_files(args.iDir, args.type)
+    if not input_files:
+        raise RuntimeError('No %s files in %s' % (args.type, args.iDir))
+    log.info('Found %d %s files' % (len(input_files), args.type))
+
+    # Plan the chunks
+    # -------------------------------------------------------------------------
+    pool = Pool(args.jobs)
+    n_events = pool.map(get_n_events, [(f, args.type) for f in input_files])
+    sizes = [os.path.getsize(f) for f in input_files]
+    max_size = args.size * 1024 * 1024 if args.size else None
+
+    chunks = plan_chunks(input_files, n_events, sizes, args.nevents, max_size)
+
+    jobs = []
+    stem = generate_stem(input_files[0])
+    for ind, chunk in enumerate(chunks):
+        out_name = os.path.join(args.oDir, '%s_part%d.%s.gz' % (stem, ind, args.type))
+        jobs.append((args.type, chunk, out_name))
+        log.debug('%s: %s' % (out_name, chunk))
+    log.info('Merging into %d chunks' % len(jobs))
+
+    if args.dry:
+        pool.close()
+        pool.join()
+        log.warning('Dry run - not writing any files.')
+        for _, chunk, out_name in jobs:
+            log.info('%s <- %d files' % (out_name, len(set(f for f, _, _ in chunk))))
+        return jobs
+
+    # Write the chunks
+    # -------------------------------------------------------------------------
+    check_create_dir(args.oDir, args.v)
+    summaries = pool.map(merge_chunk, jobs)
+    pool.close()
+    pool.join()
+
+    for summary in summaries:
+        log.info('Written %d events to %s' % (summary['nevents'], summary['filename']))
+    return summaries
+
+
+def guess_type(directory):
+    """Guess the filetype from the contents of a directory."""
+    for fmt in ['hepmc', 'lhe']:
+        if get_input_files(directory, fmt):
+            return fmt
+    raise RuntimeError('Cannot determine filetype of files in %s, use --type' % directory)
+
+
+def get_input_files(directory, fmt):
+    """Get list of files with format fmt (zipped or not) in directory.
+
+    Files are sorted by seed if possible, otherwise by name, so that the
+    chunks are reproducible.
+    """
+    def sort_key(filename):
+        match = FILENAME_RE.search(os.path.basename(filename))
+        return (int(match.group('seed')) if match else -1, filename)
+
+    files = [os.path.join(directory, f) for f in os.listdir(directory)
+             if f.endswith('.%s' % fmt) or f.endswith('.%s.gz' % fmt)]
+    return sorted(files, key=sort_key)
+
+
+def generate_stem(filename):
+    """Generate an output filename stem from an input file, removing
+    the number of events and seed.
+
+    >>> generate_stem('ggh125_2a_4tau_ma1_8_13TeV_n10000_seed12.hepmc.gz')
+    ggh125_2a_4tau_ma1_8_13TeV
+    """
+    basename = os.path.basename(filename)
+    match = FILENAME_RE.search(basename)
+    if match:
+        return match.group('stem')
+    return basename.split('.')[0]
+
+
+def open_file(filename, mode='r'):
+    """Open file, using gzip if filename ends with .gz"""
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode)
+    return open(filename, mode)
+
+
+def is_event_start(line, fmt):
+    """Does line mark the start of a new event in a file of format fmt"""
+    if fmt == 'lhe':
+        return line.lstrip().startswith(LHE_EVENT_START)
+    return line.startswith('E ')
+
+
+def event_lines(lines, fmt, first=0, count=None):
+    """Get the lines of some of the events in an event listing.
+    Any lines before the first event are only kept if first is 0.
+    Stops at the end marker, which is not returned.
+
+    lines: iterator
+        Lines after the start of the event listing, i.e. after the HepMC
+        start marker, or the LHE </init> line.
+    fmt: str
+        File format.
+    first: int
+        Index of the first event to use.
+    count: int
+        Number of events to use. If None, all to the end.
+    """
+    end = LHE_END if fmt == 'lhe' else HEPMC_END
+    index = -1
+    for line in lines:
+        if line.strip().startswith(end):
+            return
+        if is_event_start(line, fmt):
+            index += 1
+            if count is not None and index >= first + count:
+                return
+        if first == 0 or index >= first:
+            yield line
+
+
+def count_events(filename, fmt):
+    """Count number of events in a file by streaming through it."""
+    with open_file(filename) as f:
+        return sum(1 for line in f if is_event_start(line, fmt))
+
+
+def get_n_events(file_fmt):
+    """Get number of events in a file, for planning the chunks. Uses the number
+    requested in the filename if available (which a failed job may not have
+    reached), otherwise counts the events.
+
+    file_fmt: (str, str)
+        Filename, and file format. A tuple so it can be used with Pool.map()
+    """
+    filename, fmt = file_fmt
+    match = FILENAME_RE.search(os.path.basename(filename))
+    if match:
+        return int(match.group('nevents'))
+    return count_events(filename, fmt)
+
+
+def plan_chunks(filenames, n_events, sizes, max_events=None, max_size=None):
+    """Split the events in files into chunks, such that each chunk has no
+    more than max_events events and max_size bytes. Each chunk is filled
+    before starting the next, so a file is split between chunks at an event
+    boundary if needed. The size of each event is estimated from the size of
+    its file. A file with no (known) events can't be split, so it is kept whole.
+
+    Returns a list of chunks, each a list of (filename, first event,
+    number of events) for the parts of files in it. The number of events is
+    None for the last part of a file, to read to the end.
+
+    >>> plan_chunks(['a', 'b', 'c'], [10, 10, 10], [1, 1, 1], max_events=15)
+    [[('a', 0, None), ('b', 0, 5)], [('b', 5, None), ('c', 0, None)]]
+    """
+    chunks = []
+    current, current_events, current_size = [], 0, 0.
+    for filename, n, size in zip(filenames, n_events, sizes):
+        # a file with no events is planned as one event of its whole size
+        n_units = n or 1
+        unit_size = float(size) / n_units
+        first = 0
+        while first < n_units:
+            # number of events from this file that fit in the current chunk
+            n_fit = n_units - first
+            if max_events and n:
+                n_fit = min(n_fit, max_events - current_events)
+            if max_size:
+                n_fit = min(n_fit, int((max_size - current_size) / unit_size))
+            if current and n_fit < n_units - first:
+                # doesn't all fit, so fill this chunk & start a new one
+                if n_fit > 0:
+                    current.append((filename, first, n_fit))
+                    first += n_fit
+                chunks.append(current)
+                current, current_events, current_size = [], 0, 0.
+                continue
+            # always take at least one event, even if it is over the limits
+            n_take = max(n_fit, 1)
+            current.append((filename, first, None if first + n_take >= n_units else n_take))
+            current_events += n_take if n else 0
+            current_size += n_take * unit_size
+            first += n_take
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def merge_chunk(job):
+    """Merge a list of input files into one output file, and write a JSON
+    summary alongside it. Returns the summary dict.
+
+    job: (str, list[(str, int, int)], str)
+        File format, parts of input files as from plan_chunks(),
+        output filename. A tuple so it can be used with Pool.map()
+    """
+    fmt, inputs, out_name = job
+    if fmt == 'lhe':
+        summary = merge_lhe(inputs, out_name)
+    else:
+        summary = merge_hepmc(inputs, out_name)
+    summary['filename'] = out_name
+    summary['inputs'] = inputs
+    # do the splitext twice to get rid of e.g. X.lhe.gz
+    json_name = os.path.splitext(os.path.splitext(out_name)[0])[0] + '.json'
+    with open(json_name, 'w') as jfile:
+        json.dump(summary, jfile, indent=2, sort_keys=True)
+    return summary
+
+
+def merge_hepmc(inputs, out_name):
+    """Merge HepMC files. Header & footer are taken from the first file.
+
+    inputs: list[(str, int, int)]
+        Filename, first event, and number of events (None for all the rest)
+        for each input, as from plan_chunks()
+    """
+    n_events = 0
+    with open_file(out_name, 'w') as out_file:
+        for ind, (in_name, first, count) in enumerate(inputs):
+            with open_file(in_name) as in_file:
+                for line in in_file:
+                    if ind == 0:
+                        out_file.write(line)
+                    if line.startswith(HEPMC_START):
+                        break
+                for line in event_lines(in_file, 'hepmc', first, count):
+                    if line.startswith('E '):
+                        n_events += 1
+                    out_file.write(line)
+        out_file.write(HEPMC_END + '\n')
+    return {'nevents': n_events}
+
+
+def read_lhe_init(filename):
+    """Get the header and <init> block of an LHE file.
+
+    Returns the lines before <init>, and a dict with the beam info line,
+    a list of process info [XSECUP, XERRUP, XMAXUP, LPRUP],
+    and any other lines in the <init> block.
+    """
+    header, beam, processes, other = [], None, [], []
+    in_init = False
+    with open_file(filename) as f:
+        for line in f:
+            stripped = line.strip()
+            if not in_init:
+                if stripped.startswith('<init'):
+                    in_init = True
+                else:
+                    header.append(line)
+                continue
+            if stripped.startswith('</init'):
+                break
+            if beam is None:
+                if stripped and not stripped.startswith('#'):
+                    beam = stripped.split()
+                continue
+            if len(processes) < int(beam[-1]):
+                xsec, err, xmax, lprup = stripped.split()[:4]
+                processes.append([float(xsec), float(err), float(xmax), int(lprup)])
+            else:
+                other.append(line)
+    if beam is None:
+        raise RuntimeError('Cannot find <init> block in %s' % filename)
+    return header, {'beam': beam, 'processes': processes, 'other': other}
+
+
+def combine_lhe_inits(inits, n_events):
+    """Combine <init> blocks from several LHE files.
+
+    For each process, the cross section is the event-weighted average,
+    and the errors are combined in quadrature with the same weights.
+    XMAXUP is the maximum of the inputs.
+
+    inits: list[dict]
+        <init> info, as returned by read_lhe_init()
+    n_events: list[int]
+        Number of events in each file, used as weights.
+    """
+    beam = inits[0]['beam']
+    for init in inits[1:]:
+        # Everything apart from NPRUP must be the same
+        if init['beam'][:-1] != beam[:-1]:
+            raise RuntimeError('Incompatible beam info in LHE files: %s vs %s' % (beam, init['beam']))
+
+    combined = {}
+    for init, n in zip(inits, n_events):
+        for xsec, err, xmax, lprup in init['processes']:
+            sum_n, sum_xsec, sum_err2, max_xmax = combined.get(lprup, (0, 0., 0., 0.))
+            combined[lprup] = (sum_n + n,
+                               sum_xsec + (n * xsec),
+                               sum_err2 + (n * err) ** 2,
+                               max(max_xmax, xmax))
+
+    processes = []
+    for lprup in sorted(combined):
+        sum_n, sum_xsec, sum_err2, max_xmax = combined[lprup]
+        if sum_n == 0:
+            raise RuntimeError('No events for process %d' % lprup)
+        processes.append([sum_xsec / sum_n, math.sqrt(sum_err2) / sum_n, max_xmax, lprup])
+
+    beam = beam[:-1] + [str(len(processes))]
+    return {'beam': beam, 'processes': processes, 'other': inits[0]['other']}
+
+
+def merge_lhe(inputs, out_name):
+    """Merge LHE files. The header is taken from the first file,
+    and the <init> block is made by combining those of all files, weighted
+    by the number of events used from each.
+
+    The <init> block comes before the events, but the numbers of events are
+    only known once they have been read. So the events are streamed into a
+    separate file first, then appended after the header & <init> block.
+    (Concatenated gzip files are a valid gzip file.)
+
+    inputs: list[(str, int, int)]
+        Filename, first event, and number of events (None for all the rest)
+        for each input, as from plan_chunks()
+    """
+    headers_inits = [read_lhe_init(f) for f, _, _ in inputs]
+
+    events_name = os.path.join(os.path.dirname(out_name), '.events_' + os.path.basename(out_name))
+    weights = []
+    try:
+        with open_file(events_name, 'w') as events_file:
+            for in_name, first, count in inputs:
+                n_in = 0
+                with open_file(in_name) as in_file:
+                    for line in in_file:
+                        if line.strip().startswith('</init'):
+                            break
+                    for line in event_lines(in_file, 'lhe', first, count):
+                        if is_event_start(line, 'lhe'):
+                            n_in += 1
+                        events_file.write(line)
+                if n_in == 0:
+                    log.warning('No events in %s' % in_name)
+                weights.append(n_in)
+            events_file.write(LHE_END + '\n')
+
+        # The chunks are planned with the numbers of events in the filenames,
+        # so truncated files can leave a chunk with none
+        if not any(weights):
+            log.warning('No events for %s, inputs have fewer events than planned' % out_name)
+        init = combine_lhe_inits([hi[1] for hi in headers_inits],
+                                 weights if any(weights) else [1] * len(weights))
+
+        with open_file(out_name, 'w') as out_file:
+            out_file.write(''.join(headers_inits[0][0]))
+            out_file.write('<init>\n')
+            out_file.write(' '.join(init['beam']) + '\n')
+            for xsec, err, xmax, lprup in init['processes']:
+                out_file.write('%.8e %.8e %.8e %d\n' % (xsec, err, xmax, lprup))
+            out_file.write(''.join(init['other']))
+            out_file.write('</init>\n')
+        with open(out_name, 'ab') as out_file, open(events_name, 'rb') as events_file:
+            shutil.copyfileobj(events_file, out_file)
+    finally:
+        if os.path.isfile(events_name):
+            os.remove(events_name)
+
+    return {'nevents': sum(weights),
+            'input_nevents': weights,
+            'xsec': [{'lprup': p[3], 'xsec': p[0], 'error': p[1]}
+                     for p in init['processes']]}
+
+
+def check_create_dir(directory, info=False):
+    """Check to see if directory exists, if not make it.
+
+    Can optionally display message to user.
+    """
+    if not os.path.isdir(directory):
+        if os.path.isfile(directory):
+            raise RuntimeError("Cannot create directory %s, already "
+                               "exists as a file object" % directory)
+        os.makedirs(directory)
+        if info:
+            print "Making dir %s" % directory
+
+
+if __name__ == "__main__":
+    merge_events()
@@ -1,6 +1,12 @@
 #!/usr/bin/env python
 """
 Script to submit a batch of Delphes jobs on HTCondor
+
+Input files are taken from the production catalog (see common/catalog.py):
+all finished files in --iDir. If the catalog has none (e.g. for files made
+before it existed), the files in --iDir are used instead.
+The output ROOT files are registered in the catalog as pending, and are marked
+as done by the job once they have been copied to their destination.
 """
 
 
@@ -11,6 +17,10 @@ import logging
 from time import strftime
 from subprocess import call
 from itertools import izip_longest
+from collections import OrderedDict
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import catalog
+import storage
 
 
 logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
@@ -24,14 +34,28 @@ DELPHES_DIR = '/users/%s/delphes' % os.environ['LOGNAME']
 def submit_delphes_jobs_htcondor(in_args=sys.argv[1:], delphes_dir=DELPHES_DIR):
     """
     Main function.
+
+    Returns the DAG filename, and an OrderedDict of
+    {node name: [(input file, output file)]} as from write_dag_file().
     """
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('--card',
                         required=True,
                         help='Delphes card file. ASSUMES IT IS IN input_cards/')
     parser.add_argument('--iDir',
-                        required=True,
                         help='Input directory of hepmc/lhe files to process')
+    parser.add_argument('--inputFiles',
+                        nargs='+',
+                        action='append',
+                        help='Input files to process, instead of those in --iDir. '
+                        'They do not need to exist yet, e.g. if they are made '
+                        'by earlier jobs in a workflow. Can be used more than '
+                        'once, in which case each job only has files from one '
+                        'of them, e.g. to keep samples separate.')
+    parser.add_argument('--filesPerJob',
+                        type=int,
+                        default=2,
+                        help='Number of input files to process in each job')
     parser.add_argument('--type',
                         choices=['hepmc', 'lhe'],
                         help='Filetype to process')
@@ -39,10 +63,18 @@ def submit_delphes_jobs_htcondor(in_args=sys.argv[1:], delphes_dir=DELPHES_DIR):
                         help='Output directory for ROOT files. If one is not '
                         'specified, one will be created automatically at '
                         '<iDir>/../delphes/<card>')
+    parser.add_argument("--catalog",
+                        help="Catalog file to find input files in, and register "
+                        "output files in. "
+                        "Defaults to $%s, or %s" % (catalog.CATALOG_ENV, catalog.DEFAULT_CATALOG))
     # Some generic script options
     parser.add_argument("--dry",
                         help="Dry run, don't submit to queue.",
                         action='store_true')
+    parser.add_argument("--noSubmit",
+                        help="Copy files & write the DAG, but don't submit it, "
+                        "e.g. to include it in a bigger workflow.",
+                        action='store_true')
     parser.add_argument("-v",
                         help="Display debug messages.",
                         action='store_true')
@@ -59,8 +91,15 @@ def submit_delphes_jobs_htcondor(in_args=sys.argv[1:], delphes_dir=DELPHES_DIR):
     # -------------------------------------------------------------------------
     if not os.path.isdir(delphes_dir):
         raise RuntimeError('DELPHES_DIR does not correspond to an actual directory')
-    if not os.path.isdir(args.iDir):
+    if args.inputFiles:
+        if not args.iDir:
+            args.iDir = os.path.dirname(args.inputFiles[0][0])
+    elif not args.iDir:
+        raise RuntimeError('You must specify --iDir or --inputFiles')
+    elif not os.path.isdir(args.iDir):
         raise RuntimeError('--iDir arg does not correspond to an actual directory')
+    if args.filesPerJob < 1:
+        raise RuntimeError('--filesPerJob must be >= 1')
     if not os.path.isfile(args.card):
         raise RuntimeError('Cannot find input card')
     if os.path.dirname(args.card) != 'input_cards':
@@ -76,7 +115,11 @@ def submit_delphes_jobs_htcondor(in_args=sys.argv[1:], delphes_dir=DELPHES_DIR):
     # -------------------------------------------------------------------------
     if not args.oDir:
         args.oDir = generate_output_dir(args.iDir, os.path.basename(args.card))
-    check_create_dir(args.oDir, args.v)
+
+    # Directories to make & files to copy to /hdfs are queued up, and done
+    # all at once before submitting, with as few hadoop commands as possible
+    store = storage.get_storage()
+    store.queue_mkdir([args.oDir])
 
     # Setup log directory
     # -------------------------------------------------------------------------
@@ -94,49 +137,59 @@ def submit_delphes_jobs_htcondor(in_args=sys.argv[1:], delphes_dir=DELPHES_DIR):
 
     # Zip up Delphes installation and move it to hdfs
     # -------------------------------------------------------------------------
-    log.info('Creating tar file of Delphes installation, please wait...')
-    call(['tar', 'czf', 'delphes.tgz', '-C', os.path.dirname(delphes_dir), os.path.basename(delphes_dir)])
-    zip_dir = '/hdfs/user/%s/NMSSMPheno/zips' % (os.environ['LOGNAME'])
-    check_create_dir(zip_dir, args.v)
-    zip_filename = 'delphes.tgz'
-    zip_path = os.path.join(zip_dir, zip_filename)
-    call(['hadoop', 'fs', '-copyFromLocal', '-f', zip_filename, zip_dir.replace('/hdfs', '')])
-    os.remove(zip_filename)
-    copy_to_local[zip_path] = zip_filename
+    zip_path = '/hdfs/user/%s/NMSSMPheno/zips/delphes.tgz' % os.environ['LOGNAME']
+    if not args.dry:
+        zip_path = create_delphes_tar(delphes_dir, args.v, store)
+    copy_to_local[zip_path] = os.path.basename(zip_path)
 
     # Copy across card to hdfs
     # -------------------------------------------------------------------------
+    sandbox_cards = os.path.join(args.oDir, 'input_cards')
     if not args.dry:
-        log.debug('Copying across input_cards...')
-        call(['hadoop', 'fs', '-copyFromLocal', '-f',
-              'input_cards', args.oDir.replace('/hdfs', '')])
-    copy_to_local[os.path.join(args.oDir, 'input_cards')] = 'input_cards'
+        store.queue_upload([('input_cards', sandbox_cards)])
+    copy_to_local[sandbox_cards] = 'input_cards'
 
     # Write DAG file
     # -------------------------------------------------------------------------
     dag_name = file_stem + '.dag'
     status_name = file_stem + '.status'
 
-    write_dag_file(dag_filename=dag_name,
-                   condor_filename='HTCondor/runDelphes.condor',
-                   status_filename=status_name,
-                   copyToLocal=copy_to_local, copyFromLocal=copy_from_local,
-                   log_dir=log_dir, args=args)
+    cat = catalog.Catalog(args.catalog)
+    node_files = write_dag_file(dag_filename=dag_name,
+                                condor_filename='HTCondor/runDelphes.condor',
+                                status_filename=status_name,
+                                copyToLocal=copy_to_local, copyFromLocal=copy_from_local,
+                                log_dir=log_dir, args=args, cat=cat,
+                                input_files=args.inputFiles, files_per_job=args.filesPerJob)
+    cat.close()
+
+    # Make the output directory, copy the zip & input cards across
+    # -------------------------------------------------------------------------
+    if not args.dry:
+        log.debug('Copying across input_cards...')
+        n_uploads = len(store.pending_uploads)
+        if len(store.flush()) != n_uploads:
+            raise RuntimeError('Failed to copy input files to /hdfs')
+        log.info(store.summary())
 
     # Submit it
     # -------------------------------------------------------------------------
     if args.dry:
         log.warning('Dry run - not submitting jobs or copying files.')
+    elif args.noSubmit:
+        log.info('Not submitting %s' % dag_name)
     else:
         call(['condor_submit_dag', dag_name])
         log.info('Check status with:')
         log.info('DAGstatus.py %s' % status_name)
         log.info('Condor log files written to: %s' % log_dir)
         print''
+    return dag_name, node_files
 
 
 def write_dag_file(dag_filename, condor_filename, status_filename, log_dir,
-                   copyToLocal, copyFromLocal, args):
+                   copyToLocal, copyFromLocal, args, cat=None,
+                   input_files=None, files_per_job=2):
     """Write a DAG file for a set of jobs
 
     Creates a DAG file, setting correct args for worker node script.
@@ -155,27 +208,65 @@ def write_dag_file(dag_filename, condor_filename, status_filename, log_dir,
     args: argparse.Namespace
         Contains info about output directory, job IDs, number of events per job,
         and args to pass to the executable.
-
+    cat: catalog.Catalog
+        Catalog to get input files from, and to register output files in
+        (not for dry runs). If None, or it has no files in args.iDir,
+        the input files are found by listing args.iDir.
+    input_files: list[list[str]]
+        Groups of input files to process. Each job only has files from one
+        group. If None, they are found in the catalog or args.iDir as above,
+        as one group.
+    files_per_job: int
+        Number of input files to process in each job.
+
+    Returns an OrderedDict of {node name: [(input file, output file)]}.
     """
     # collate list of input files
     def accept_file(filename):
         fl = os.path.basename(filename).lower()
         extensions = ['.lhe', '.hepmc', '.gz', '.tar.gz', '.tgz']
-        return any([os.path.isfile(filename) and fl.endswith(ext) for ext in extensions])
-
-    print os.listdir(args.iDir)
-    input_files = [os.path.join(args.iDir, f) for f in os.listdir(args.iDir) if accept_file(os.path.join(args.iDir, f))]
-    if not input_files:
+        return any([fl.endswith(ext) for ext in extensions])
+
+    input_groups = [group for group in (input_files or []) if group]
+    if cat and not input_groups:
+        input_files = [f for f in cat.paths(directory=args.iDir, status='done', format=args.type)
+                       if accept_file(f)]
+        log.info('Found %d input files in catalog %s' % (len(input_files), cat.filename))
+        input_groups = [input_files] if input_files else []
+        if input_files:
+            # Only finished files are used, so say what is left out
+            disk_files = [os.path.join(args.iDir, f) for f in os.listdir(args.iDir)
+                          if accept_file(f)]
+            not_done, missing = cat.unfinished(args.iDir, disk_files)
+            not_done = [f for f in not_done if accept_file(f)]
+            if not_done:
+                log.warning('%d files in %s are not done in the catalog, not using them'
+                            % (len(not_done), args.iDir))
+            if missing:
+                log.warning('%d files in %s are not in the catalog, not using them. '
+                            'Add them with catalog.py scan' % (len(missing), args.iDir))
+    if not input_groups:
+        log.debug(os.listdir(args.iDir))
+        input_files = [os.path.join(args.iDir, f) for f in sorted(os.listdir(args.iDir))
+                       if os.path.isfile(os.path.join(args.iDir, f)) and accept_file(f)]
+        input_groups = [input_files] if input_files else []
+    if not input_groups:
         raise RuntimeError('No acceptable input file in %s' % args.iDir)
+    card_hash = catalog.card_hash([args.card])
 
+    # we assign each job to run over a certain number of input files,
+    # never mixing groups. The last of each group is padded with None
+    job_inputs = [[f for f in files if f]
+                  for group in input_groups
+                  for files in grouper(group, files_per_job)]
+
+    node_files = OrderedDict()
     log.info("DAG file: %s" % dag_filename)
     with open(dag_filename, 'w') as dag_file:
         dag_file.write('# DAG for card %s\n' % args.card)
         dag_file.write('# Outputting to %s\n' % args.oDir)
 
-        # we assign each job to run over a certain number of input files.
-        files_per_job = 2
-        for ind, input_files in enumerate(grouper(input_files, files_per_job)):
+        for ind, input_files in enumerate(job_inputs):
             job_name = '%d_%s' % (ind, os.path.basename(args.card))
             dag_file.write('JOB %s %s\n' % (job_name, condor_filename))
 
@@ -194,6 +285,18 @@ def write_dag_file(dag_filename, condor_filename, status_filename, log_dir,
             output_files = [os.path.join(args.oDir, stem(f)) + '.root' for f in input_files]
             for in_file, out_file in zip(input_files, output_files):
                 job_opts.extend(['--process', in_file, out_file])
+            node_files[job_name] = zip(input_files, output_files)
+
+            # Register outputs, with the same sample info as their inputs
+            # ----------------------------------------------------------------
+            if cat and not args.dry:
+                for in_file, out_file in zip(input_files, output_files):
+                    in_info = cat.get(in_file)
+                    fields = {col: in_info[col] for col in ['channel', 'mass', 'energy',
+                                                            'seed', 'n_events']} if in_info else {}
+                    cat.register(out_file, generator='Delphes', format='root',
+                                 card_hash=card_hash, status='pending', **fields)
+                job_opts.extend(['--catalog', cat.filename])
 
             # start with files to copyToLocal at the start of job running
             # ----------------------------------------------------------------
@@ -215,6 +318,32 @@ def write_dag_file(dag_filename, condor_filename, status_filename, log_dir,
                            job_name, ' '.join(job_opts), log_dir, log_name))
 
         dag_file.write('NODE_STATUS_FILE %s 30\n' % status_filename)
+    return node_files
+
+
+def create_delphes_tar(delphes_dir, info=False, store=None):
+    """Make a tar file of the Delphes installation, and put it on /hdfs.
+    The worker node scripts assume it is called delphes.tgz.
+
+    store: storage.Storage
+        Storage to queue the copy with, to be done by its next flush().
+        If None, the copy is done straight away.
+
+    Returns the location of the tar file on /hdfs.
+    """
+    log.info('Creating tar file of Delphes installation, please wait...')
+    delphes_dir = delphes_dir.rstrip('/')
+    zip_filename = 'delphes.tgz'
+    call(['tar', 'czf', zip_filename, '-C', os.path.dirname(delphes_dir), os.path.basename(delphes_dir)])
+    zip_dir = '/hdfs/user/%s/NMSSMPheno/zips' % (os.environ['LOGNAME'])
+    zip_path = os.path.join(zip_dir, zip_filename)
+    queue = store is not None
+    store = store or storage.get_storage()
+    store.queue_mkdir([zip_dir])
+    store.queue_upload([(zip_filename, zip_path)], remove=True)
+    if not queue:
+        store.flush()
+    return zip_path
 
 
 def check_create_dir(directory, info=False):
@@ -13,12 +13,12 @@ This is mainly responsible for:
 
 
 import argparse
-from subprocess import call
 import sys
-import shutil
 import os
 import tarfile
 from glob import glob
+# transferred alongside this script, see mcJob.condor
+import storage
 
 
 def main(in_args=sys.argv[1:]):
@@ -33,11 +33,20 @@ def main(in_args=sys.argv[1:]):
                         "after running program. "
                         "Must be of the form <source> <destination>. "
                         "Repeat for each file you want to copy.")
+    parser.add_argument("--catalog",
+                        help="Catalog file, to mark output files as done "
+                        "once they have been copied.")
     parser.add_argument("--args", nargs=argparse.REMAINDER,
                         help="")
     args = parser.parse_args(args=in_args)
     print args
 
+    # catalog.py is transferred alongside this script, so import it before
+    # moving to the sandbox area
+    if args.catalog:
+        import catalog
+    store = storage.get_storage()
+
     # Make sandbox area to avoid names clashing, and stop auto transfer
     # back to submission node
     # -------------------------------------------------------------------------
@@ -50,14 +59,7 @@ def main(in_args=sys.argv[1:]):
     if args.copyToLocal:
         for (source, dest) in args.copyToLocal:
             print source, dest
-            if source.startswith('/hdfs'):
-                source = source.replace('/hdfs', '')
-                call(['hadoop', 'fs', '-copyToLocal', source, dest])
-            else:
-                if os.path.isfile(source):
-                    shutil.copy2(source, dest)
-                elif os.path.isdir(source):
-                    shutil.copytree(source, dest)
+        store.download(args.copyToLocal)
         print os.listdir(os.getcwd())
 
     # Setup MG5_aMC
@@ -88,28 +90,21 @@ def main(in_args=sys.argv[1:]):
 
     # Copy files from worker node area to /hdfs or /storage
     # -------------------------------------------------------------------------
+    # The destination directories are all made first, with one mkdir for
+    # those on /hdfs, then the files copied with one put per directory
+    copied = []
     if args.copyFromLocal:
         for (source, dest) in args.copyFromLocal:
-            check_create_dir(os.path.dirname(dest))
             print source, dest
-            if dest.startswith('/hdfs'):
-                dest = dest.replace('/hdfs', '')
-                call(['hadoop', 'fs', '-copyFromLocal', '-f', source, dest])
-            else:
-                if os.path.isfile(source):
-                    shutil.copy2(source, dest)
-                elif os.path.isdir(source):
-                    shutil.copytree(source, dest)
-
-
-def check_create_dir(directory, info=False):
-    """Check dir exists, if not create"""
-    if not os.path.isdir(directory):
-        if os.path.isfile(directory):
-            raise RuntimeError('%s already exists as a file' % directory)
-        os.makedirs(directory)
-        if info:
-            print 'Making dir', directory
+        store.make_dirs([os.path.dirname(dest) for (_, dest) in args.copyFromLocal])
+        copied = store.upload(args.copyFromLocal)
+    print store.summary()
+
+    # Mark outputs as done in the catalog. Only the files registered by the
+    # submit script are in it, so the other files are ignored.
+    # -------------------------------------------------------------------------
+    if args.catalog and copied:
+        catalog.mark_outputs_done(args.catalog, [(dest, source) for (source, dest) in copied])
 
 
 def get_value_from_card(card, field):
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+"""
+Combine cross sections from the many MG5_aMC@NLO jobs of a channel.
+
+For each job, the HTCondor submission copies summary.txt to
+<oDir>/other/summary_<seed>.txt (and RunMaterial.tar.gz to
+<oDir>/other/RunMaterial_<seed>.tar.gz). This script parses all of those for
+one or more output directories in parallel, and combines the cross sections
+using an inverse-variance weighted mean. Seeds whose cross section is far from
+the median of all seeds are flagged as outliers, and left out of the mean
+unless --keepOutliers is used.
+
+Parsed values are cached in <oDir>/other/xsec_cache.json, keyed by file
+modification time and size, so re-running only parses new or changed files.
+
+The result is written as a JSON normalisation table, with one entry per
+channel (the same names as used in MadAnalysis/samples.json):
+
+{"pp13_bb": {"xsec": 1.2e+05, "error": 1.1e+02, "unit": "pb",
+             "nevents": 1000000, "weight": 0.12, ...}}
+
+where weight = xsec / nevents is the per-event weight in pb. nevents counts
+all seeds, including outliers, as their events are still in the sample.
+If the number of events is unknown for any seed, weight is null.
+
+e.g.:
+./combine_xsec.py /hdfs/user/<username>/NMSSMPheno/MG5_aMC/13TeV/pp13_bb/18_Nov_15
+"""
+
+
+import os
+import re
+import sys
+import json
+import math
+import tarfile
+import argparse
+import logging
+from multiprocessing import Pool, cpu_count
+
+
+logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+log = logging.getLogger(__name__)
+
+
+# Conversion factors to pb
+UNITS = {'fb': 1E-3, 'pb': 1., 'nb': 1E3, 'ub': 1E6, 'mb': 1E9}
+
+SUMMARY_RE = re.compile(r'^summary_(?P<seed>\d+)\.txt$')
+XSEC_RE = re.compile(r'Total cross[- ]section\s*:\s*(?P<xsec>\S+)\s*\+-\s*(?P<error>\S+)\s*(?P<unit>\w+)')
+NEVENTS_RE = re.compile(r'Number of (?:unweighted )?events generated\s*:\s*(?P<nevents>\d+)')
+PROCESS_RE = re.compile(r'Process\s+(?P<process>.+)$')
+
+CACHE_NAME = 'xsec_cache.json'
+
+
+def combine_xsec(in_args=sys.argv[1:]):
+    """Main function. Parse summaries, combine, and write table."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('oDirs',
+                        nargs='+',
+                        help='Output directories of submit_mg5_jobs_htcondor.py, '
+                        'i.e. those containing the other/ subdirectory')
+    parser.add_argument('--output',
+                        default='xsec.json',
+                        help='Output JSON normalisation table. If it already '
+                        'exists, channels will be added/updated.')
+    parser.add_argument('--pull',
+                        type=float,
+                        default=5.,
+                        help='Flag a seed as an outlier if its cross section '
+                        'is more than this many of its standard deviations '
+                        'from the median cross section')
+    parser.add_argument('--keepOutliers',
+                        action='store_true',
+                        help='Include outlier seeds in the combined cross section')
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=cpu_count(),
+                        help='Number of files to parse in parallel. '
+                        'Defaults to the number of cores.')
+    parser.add_argument("-v",
+                        help="Display debug messages.",
+                        action='store_true')
+    args = parser.parse_args(args=in_args)
+
+    if args.v:
+        log.setLevel(logging.DEBUG)
+
+    log.debug('program args: %s' % args)
+
+    table = {}
+    if os.path.isfile(args.output):
+        with open(args.output) as jfile:
+            table = json.load(jfile)
+
+    pool = Pool(args.jobs)
+    for o_dir in args.oDirs:
+        o_dir = o_dir.rstrip('/')
+        other_dir = os.path.join(o_dir, 'other')
+        if not os.path.isdir(other_dir):
+            raise RuntimeError('%s does not exist' % other_dir)
+
+        channel = get_channel(o_dir)
+        results = parse_dir(other_dir, pool)
+        if not results:
+            log.warning('No cross sections found in %s, skipping' % other_dir)
+            continue
+
+        entry = combine_results(results, args.pull, args.keepOutliers)
+        entry['dir'] = o_dir
+        table[channel] = entry
+
+        log.info('%s: %.4e +- %.4e pb from %d jobs, %d events' % (channel,
+                                                                   entry['xsec'],
+                                                                   entry['error'],
+                                                                   entry['n_jobs'],
+                                                                   entry['nevents']))
+        if entry['outliers']:
+            note = '' if args.keepOutliers else ' (not in mean)'
+            log.warning('%s: outlier seeds%s: %s' % (channel, note,
+                                                     ' '.join(str(s) for s in entry['outliers'])))
+    pool.close()
+    pool.join()
+
+    log.info('Writing normalisation table to %s' % args.output)
+    with open(args.output, 'w') as jfile:
+        json.dump(table, jfile, indent=2, sort_keys=True)
+    return table
+
+
+def get_channel(o_dir):
+    """Get channel name from an output directory generated by
+    generate_dir_soolin(), i.e. <...>/<energy>TeV/<channel>/<date>.
+
+    If the directory does not follow that pattern, use its basename.
+    """
+    parent, date = os.path.split(o_dir)
+    if re.match(r'\d{2}_\w{3}_\d{2}$', date):
+        return os.path.basename(parent)
+    return date
+
+
+def parse_dir(other_dir, pool):
+    """Parse all summary_<seed>.txt files in a directory, using the cache
+    where possible and the pool for everything else.
+
+    Returns a list of dicts, one per seed, sorted by seed.
+    """
+    cache_name = os.path.join(other_dir, CACHE_NAME)
+    cache = {}
+    if os.path.isfile(cache_name):
+        with open(cache_name) as jfile:
+            cache = json.load(jfile)
+
+    results, to_parse = [], []
+    for filename in sorted(os.listdir(other_dir)):
+        if not SUMMARY_RE.match(filename):
+            continue
+        stat = os.stat(os.path.join(other_dir, filename))
+        cached = cache.get(filename)
+        if cached and cached['mtime'] == stat.st_mtime and cached['size'] == stat.st_size:
+            results.append(cached)
+        else:
+            to_parse.append(os.path.join(other_dir, filename))
+
+    log.debug('%s: %d cached, %d to parse' % (other_dir, len(results), len(to_parse)))
+    results.extend(pool.map(parse_summary, to_parse))
+
+    cache = {os.path.basename(r['filename']): r for r in results}
+    with open(cache_name, 'w') as jfile:
+        json.dump(cache, jfile, indent=2, sort_keys=True)
+
+    return sorted([r for r in results if r['xsec'] is not None], key=lambda r: r['seed'])
+
+
+def parse_summary(filename):
+    """Parse a MG5_aMC summary file. If the number of events isn't in there,
+    try the run_card in the corresponding RunMaterial tarball.
+
+    Returns a dict of info, with the cross section in pb.
+    If no cross section could be found, it is set to None.
+    """
+    stat = os.stat(filename)
+    seed = int(SUMMARY_RE.match(os.path.basename(filename)).group('seed'))
+    result = {'filename': filename, 'seed': seed,
+              'mtime': stat.st_mtime, 'size': stat.st_size,
+              'xsec': None, 'error': None, 'nevents': None, 'process': None}
+
+    with open(filename) as f:
+        for line in f:
+            match = XSEC_RE.search(line)
+            if match:
+                unit = match.group('unit').lower()
+                if unit not in UNITS:
+                    log.warning('Unknown unit %s in %s' % (unit, filename))
+                    continue
+                result['xsec'] = float(match.group('xsec')) * UNITS[unit]
+                result['error'] = float(match.group('error')) * UNITS[unit]
+                continue
+            match = NEVENTS_RE.search(line)
+            if match:
+                result['nevents'] = int(match.group('nevents'))
+                continue
+            match = PROCESS_RE.search(line.strip())
+            if match and not result['process']:
+                result['process'] = match.group('process').strip()
+
+    if result['xsec'] is None:
+        log.warning('No cross section in %s' % filename)
+
+    if result['nevents'] is None:
+        tar_name = os.path.join(os.path.dirname(filename), 'RunMaterial_%d.tar.gz' % seed)
+        if os.path.isfile(tar_name):
+            result['nevents'] = get_nevents_from_run_material(tar_name)
+
+    return result
+
+
+def get_nevents_from_run_material(tar_name):
+    """Get the number of events requested from the run_card inside a
+    RunMaterial tarball. Returns None if it can't be found."""
+    try:
+        with tarfile.open(tar_name) as tar:
+            for member in tar.getmembers():
+                if not member.name.endswith('run_card.dat'):
+                    continue
+                for line in tar.extractfile(member):
+                    # of the form: 10000 = nevents ! Number of unweighted events requested
+                    parts = line.split('!')[0].split('=')
+                    if len(parts) == 2 and parts[1].strip() == 'nevents':
+                        return int(parts[0])
+    except (tarfile.TarError, IOError) as e:
+        log.warning('Cannot read %s: %s' % (tar_name, e))
+    return None
+
+
+def combine_results(results, max_pull=5., keep_outliers=False):
+    """Combine cross sections from many jobs.
+
+    The combined cross section is the inverse-variance weighted mean.
+    A job is an outlier if |xsec - median| / error > max_pull. The median is
+    used so that a single bad job can't drag the reference value towards it.
+
+    results: list[dict]
+        Parsed info for each job, from parse_summary()
+    max_pull: float
+        Threshold for flagging outliers.
+    keep_outliers: bool
+        If True, outliers are included in the mean. Otherwise they are only
+        used for the event count.
+    """
+    xsecs = sorted(r['xsec'] for r in results)
+    mid = len(xsecs) // 2
+    median = xsecs[mid] if len(xsecs) % 2 else 0.5 * (xsecs[mid - 1] + xsecs[mid])
+
+    outliers = [r['seed'] for r in results
+                if r['error'] > 0 and abs(r['xsec'] - median) / r['error'] > max_pull]
+    used = results if keep_outliers else [r for r in results if r['seed'] not in outliers]
+
+    # Jobs with 0 error would get infinite weight, so treat them separately
+    with_error = [r for r in used if r['error'] > 0]
+    if with_error:
+        sum_w = sum(1. / r['error'] ** 2 for r in with_error)
+        xsec = sum(r['xsec'] / r['error'] ** 2 for r in with_error) / sum_w
+        error = 1. / math.sqrt(sum_w)
+    else:
+        xsec = sum(r['xsec'] for r in used) / len(used)
+        error = 0.
+
+    chi2 = sum(((r['xsec'] - xsec) / r['error']) ** 2 for r in with_error)
+
+    # The per-event weight needs the events from every seed, so it can't be
+    # made if any are unknown
+    nevents = sum(r['nevents'] for r in results if r['nevents'])
+    missing_nevents = [r['seed'] for r in results if not r['nevents']]
+    if missing_nevents:
+        log.warning('Unknown number of events for seeds: %s, not setting weight'
+                    % ' '.join(str(s) for s in missing_nevents))
+
+    processes = sorted(set(r['process'] for r in results if r['process']))
+    if len(processes) > 1:
+        log.warning('More than one process in summaries: %s' % processes)
+
+    return {'xsec': xsec,
+            'error': error,
+            'unit': 'pb',
+            'nevents': nevents,
+            'weight': xsec / nevents if nevents and not missing_nevents else None,
+            'n_jobs': len(used),
+            'chi2_ndf': chi2 / (len(with_error) - 1) if len(with_error) > 1 else None,
+            'outliers': outliers,
+            'seeds': [r['seed'] for r in results],
+            'process': processes[0] if processes else None}
+
+
+if __name__ == "__main__":
+    combine_xsec()
@@ -3,14 +3,20 @@
 """
 Script to run MG5_aMC locally. Creates new input card from user's options,
 to ensure that Pythia8 & HepMC linked correctly, and other options.
+
+Several seeds can be run at once using --seeds, in which case each seed is run
+in its own directory, seed_<seed>, using a pool of processes.
 """
 
 import argparse
 import sys
 import os
 import re
+import gzip
+import time
 import logging
 from subprocess import call
+from multiprocessing import Pool, cpu_count
 
 
 logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
@@ -41,6 +47,17 @@ class MG5ArgParser(argparse.ArgumentParser):
                           help='Random number generator seed',
                           default=0,
                           type=int)
+        self.add_argument('--seeds',
+                          help='Run over a range of seeds locally, in parallel. '
+                          'Must be of the form: startSeed endSeed. '
+                          'This will superseed any --seed option',
+                          nargs=2, type=int,
+                          metavar=('startSeed', 'endSeed'))
+        self.add_argument('-j', '--jobs',
+                          help='Number of seeds to run in parallel when using '
+                          '--seeds. Defaults to the number of cores.',
+                          default=cpu_count(),
+                          type=int)
         self.add_argument('--pythia8',
                           dest='pythia8_path',
                           help='Path to Pythia directory',
@@ -85,6 +102,10 @@ def run_mg5(in_args=sys.argv[1:]):
 
     log.debug(fields)
 
+    if args.seeds:
+        run_mg5_seeds(args, fields)
+        return args
+
     # make a new card for MG5_aMC
     new_card = args.card.replace(".txt", "_new.txt")
     args.__dict__['new_card'] = new_card
@@ -100,6 +121,85 @@ def run_mg5(in_args=sys.argv[1:]):
     return args
 
 
+def run_mg5_seeds(args, fields):
+    """Make a card for each seed, and run MG5_aMC for all of them in parallel.
+
+    Each seed is run in its own directory, seed_<seed>, so that the output
+    directories from MG5_aMC don't clash.
+
+    args: argparse.Namespace
+        Parsed args from MG5ArgParser.
+    fields: dict
+        Dict of things to replace in the template card, see make_card().
+    """
+    if args.seeds[1] < args.seeds[0]:
+        raise RuntimeError('The second --seeds argument must be >= the first.')
+    if args.jobs < 1:
+        raise RuntimeError('--jobs must be >= 1')
+
+    exe = os.path.abspath(args.exe)
+    output = get_value_from_card(args.card, 'output')
+    jobs = []
+    for seed in xrange(args.seeds[0], args.seeds[1] + 1):
+        work_dir = os.path.abspath('seed_%d' % seed)
+        if not os.path.isdir(work_dir):
+            os.makedirs(work_dir)
+        seed_fields = dict(fields, iseed=seed)
+        new_card = os.path.join(work_dir, os.path.basename(args.card).replace(".txt", "_new.txt"))
+        make_card(args.card, new_card, seed_fields)
+        jobs.append((seed, exe, new_card, work_dir, output))
+
+    if args.dry:
+        return
+
+    n_procs = min(args.jobs, len(jobs))
+    log.info('Running %d seeds with %d processes' % (len(jobs), n_procs))
+    pool = Pool(n_procs)
+    results = pool.map(run_seed, jobs)
+    pool.close()
+    pool.join()
+
+    # Print summary
+    log.info('%6s %8s %12s %10s' % ('Seed', 'Status', 'Wall time/s', 'Events'))
+    for res in results:
+        log.info('%6d %8s %12.1f %10s' % (res['seed'],
+                                          'OK' if res['returncode'] == 0 else 'FAILED',
+                                          res['time'],
+                                          res['nevents'] if res['nevents'] is not None else '?'))
+    log.info('Total: %d events' % sum(res['nevents'] or 0 for res in results))
+
+    failed = [res['seed'] for res in results if res['returncode'] != 0]
+    if failed:
+        raise RuntimeError('MG5_aMC failed for seeds: %s' % ' '.join(str(s) for s in failed))
+
+
+def run_seed(job):
+    """Run MG5_aMC for one seed inside its own directory.
+    The output from MG5_aMC is written to mg5.log in that directory.
+
+    Returns a dict of info about the run: seed, returncode, wall time,
+    and number of events produced (None if unknown).
+
+    job: (int, str, str, str, str)
+        Seed, MG5_aMC exe, card, directory to run in, and the output name from
+        the card. A tuple so it can be used with Pool.map()
+    """
+    seed, exe, card, work_dir, output = job
+    log.info('Running MG5_aMC with card %s' % card)
+    start = time.time()
+    with open(os.path.join(work_dir, 'mg5.log'), 'w') as log_file:
+        returncode = call([exe, card], cwd=work_dir, stdout=log_file, stderr=log_file)
+    wall_time = time.time() - start
+
+    nevents = None
+    if output:
+        lhe_zip = os.path.join(work_dir, output, 'Events', 'run_01', 'events.lhe.gz')
+        if os.path.isfile(lhe_zip):
+            with gzip.open(lhe_zip) as lhe_file:
+                nevents = sum(1 for line in lhe_file if line.lstrip().startswith('<event'))
+    return {'seed': seed, 'returncode': returncode, 'time': wall_time, 'nevents': nevents}
+
+
 def make_card(in_card, out_card, fields):
     """Make a copy of a card file, replacing various attributes.
 
@@ -147,5 +247,19 @@ def make_card(in_card, out_card, fields):
         out_file.write(''.join(card_template))
 
 
+def get_value_from_card(card, field):
+    """Get value of field from card.
+
+    card: str
+        Filename
+    field: str
+        Field name
+    """
+    with open(card) as f:
+        for line in f:
+            if field in line.strip():
+                return line.strip().split()[-1]
+
+
 if __name__ == "__main__":
     run_mg5()
@@ -20,10 +20,13 @@ set up, but the job is not submitted.
 
 Note that this submits the jobs not one-by-one but as a DAG, to allow easier
 monitoring of job status.
+
+Each LHE & HepMC output file is registered in the production catalog (see
+common/catalog.py) as pending, and is marked as done by the job once it has
+been copied to its destination.
 """
 
 
-import shutil
 from time import strftime
 from subprocess import call
 import argparse
@@ -33,6 +36,9 @@ import getpass
 import logging
 import re
 from run_mg5 import MG5ArgParser
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import catalog
+import storage
 
 
 logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
@@ -73,6 +79,9 @@ def submit_mc_jobs_htcondor(in_args=sys.argv[1:], mg5_dir=MG5_DIR):
                         help="All other program arguments. "
                         "You MUST specify this after all other options",
                         nargs=argparse.REMAINDER)
+    parser.add_argument("--catalog",
+                        help="Catalog file to register output files in. "
+                        "Defaults to $%s, or %s" % (catalog.CATALOG_ENV, catalog.DEFAULT_CATALOG))
     # Some generic script options
     parser.add_argument("--dry",
                         help="Dry run, don't submit to queue.",
@@ -114,6 +123,7 @@ def submit_mc_jobs_htcondor(in_args=sys.argv[1:], mg5_dir=MG5_DIR):
         raise RuntimeError('Put your card in input_cards directory')
     args.card = card
     args.channel = get_value_from_card(args.card, 'output')
+    args.card_hash = catalog.card_hash([card])
 
     # Get CoM energy
     # -------------------------------------------------------------------------
@@ -124,7 +134,10 @@ def submit_mc_jobs_htcondor(in_args=sys.argv[1:], mg5_dir=MG5_DIR):
     if args.oDir == "":
         args.oDir = generate_dir_soolin(args.channel, args.energy)
 
-    check_create_dir(args.oDir)
+    # Directories to make & files to copy to /hdfs are queued up, and done
+    # all at once before submitting, with as few hadoop commands as possible
+    store = storage.get_storage()
+    store.queue_mkdir([args.oDir])
 
     # Dicts to hold thing to be copied before/after the job runs
     copy_to_local = {}
@@ -136,32 +149,25 @@ def submit_mc_jobs_htcondor(in_args=sys.argv[1:], mg5_dir=MG5_DIR):
     if mg5_dir.endswith("/"):
         mg5_dir = mg5_dir.rstrip('/')
     version = re.findall(r'MG5_aMC_v.*', mg5_dir)[0]
-    log.info('Creating tar file of MG5 installation, please wait...')
-    call(['tar', 'czf', '%s.tgz' % version, '-C', os.path.dirname(mg5_dir), version])
-    # copy to hdfs
-    zip_dir = '/hdfs/user/%s/NMSSMPheno/zips/' % (os.environ['LOGNAME'])
-    check_create_dir(zip_dir)
+    zip_dir = '/hdfs/user/%s/NMSSMPheno/zips' % (os.environ['LOGNAME'])
     zip_filename = '%s.tgz' % version
     zip_path = os.path.join(zip_dir, zip_filename)
-    call(['hadoop', 'fs', '-copyFromLocal', '-f', zip_filename, zip_dir.replace('/hdfs', '')])
-    os.remove(zip_filename)
-    copy_to_local[zip_path] = 'MG5_aMC.tgz'
-
-    # Copy across input cards to hdfs to sandbox them
-    # -------------------------------------------------------------------------
     if not args.dry:
-        log.debug('Copying across input_cards...')
-        call(['hadoop', 'fs', '-copyFromLocal', '-f',
-              'input_cards', args.oDir.replace('/hdfs', '')])
-    copy_to_local[os.path.join(args.oDir, 'input_cards')] = 'input_cards'
+        log.info('Creating tar file of MG5 installation, please wait...')
+        call(['tar', 'czf', zip_filename, '-C', os.path.dirname(mg5_dir), version])
+        # copy to hdfs, removing the local tar after
+        store.queue_mkdir([zip_dir])
+        store.queue_upload([(zip_filename, zip_path)], remove=True)
+    copy_to_local[zip_path] = 'MG5_aMC.tgz'
 
-    # Copy run script to outputdir to sandbox it
+    # Copy across input cards & run script to outputdir to sandbox them
     # -------------------------------------------------------------------------
+    sandbox_cards = os.path.join(args.oDir, 'input_cards')
     sandbox_script = os.path.join(args.oDir, 'run_mg5.py')
+    copy_to_local[sandbox_cards] = 'input_cards'
     copy_to_local[sandbox_script] = 'run_mg5.py'
     if not args.dry:
-        log.debug('Copying across exe...')
-        shutil.copy2('run_mg5.py', sandbox_script)
+        store.queue_upload([('input_cards', sandbox_cards), ('run_mg5.py', sandbox_script)])
 
     # Setup log directory
     # -------------------------------------------------------------------------
@@ -178,11 +184,22 @@ def submit_mc_jobs_htcondor(in_args=sys.argv[1:], mg5_dir=MG5_DIR):
     # -------------------------------------------------------------------------
     dag_name = file_stem + '.dag'
     status_name = file_stem + '.status'
+    # Register output files in the catalog, not for dry runs
+    cat = None if args.dry else catalog.Catalog(args.catalog)
     write_dag_file(dag_filename=dag_name,
                    condor_filename='HTCondor/mcJob.condor',
                    status_filename=status_name,
                    copyToLocal=copy_to_local, copyFromLocal=copy_from_local,
-                   log_dir=log_dir, args=args)
+                   log_dir=log_dir, args=args, cat=cat)
+
+    # Make the output directory, copy the zip, input cards & run script across
+    # -------------------------------------------------------------------------
+    if not args.dry:
+        log.debug('Copying across input_cards, exe...')
+        n_uploads = len(store.pending_uploads)
+        if len(store.flush()) != n_uploads:
+            raise RuntimeError('Failed to copy input files to /hdfs')
+        log.info(store.summary())
 
     # Submit it
     # -------------------------------------------------------------------------
@@ -197,7 +214,7 @@ def submit_mc_jobs_htcondor(in_args=sys.argv[1:], mg5_dir=MG5_DIR):
 
 
 def write_dag_file(dag_filename, condor_filename, status_filename, log_dir,
-                   copyToLocal, copyFromLocal, args):
+                   copyToLocal, copyFromLocal, args, cat=None):
     """Write a DAG file for a set of jobs.
 
     Creates a DAG file, adding extra flags for the worker node script.
@@ -219,6 +236,9 @@ def write_dag_file(dag_filename, condor_filename, status_filename, log_dir,
     args: argparse.Namespace
         Contains info about output directory, job IDs, number of events per job,
         and args to pass to the executable.
+    cat: catalog.Catalog
+        Catalog to register LHE & HepMC files in as pending. If None, files
+        are not registered.
     """
     # to parse the MG5 specific parts
     mg5_parser = MG5ArgParser()
@@ -258,6 +278,14 @@ def write_dag_file(dag_filename, condor_filename, status_filename, log_dir,
 
             job_opts.extend(['--copyFromLocal', lhe_zip, os.path.join(args.oDir, 'lhe', lhe_final_zip)])
             job_opts.extend(['--copyFromLocal', hepmc_zip, os.path.join(args.oDir, 'hepmc', hepmc_final_zip)])
+            if cat:
+                for fmt, final_zip in [('lhe', lhe_final_zip), ('hepmc', hepmc_final_zip)]:
+                    cat.register(os.path.join(args.oDir, fmt, final_zip),
+                                 generator='MG5_aMC', channel=args.channel,
+                                 energy=args.energy, seed=job_ind,
+                                 n_events=mg5_args.nevents, format=fmt,
+                                 card_hash=args.card_hash, status='pending')
+                job_opts.extend(['--catalog', cat.filename])
             # Supplementary materials
             job_opts.extend(['--copyFromLocal', os.path.join(output_dir, 'RunMaterial.tar.gz'),
                              os.path.join(args.oDir, 'other', 'RunMaterial_%d.tar.gz' % job_ind)])
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+"""
+This script is designed to run MadAnalysis over a filelist on the worker node
+on HTCondor. User should not run this script directly!
+
+The filelist, input files, and run directory must all be accessible from the
+worker node.
+"""
+
+
+import argparse
+import sys
+import os
+
+
+def main(in_args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--exe", required=True,
+                        help="Location of MadAnalysis executable")
+    parser.add_argument("--filelist", required=True,
+                        help="Filelist to run over")
+    parser.add_argument("--runDir", required=True,
+                        help="Directory to run MadAnalysis in")
+    parser.add_argument("--fingerprint",
+                        help="Fingerprint of inputs, stored if successful")
+    args = parser.parse_args(args=in_args)
+    print args
+
+    # run_ma.py is transferred to the initial working directory
+    sys.path.insert(0, os.path.abspath('.'))
+    import run_ma
+    flist, returncode = run_ma.run_filelist((args.exe, args.filelist,
+                                                  args.runDir, args.fingerprint))
+    print 'MadAnalysis returned', returncode, 'for', flist
+    return returncode
+
+
+if __name__ == "__main__":
+    sys.exit(main())
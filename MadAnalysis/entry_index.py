@@ -0,0 +1,106 @@
+"""
+Persistent index of the number of entries in the Delphes tree of ROOT files.
+
+Opening every ROOT file to count its events is slow, especially over /hdfs,
+so the counts are stored in a JSON file, keyed by file path. The size and
+modification time of each file are also stored, so that the count is only
+redone if the file has changed.
+
+ROOT is only imported if a file actually needs to be opened.
+"""
+
+
+import os
+import json
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+class EntryIndex(object):
+    """Index of number of entries per ROOT file.
+
+    filename: str
+        JSON file to store the index in. Created if it doesn't exist.
+    tree_name: str
+        Name of the TTree to count entries of.
+    """
+
+    def __init__(self, filename, tree_name='Delphes'):
+        self.filename = filename
+        self.tree_name = tree_name
+        self.entries = {}
+        self.modified = False
+        if os.path.isfile(filename):
+            with open(filename) as jfile:
+                self.entries = json.load(jfile)
+
+    def get_entries(self, filename):
+        """Get number of entries in the tree for a file, using the index if
+        it is up to date, otherwise by opening the file."""
+        filename = os.path.abspath(filename)
+        stat = os.stat(filename)
+        entry = self.entries.get(filename)
+        if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            return entry['entries']
+
+        log.debug('Counting entries in %s' % filename)
+        n_entries = count_entries(filename, self.tree_name)
+        self.entries[filename] = {'size': stat.st_size,
+                                  'mtime': stat.st_mtime,
+                                  'entries': n_entries}
+        self.modified = True
+        return n_entries
+
+    def save(self):
+        """Write the index to file, if anything has changed."""
+        if not self.modified:
+            return
+        log.debug('Writing entry index to %s' % self.filename)
+        with open(self.filename, 'w') as jfile:
+            json.dump(self.entries, jfile, indent=2, sort_keys=True)
+        self.modified = False
+
+
+def count_entries(filename, tree_name):
+    """Open a ROOT file and get the number of entries in a tree."""
+    import ROOT
+    ROOT.PyConfig.IgnoreCommandLineOptions = True
+    f = ROOT.TFile.Open(filename)
+    if not f or f.IsZombie():
+        raise RuntimeError('Cannot open file %s' % filename)
+    tree = f.Get(tree_name)
+    if not tree:
+        f.Close()
+        raise RuntimeError('Cannot get tree %s from %s' % (tree_name, filename))
+    n_entries = int(tree.GetEntries())
+    f.Close()
+    return n_entries
+
+
+def select_files(filenames, n_events, index):
+    """Select the smallest set of files that has at least n_events entries.
+
+    Files are picked largest first, with ties broken by filename, so the
+    selection is reproducible. If there aren't enough events in total,
+    all files are returned. The selected files are returned sorted by filename.
+
+    filenames: list[str]
+        Files to choose from.
+    n_events: int
+        Number of events required.
+    index: EntryIndex
+        Index to get the number of entries for each file.
+    """
+    counts = sorted(((index.get_entries(f), f) for f in filenames),
+                    key=lambda x: (-x[0], x[1]))
+    selected, total = [], 0
+    for entries, filename in counts:
+        if total >= n_events:
+            break
+        selected.append(filename)
+        total += entries
+    if total < n_events:
+        log.warning('Only %d events available, fewer than the %d requested' % (total, n_events))
+    return sorted(selected)
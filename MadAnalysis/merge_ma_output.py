@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+"""
+Merge the outputs of several MadAnalysis runs over shards of the same channel
+into one output.
+
+Cut-flow (.saf) and histogram (.saf) files are merged by summing the counters,
+statistics and bin contents. Other files are copied from the first shard.
+
+e.g.:
+./merge_ma_output.py --name ggh125_2a_4tau --output run_dir/ggh125_2a_4tau/Output/ggh125_2a_4tau \
+run_dir/ggh125_2a_4tau_shard0/Output/ggh125_2a_4tau_shard0 run_dir/ggh125_2a_4tau_shard1/Output/ggh125_2a_4tau_shard1
+"""
+
+
+import os
+import re
+import sys
+import math
+import shutil
+import argparse
+import logging
+from collections import OrderedDict
+
+
+logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+log = logging.getLogger(__name__)
+
+
+# SAF blocks whose numbers are accumulated, so should be summed across shards
+SUM_TAGS = ['InitialCounter', 'Counter', 'Statistics', 'Data']
+# SAF blocks whose lines should be concatenated across shards
+CONCAT_TAGS = ['FileInfo']
+# Holds xsec, xsec error, nevents, sum of +ve weights, sum of -ve weights
+GLOBAL_INFO_TAG = 'SampleGlobalInfo'
+
+TAG_RE = re.compile(r'^<(/?)(\w+)>$')
+
+
+def merge_ma_output(in_args=sys.argv[1:]):
+    """Main function."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('shardDirs',
+                        nargs='+',
+                        help='Output directories for each shard')
+    parser.add_argument('--output',
+                        required=True,
+                        help='Output directory for merged files')
+    parser.add_argument('--name',
+                        required=True,
+                        help='Name of the merged sample. Replaces the shard '
+                        'name in any filenames.')
+    parser.add_argument("-v",
+                        help="Display debug messages.",
+                        action='store_true')
+    args = parser.parse_args(args=in_args)
+
+    if args.v:
+        log.setLevel(logging.DEBUG)
+
+    merge_outputs(args.shardDirs, args.output, args.name)
+
+
+def merge_outputs(shard_dirs, out_dir, name):
+    """Merge the MadAnalysis output directories from several shards.
+
+    shard_dirs: list[str]
+        Output directories, one per shard. The basename of each is assumed to
+        be the shard name, and is replaced by name in the output filenames.
+    out_dir: str
+        Output directory for merged files.
+    name: str
+        Name of the merged sample.
+    """
+    # Collect the equivalent files from each shard
+    rel_files = OrderedDict()
+    for shard_dir in shard_dirs:
+        shard_dir = shard_dir.rstrip('/')
+        if not os.path.isdir(shard_dir):
+            raise RuntimeError('Shard output %s does not exist' % shard_dir)
+        shard = os.path.basename(shard_dir)
+        for root, _, files in os.walk(shard_dir):
+            for f in sorted(files):
+                filename = os.path.join(root, f)
+                rel = os.path.relpath(filename, shard_dir).replace(shard, name)
+                rel_files.setdefault(rel, []).append(filename)
+
+    log.info('Merging %d shards into %s' % (len(shard_dirs), out_dir))
+    for rel, inputs in rel_files.iteritems():
+        if len(inputs) != len(shard_dirs):
+            log.warning('%s only in %d/%d shards' % (rel, len(inputs), len(shard_dirs)))
+        out_name = os.path.join(out_dir, rel)
+        if not os.path.isdir(os.path.dirname(out_name)):
+            os.makedirs(os.path.dirname(out_name))
+        if rel.endswith('.saf'):
+            log.debug('Merging %s' % rel)
+            merge_saf_files(inputs, out_name)
+        else:
+            shutil.copy2(inputs[0], out_name)
+
+
+def read_saf(filename):
+    """Read a SAF file.
+
+    Returns a list of (line, tag) for each line, where tag is the innermost
+    block the line is in (None if not in a block), and a list of lines
+    in any blocks that should be concatenated. Lines in those blocks are
+    replaced by a single placeholder entry in the first list.
+    """
+    lines, concat = [], []
+    tags = []
+    with open(filename) as f:
+        for line in f:
+            match = TAG_RE.match(line.strip())
+            if match:
+                closing, tag = match.groups()
+                if closing and tags and tags[-1] == tag:
+                    tags.pop()
+                elif not closing:
+                    tags.append(tag)
+                    if tag in CONCAT_TAGS:
+                        lines.append((line, tag))
+                        lines.append((None, tag))
+                        continue
+                lines.append((line, None))
+                continue
+            current = tags[-1] if tags else None
+            if current in CONCAT_TAGS:
+                concat.append(line)
+                continue
+            lines.append((line, current))
+    return lines, concat
+
+
+def split_numbers(line):
+    """Split a line into a list of numbers (as strings) and its comment.
+    Returns None for the numbers if the line isn't purely numbers.
+    """
+    values, _, comment = line.partition('#')
+    values = values.split()
+    try:
+        [float(v) for v in values]
+    except ValueError:
+        return None, comment
+    return values, comment
+
+
+def format_number(value, as_int):
+    """Format a number, as an int if as_int, otherwise in scientific notation"""
+    if as_int:
+        return '%d' % value
+    return '%.10e' % value
+
+
+def sum_lines(lines):
+    """Sum the numbers in equivalent lines from several files, element-wise.
+    The comment and indentation are taken from the first line.
+    If the lines don't only contain numbers, the first is returned.
+    """
+    split = [split_numbers(line) for line in lines]
+    if any(values is None for values, _ in split) or len(set(len(v) for v, _ in split)) != 1:
+        return lines[0]
+    values = split[0][0]
+    if not values:
+        return lines[0]
+    summed = []
+    for i in range(len(values)):
+        column = [v[i] for v, _ in split]
+        as_int = all(re.match(r'^-?\d+$', c) for c in column)
+        total = sum(int(c) if as_int else float(c) for c in column)
+        summed.append(format_number(total, as_int))
+    indent = lines[0][:len(lines[0]) - len(lines[0].lstrip())]
+    comment = split[0][1].rstrip('\n')
+    line = indent + ' '.join(summed)
+    if comment:
+        line += ' # ' + comment.strip()
+    return line + '\n'
+
+
+def combine_global_info(lines):
+    """Combine the global info line from several files.
+
+    Of the form: xsec xsec_error nevents sum_weight+ sum_weight-
+    The cross section is averaged, weighted by nevents. Everything else is
+    summed, with the errors in quadrature.
+    """
+    split = [split_numbers(line)[0] for line in lines]
+    if any(not values or len(values) != 5 for values in split):
+        return sum_lines(lines)
+    nevents = [float(v[2]) for v in split]
+    total = sum(nevents)
+    if total == 0:
+        return sum_lines(lines)
+    xsec = sum(n * float(v[0]) for n, v in zip(nevents, split)) / total
+    error = math.sqrt(sum((n * float(v[1])) ** 2 for n, v in zip(nevents, split))) / total
+    indent = lines[0][:len(lines[0]) - len(lines[0].lstrip())]
+    values = [format_number(xsec, False),
+              format_number(error, False),
+              format_number(total, True),
+              format_number(sum(float(v[3]) for v in split), False),
+              format_number(sum(float(v[4]) for v in split), False)]
+    return indent + ' '.join(values) + '\n'
+
+
+def merge_saf_files(inputs, out_name):
+    """Merge equivalent SAF files from several shards.
+
+    The files must have the same structure, i.e. come from the same analysis.
+    """
+    contents = [read_saf(f) for f in inputs]
+    n_lines = set(len(lines) for lines, _ in contents)
+    if len(n_lines) != 1:
+        raise RuntimeError('SAF files have different structures, cannot merge: %s' % inputs)
+
+    with open(out_name, 'w') as out_file:
+        for parts in zip(*[lines for lines, _ in contents]):
+            lines = [line for line, _ in parts]
+            tag = parts[0][1]
+            if lines[0] is None:
+                # placeholder for lines to be concatenated
+                for _, concat in contents:
+                    out_file.write(''.join(concat))
+            elif tag in SUM_TAGS:
+                out_file.write(sum_lines(lines))
+            elif tag == GLOBAL_INFO_TAG and split_numbers(lines[0])[0]:
+                out_file.write(combine_global_info(lines))
+            else:
+                out_file.write(lines[0])
+
+
+if __name__ == "__main__":
+    merge_ma_output()
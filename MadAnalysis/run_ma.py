@@ -3,6 +3,24 @@
 Run MadAnalysis locally.
 
 Takes care of untarring input files, etc.
+
+Each channel is run in its own directory, run_dir/<channel>, with several
+channels running in parallel.
+
+Channels with many files can be split into shards (--shards, or "shards" for
+a channel in the samples JSON), each of which is run separately. The outputs
+of the shards are then merged into run_dir/<channel>/Output/<channel>.
+Shards can either be run locally, or on HTCondor as a DAG (--batch).
+
+For each channel/shard, a fingerprint of the input files (paths, sizes,
+modification times), the MadAnalysis exe, any analysis config files (--config),
+and the channel info from the samples JSON is stored after a successful run.
+If it matches on the next run, the existing output is reused instead of running
+MadAnalysis again. Use --force to rerun everything.
+
+For directories in the samples JSON, the files are taken from the production
+catalog (see common/catalog.py) if it has any finished files in that directory,
+otherwise the directory is listed.
 """
 
 
@@ -10,8 +28,17 @@ import os
 import sys
 import argparse
 import json
+import glob
+import hashlib
 import logging
+from time import strftime
 from subprocess import call
+from multiprocessing import Pool, cpu_count
+from collections import OrderedDict
+from merge_ma_output import merge_outputs
+from entry_index import EntryIndex, select_files
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import catalog
 
 
 logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
@@ -36,6 +63,38 @@ class MadAnalysisArgParser(argparse.ArgumentParser):
         self.add_argument('--dry',
                           action='store_true',
                           help="Only make card, don't run MadAnalysis")
+        self.add_argument('-j', '--jobs',
+                          help='Number of channels/shards to run in parallel. '
+                          'Defaults to the number of cores.',
+                          default=cpu_count(),
+                          type=int)
+        self.add_argument('--shards',
+                          help='Number of shards to split each channel into. '
+                          'Can be overridden for each channel by setting '
+                          '"shards" in the samples JSON.',
+                          default=1,
+                          type=int)
+        self.add_argument('--index',
+                          help='JSON file to cache the number of events in '
+                          'each input file, for channels with "events"',
+                          default='delphes_entries.json')
+        self.add_argument('--config',
+                          nargs='+',
+                          default=[],
+                          help='Analysis config files. Only used to determine '
+                          'if a channel needs rerunning.')
+        self.add_argument('--force',
+                          action='store_true',
+                          help='Rerun all channels, even if their inputs, exe '
+                          'and config are unchanged')
+        self.add_argument('--catalog',
+                          help='Catalog file to find input files in. '
+                          'Defaults to $%s, or %s' % (catalog.CATALOG_ENV,
+                                                      catalog.DEFAULT_CATALOG))
+        self.add_argument('--batch',
+                          action='store_true',
+                          help='Run shards on HTCondor as a DAG, '
+                          'rather than locally')
         self.add_argument("-v",
                           action='store_true',
                           help="Display debug messages.")
@@ -55,6 +114,13 @@ def run_ma(in_args=sys.argv[1:]):
         raise RuntimeError('JSON samples file does not exist')
     if not os.path.isfile(args.exe):
         raise RuntimeError('MadAnalysis exe does not exist')
+    if args.jobs < 1:
+        raise RuntimeError('--jobs must be >= 1')
+    if args.shards < 1:
+        raise RuntimeError('--shards must be >= 1')
+    for config in args.config:
+        if not os.path.isfile(config):
+            raise RuntimeError('Config file %s does not exist' % config)
 
     # Interpret samples JSON
     # ------------------------------------------------------------------------
@@ -63,27 +129,258 @@ def run_ma(in_args=sys.argv[1:]):
         sample_dict = json.load(jfile)
     log.debug('Sample dictionary: %s' % sample_dict)
 
-    filelists = generate_filelists(sample_dict, os.getcwd())
+    index = EntryIndex(args.index)
+    cat = catalog.Catalog(args.catalog)
+    filelists = generate_filelists(sample_dict, os.getcwd(), args.shards, index, cat)
+    cat.close()
+    index.save()
+    if not filelists:
+        log.warning('No channels to run over')
+        return
+
+    exe_abs = os.path.abspath(args.exe)
+    run_dir = os.path.abspath('run_dir')
 
-    # Run MadAnalysis
+    # Figure out which channels/shards need (re)running
+    # ------------------------------------------------------------------------
+    fingerprints = {}
+    to_run = []
+    for channel, shards in filelists.iteritems():
+        for flist in shards:
+            fingerprints[flist] = calc_fingerprint(flist, exe_abs, args.config,
+                                                   sample_dict[channel])
+            if args.force or not is_up_to_date(flist, run_dir, fingerprints[flist]):
+                to_run.append(flist)
+            else:
+                log.info('Inputs for %s unchanged, reusing output in %s' % (
+                         os.path.basename(flist), generate_output_dir(flist, run_dir)))
+    to_merge = [channel for channel, shards in filelists.iteritems()
+                if len(shards) > 1 and
+                (any(flist in to_run for flist in shards) or
+                 not os.path.isdir(generate_output_dir(channel, run_dir)))]
+    if not to_run and not to_merge:
+        log.info('Nothing to do, all outputs up to date')
+        return
+
+    # Run MadAnalysis on HTCondor
+    # ------------------------------------------------------------------------
+    if args.batch:
+        file_stem = os.path.join(run_dir, strftime("%H%M%S"))
+        log_dir = os.path.join(run_dir, 'logs')
+        if not os.path.isdir(log_dir):
+            os.makedirs(log_dir)
+        dag_name = file_stem + '.dag'
+        status_name = file_stem + '.status'
+        write_dag_file(dag_filename=dag_name, status_filename=status_name,
+                       log_dir=log_dir, filelists=filelists,
+                       exe=exe_abs, run_dir=run_dir, fingerprints=fingerprints,
+                       to_run=to_run, to_merge=to_merge)
+        if args.dry:
+            log.warning('Dry run - not submitting jobs.')
+        else:
+            call(['condor_submit_dag', dag_name])
+            log.info('Check status with:')
+            log.info('DAGstatus.py %s' % status_name)
+            log.info('Condor log files written to: %s' % log_dir)
+        return
+
+    # Run MadAnalysis locally
     # ------------------------------------------------------------------------
-    # we make a temporary inner directory to run from since the output from
-    # MadAnalysis will be put in $PWD/../Output/
     if not args.dry:
-        exe_abs = os.path.abspath(args.exe)
-        tmp_dir = 'run_dir'
-        if not os.path.isdir(tmp_dir):
-            os.makedirs(tmp_dir)
-        os.chdir(tmp_dir)
-        for flist in filelists:
-            call([exe_abs, flist])
+        jobs = [(exe_abs, flist, run_dir, fingerprints[flist]) for flist in to_run]
+        results = []
+        if jobs:
+            n_procs = min(args.jobs, len(jobs))
+            log.info('Running %d channels/shards with %d processes' % (len(jobs), n_procs))
+            pool = Pool(n_procs)
+            results = pool.map(run_filelist, jobs)
+            pool.close()
+            pool.join()
+
+        failed = [flist for flist, returncode in results if returncode != 0]
+        for flist in failed:
+            log.error('MadAnalysis failed for %s, see %s' % (flist, generate_log_name(flist, run_dir)))
+
+        # Merge the outputs of sharded channels
+        for channel in to_merge:
+            shards = filelists[channel]
+            if any(flist in failed for flist in shards):
+                log.error('Not merging shards for %s as some failed' % channel)
+                continue
+            merge_outputs(shard_dirs=[generate_output_dir(flist, run_dir) for flist in shards],
+                          out_dir=generate_output_dir(channel, run_dir),
+                          name=channel)
+
+        if failed:
+            raise RuntimeError('MadAnalysis failed for %d/%d channels/shards' % (len(failed), len(jobs)))
+
+
+def run_filelist(job):
+    """Run MadAnalysis over one filelist.
+
+    Each filelist gets its own directory, <run_dir>/<filelist name>. Since the
+    output from MadAnalysis will be put in $PWD/../Output/, we make a
+    temporary inner directory to run from, so the output ends up in
+    <run_dir>/<filelist name>/Output. The output from MadAnalysis is written
+    to <run_dir>/<filelist name>/ma.log
+
+    If a fingerprint is given, it is stored if MadAnalysis succeeds,
+    so future runs can be skipped if nothing has changed.
+
+    Returns the filelist and return code of MadAnalysis.
+
+    job: (str, str, str, str)
+        MadAnalysis exe, filelist, the top directory to run in, and the
+        fingerprint of the inputs (or None).
+        A tuple so it can be used with Pool.map()
+    """
+    exe, flist, run_dir, fingerprint = job
+    tmp_dir = os.path.join(run_dir, os.path.basename(flist), 'run')
+    if not os.path.isdir(tmp_dir):
+        os.makedirs(tmp_dir)
+    # remove any old fingerprint, in case this run fails
+    fingerprint_name = generate_fingerprint_name(flist, run_dir)
+    if os.path.isfile(fingerprint_name):
+        os.remove(fingerprint_name)
+    log.info('Running MadAnalysis over %s' % flist)
+    with open(generate_log_name(flist, run_dir), 'w') as log_file:
+        returncode = call([exe, flist], cwd=tmp_dir, stdout=log_file, stderr=log_file)
+    if returncode == 0 and fingerprint:
+        with open(fingerprint_name, 'w') as f:
+            f.write(fingerprint)
+    return flist, returncode
+
+
+def calc_fingerprint(flist, exe, config_files, chan_dict):
+    """Calculate a fingerprint for running MadAnalysis over a filelist,
+    using the path, size and modification time of each input file,
+    the exe, and the config files, along with the channel info.
+    """
+    fingerprint = hashlib.sha1()
+
+    def add_file(filename):
+        stat = os.stat(filename)
+        fingerprint.update('%s %d %r\n' % (os.path.abspath(filename), stat.st_size, stat.st_mtime))
+
+    with open(flist) as f:
+        for line in f:
+            if line.strip():
+                add_file(line.strip())
+    add_file(exe)
+    for config in sorted(config_files):
+        add_file(config)
+    fingerprint.update(json.dumps(chan_dict, sort_keys=True))
+    return fingerprint.hexdigest()
+
 
+def is_up_to_date(flist, run_dir, fingerprint):
+    """Check if there is output from a previous successful run with the same
+    fingerprint."""
+    fingerprint_name = generate_fingerprint_name(flist, run_dir)
+    if not os.path.isfile(fingerprint_name):
+        return False
+    if not os.path.isdir(generate_output_dir(flist, run_dir)):
+        return False
+    with open(fingerprint_name) as f:
+        return f.read().strip() == fingerprint
 
-def generate_filelists(sample_dict, out_dir):
+
+def generate_fingerprint_name(flist, run_dir):
+    """Generate the fingerprint filename for running over a filelist"""
+    return os.path.join(run_dir, os.path.basename(flist), 'fingerprint')
+
+
+def generate_log_name(flist, run_dir):
+    """Generate the log filename for running over a filelist"""
+    return os.path.join(run_dir, os.path.basename(flist), 'ma.log')
+
+
+def generate_output_dir(flist, run_dir):
+    """Generate the MadAnalysis output directory for a filelist"""
+    name = os.path.basename(flist)
+    return os.path.join(run_dir, name, 'Output', name)
+
+
+def write_dag_file(dag_filename, status_filename, log_dir, filelists, exe, run_dir,
+                   fingerprints=None, to_run=None, to_merge=None):
+    """Write a DAG file to run MadAnalysis over filelists on HTCondor.
+
+    Each filelist is run as its own job. For channels split into several
+    shards, a merge job is added that runs once all its shards have finished.
+    Also ensures a DAG status file will be written every 30s.
+
+    dag_filename: str
+        Name to be used for DAG job file.
+    status_filename: str
+        Name to be used for DAG status file.
+    log_dir: str
+        Directory for condor log files.
+    filelists: dict{str: list[str]}
+        Filelists for each shard of each channel,
+        as returned by generate_filelists()
+    exe: str
+        Location of MadAnalysis executable.
+    run_dir: str
+        Directory in which to run MadAnalysis.
+    fingerprints: Optional[dict{str: str}]
+        Fingerprint of the inputs for each filelist, stored after each job.
+    to_run: Optional[list[str]]
+        Filelists to run over. If None, all filelists are run over.
+    to_merge: Optional[list[str]]
+        Channels whose shards should be merged. If None, all sharded channels
+        are merged.
+
+    Returns an OrderedDict of {node name: filelist} for the MadAnalysis jobs.
+    """
+    fingerprints = fingerprints or {}
+    node_filelists = OrderedDict()
+    # condor files refer to scripts relative to this directory
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    log_name = os.path.splitext(os.path.basename(dag_filename))[0]
+
+    log.info("DAG file: %s" % dag_filename)
+    with open(dag_filename, 'w') as dag_file:
+        dag_file.write('# DAG for channels %s\n' % ' '.join(filelists.keys()))
+        dag_file.write('# Outputting to %s\n' % run_dir)
+        for channel, shards in filelists.iteritems():
+            job_names = []
+            for flist in shards:
+                if to_run is not None and flist not in to_run:
+                    continue
+                job_name = 'ma_%s' % os.path.basename(flist)
+                job_names.append(job_name)
+                node_filelists[job_name] = flist
+                dag_file.write('JOB %s HTCondor/runMA.condor DIR %s\n' % (job_name, script_dir))
+                job_opts = ['--exe', exe, '--filelist', flist, '--runDir', run_dir]
+                if fingerprints.get(flist):
+                    job_opts.extend(['--fingerprint', fingerprints[flist]])
+                dag_file.write('VARS %s opts="%s" logdir="%s" logfile="%s"\n' % (job_name,
+                                                                                ' '.join(job_opts),
+                                                                                log_dir,
+                                                                                log_name))
+            if len(shards) == 1 or (to_merge is not None and channel not in to_merge):
+                continue
+
+            merge_name = 'merge_%s' % channel
+            dag_file.write('JOB %s HTCondor/mergeMA.condor DIR %s\n' % (merge_name, script_dir))
+            job_opts = ['--name', channel, '--output', generate_output_dir(channel, run_dir)]
+            job_opts.extend([generate_output_dir(flist, run_dir) for flist in shards])
+            dag_file.write('VARS %s opts="%s" logdir="%s" logfile="%s"\n' % (merge_name,
+                                                                            ' '.join(job_opts),
+                                                                            log_dir,
+                                                                            log_name))
+            if job_names:
+                dag_file.write('PARENT %s CHILD %s\n' % (' '.join(job_names), merge_name))
+        dag_file.write('NODE_STATUS_FILE %s 30\n' % status_filename)
+    return node_filelists
+
+
+def generate_filelists(sample_dict, out_dir, n_shards=1, index=None, cat=None):
     """Generate list of files suitable for use as input to MadAnalysis.
     Each file list will be named after the sample it represents.
 
-    Returns a list of the absolute filepaths for the file lists.
+    Returns an OrderedDict of channel : list of the absolute filepaths for the
+    file lists for each shard of that channel.
 
     sample_dict: dict
         Dict of info for channels. Key is the channel name, value is a
@@ -91,15 +388,67 @@ def generate_filelists(sample_dict, out_dir):
         Channels starting with #, !, _ will be ignored.
     out_dir: str
         Output directory for filelists.
+    n_shards: int
+        Default number of shards to split each channel into.
+    index: EntryIndex
+        Index of number of events per file. Only needed for channels that
+        specify "events".
+    cat: catalog.Catalog
+        Catalog to get the files in each directory from.
     """
-    return [create_filelist(channel, chan_dict, out_dir)
-            for channel, chan_dict in sample_dict.iteritems()
-            if channel[0] not in ['#', '!', '_']]
+    return OrderedDict((channel, create_filelist(channel, chan_dict, out_dir,
+                                                 chan_dict.get('shards', n_shards),
+                                                 index, cat))
+                       for channel, chan_dict in sorted(sample_dict.iteritems())
+                       if channel[0] not in ['#', '!', '_'])
+
+
+def get_channel_files(dirs, ext='.root', cat=None):
+    """Get sorted list of files from a list of directories and/or glob patterns.
+
+    For a directory, all files in it with extension ext are used. These are
+    taken from the catalog cat if it has any finished files in the directory,
+    otherwise the directory is listed.
+    For a glob pattern, all matching files are used.
+    """
+    def accept_file(filename):
+        return (ext and filename.endswith(ext)) or not ext
+
+    files = set()
+    for d in dirs:
+        if glob.has_magic(d):
+            files.update(f for f in glob.glob(d) if os.path.isfile(f))
+            continue
+        cat_files = cat.paths(directory=d, status='done') if cat else []
+        disk_files = [os.path.join(d, f) for f in os.listdir(d) if accept_file(f)]
+        if cat_files:
+            log.debug('Using %d files in %s from catalog' % (len(cat_files), d))
+            files.update(f for f in cat_files if accept_file(f))
+            # Only finished files are used, so say what is left out
+            not_done, missing = cat.unfinished(d, disk_files)
+            not_done = [f for f in not_done if accept_file(f)]
+            if not_done:
+                log.warning('%d files in %s are not done in the catalog, not using them'
+                            % (len(not_done), d))
+            if missing:
+                log.warning('%d files in %s are not in the catalog, not using them. '
+                            'Add them with catalog.py scan' % (len(missing), d))
+        else:
+            files.update(disk_files)
+    return sorted(files)
 
 
-def create_filelist(channel, chan_dict, out_dir):
-    """Create a filelist suitable for passing to MadAnalysis.
-    Returns filename of filelist.
+def create_filelist(channel, chan_dict, out_dir, n_shards=1, index=None, cat=None):
+    """Create filelist(s) suitable for passing to MadAnalysis.
+    Returns list of filenames of filelists.
+
+    Files are taken from the entries in chan_dict['dirs'], which can be
+    directories or glob patterns. Either the first chan_dict['num'] files
+    (sorted by name) are used, or the smallest set of files that have at least
+    chan_dict['events'] events.
+
+    If n_shards > 1, the files are split into (up to) n_shards contiguous
+    blocks of roughly equal size, with filelists named <channel>_shard<N>.
 
     channel: str
         Name of the channel. Used for the filelist filename.
@@ -107,24 +456,43 @@ def create_filelist(channel, chan_dict, out_dir):
         Dictionary of info corresponding to each channel
     out_dir: str
         Output directory for filelist.
+    n_shards: int
+        Number of shards to split the channel into.
+    index: EntryIndex
+        Index of number of events per file. Required if chan_dict has "events".
+    cat: catalog.Catalog
+        Catalog to get the files in each directory from.
     """
-    filename = os.path.join(out_dir, channel)
-
-    def dir_file_iter(dirs, ext):
-        for d in dirs:
-            for f in os.listdir(d):
-                if (ext and f.endswith(ext)) or not ext:
-                    yield os.path.join(d, f)
-
-    with open(filename, 'w') as flist:
-        log.debug('Writing filelist %s' % channel)
-        n_files = chan_dict['num']
-        for i, f in enumerate(dir_file_iter(chan_dict['dirs'], '.root')):
-            if i >= n_files and n_files > 0:
-                break
-            flist.write('%s\n' % f)
-
-    return filename
+    files = get_channel_files(chan_dict['dirs'], '.root', cat)
+
+    if chan_dict.get('events', -1) > 0:
+        if index is None:
+            raise RuntimeError('Need an EntryIndex to select files by events')
+        files = select_files(files, chan_dict['events'], index)
+    elif chan_dict.get('num', -1) > 0:
+        files = files[:chan_dict['num']]
+
+    n_shards = max(1, min(n_shards, len(files)))
+    if n_shards == 1:
+        shards = [(channel, files)]
+    else:
+        shard_size, remainder = divmod(len(files), n_shards)
+        shards, start = [], 0
+        for i in xrange(n_shards):
+            end = start + shard_size + (1 if i < remainder else 0)
+            shards.append(('%s_shard%d' % (channel, i), files[start:end]))
+            start = end
+
+    filenames = []
+    for name, shard_files in shards:
+        filename = os.path.join(out_dir, name)
+        with open(filename, 'w') as flist:
+            log.debug('Writing filelist %s' % name)
+            for f in shard_files:
+                flist.write('%s\n' % f)
+        filenames.append(filename)
+
+    return filenames
 
 
 if __name__ == "__main__":
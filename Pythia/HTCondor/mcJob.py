@@ -2,14 +2,28 @@
 """
 This script is designed to setup and run on the worker node on HTCondor.
 User should not run this script directly!
+
+With --delphes, Delphes is run on the HepMC output as it is generated:
+the HepMC "file" is a named pipe, read by a thread that passes the events to
+DelphesHepMC (and optionally writes a zipped copy with --keepHepMC).
+
+Outputs listed with --compress are gzipped after the program has finished,
+using several threads (see common/compress.py).
 """
 
 
 import argparse
-from subprocess import call
+from subprocess import call, Popen, PIPE
 import sys
-import shutil
 import os
+import threading
+# transferred alongside this script, see mcJob.condor
+import compress
+import storage
+
+
+# Size of blocks of HepMC text passed from the generator to Delphes
+STREAM_CHUNK = 1024 * 1024
 
 
 def main(in_args=sys.argv[1:]):
@@ -25,11 +39,29 @@ def main(in_args=sys.argv[1:]):
                         "Must be of the form <source> <destination>. "
                         "Repeat for each file you want to copy.")
     parser.add_argument("--exe", help="Name of executable", default="mc.exe")
+    parser.add_argument("--catalog",
+                        help="Catalog file, to mark output files as done "
+                        "once they have been copied.")
+    parser.add_argument("--delphes", nargs=2,
+                        help="Run Delphes on the HepMC output as it is generated. "
+                        "Must be of the form <Delphes card> <output ROOT file>. "
+                        "Needs delphes.tgz to be copied with --copyToLocal.")
+    parser.add_argument("--keepHepMC", action='store_true',
+                        help="With --delphes, also save the HepMC output as "
+                        "<HepMC file>.gz")
+    parser.add_argument("--compress", action='append', default=[],
+                        help="Output file to gzip after running the program. "
+                        "Repeat for each file you want to compress.")
     parser.add_argument("--args", nargs=argparse.REMAINDER,
                         help="")
     args = parser.parse_args(args=in_args)
     print args
 
+    # catalog.py is transferred alongside this script, so import it before
+    # moving to the sandbox area
+    if args.catalog:
+        import catalog
+
     # Make sandbox area to avoid names clashing, and stop auto transfer
     # back to submission node
     # -------------------------------------------------------------------------
@@ -38,16 +70,10 @@ def main(in_args=sys.argv[1:]):
 
     # Copy files to worker node area from /users, /hdfs, /storage, etc.
     # -------------------------------------------------------------------------
+    store = storage.get_storage()
     for (source, dest) in args.copyToLocal:
         print source, dest
-        if source.startswith('/hdfs'):
-            source = source.replace('/hdfs', '')
-            call(['hadoop', 'fs', '-copyToLocal', source, dest])
-        else:
-            if os.path.isfile(source):
-                shutil.copy2(source, dest)
-            elif os.path.isdir(source):
-                shutil.copytree(source, dest)
+    store.download(args.copyToLocal)
 
     print os.listdir(os.getcwd())
 
@@ -56,22 +82,126 @@ def main(in_args=sys.argv[1:]):
     os.chmod(args.exe, 0555)
     cmds = ["./" + args.exe] + args.args
     print cmds
-    call(cmds)
+    # Outputs not to copy, as they were not made properly
+    failed = []
+    if args.delphes:
+        card, delphes_output = args.delphes
+        hepmc_name = args.args[args.args.index('--hepmc') + 1]
+        gen_code, delphes_code = run_with_delphes(cmds, hepmc_name, card,
+                                                  delphes_output, args.keepHepMC)
+        if gen_code != 0 or delphes_code != 0:
+            # the ROOT file (& HepMC copy) will be truncated
+            failed.append(delphes_output)
+            if args.keepHepMC:
+                failed.append(hepmc_name + '.gz')
+            print 'Generator or Delphes failed, not copying', ' '.join(failed)
+    else:
+        call(cmds)
+
+    # Compress outputs, with as many threads as we have cores
+    # -------------------------------------------------------------------------
+    for filename in args.compress:
+        if os.path.isfile(filename):
+            compress.compress_file(filename)
+        else:
+            print 'Not compressing', filename, 'as it does not exist'
 
     print os.listdir(os.getcwd())
 
-    # Copy files from worker node area to /hdfs or /storage
+    # Copy files from worker node area to /hdfs or /storage.
+    # The destinations are directories.
     # -------------------------------------------------------------------------
-    for (source, dest) in args.copyFromLocal:
+    outputs = [(source, os.path.join(dest, os.path.basename(source)))
+               for (source, dest) in args.copyFromLocal if source not in failed]
+    for (source, dest) in outputs:
         print source, dest
-        if dest.startswith('/hdfs'):
-            dest = dest.replace('/hdfs', '')
-            call(['hadoop', 'fs', '-copyFromLocal', '-f', source, dest])
-        else:
-            if os.path.isfile(source):
-                shutil.copy2(source, dest)
-            elif os.path.isdir(source):
-                shutil.copytree(source, dest)
+    copied = store.upload(outputs)
+    print store.summary()
+
+    # Mark outputs as done in the catalog
+    # -------------------------------------------------------------------------
+    if args.catalog:
+        catalog.mark_outputs_done(args.catalog, [(dest, source) for (source, dest) in copied])
+
+    # Fail the job, so that DAGMan can retry it
+    if failed:
+        sys.exit(1)
+
+
+def run_with_delphes(cmds, hepmc_name, card, delphes_output, keep_hepmc=False):
+    """Run the generator, passing its HepMC output straight to Delphes.
+
+    cmds: list[str]
+        Generator command.
+    hepmc_name: str
+        HepMC filename the generator writes to. This is made as a named pipe.
+    card: str
+        Delphes card.
+    delphes_output: str
+        Delphes output ROOT filename.
+    keep_hepmc: bool
+        Also save the HepMC output as hepmc_name.gz
+
+    Returns the return codes of the generator and Delphes.
+    """
+    # Setup Delphes. Assumes tarfile is called delphes.tgz!
+    delphes_tar = 'delphes.tgz'
+    call(['tar', 'xzf', delphes_tar])
+    os.remove(delphes_tar)
+    # DelphesHepMC reads from stdin if not given an input file
+    delphes_cmds = ['./DelphesHepMC', os.path.abspath(card), os.path.abspath(delphes_output)]
+    print delphes_cmds
+    delphes = Popen(delphes_cmds, stdin=PIPE, cwd='delphes')
+
+    os.mkfifo(hepmc_name)
+    zip_name = hepmc_name + '.gz' if keep_hepmc else None
+    streamer = threading.Thread(target=stream_hepmc, args=(hepmc_name, delphes.stdin, zip_name))
+    streamer.start()
+
+    gen_code = call(cmds)
+    # If the generator stopped without opening the pipe, the thread is still
+    # waiting for it to open, so open & close it here to let the thread finish
+    try:
+        os.close(os.open(hepmc_name, os.O_WRONLY | os.O_NONBLOCK))
+    except OSError:
+        pass
+    streamer.join()
+    delphes_code = delphes.wait()
+    os.remove(hepmc_name)
+    print 'Generator returned', gen_code, 'Delphes returned', delphes_code
+    return gen_code, delphes_code
+
+
+def stream_hepmc(pipe_name, delphes_stdin, zip_name=None):
+    """Read HepMC text from a named pipe, and pass it on to Delphes.
+    Optionally also write it to a gzipped file.
+
+    pipe_name: str
+        Named pipe to read from.
+    delphes_stdin: file
+        Pipe to Delphes. Closed at the end.
+    zip_name: str
+        If set, also write the HepMC text to this gzipped file.
+    """
+    zip_file = compress.ParallelWriter(zip_name) if zip_name else None
+    delphes_ok = True
+    with open(pipe_name, 'rb') as pipe:
+        for block in iter(lambda: pipe.read(STREAM_CHUNK), ''):
+            if delphes_ok:
+                try:
+                    delphes_stdin.write(block)
+                except IOError as err:
+                    # keep reading, so the generator doesn't get stuck
+                    print 'Delphes stopped reading:', err
+                    delphes_ok = False
+            if zip_file:
+                zip_file.write(block)
+    if zip_file:
+        zip_file.close()
+    try:
+        delphes_stdin.close()
+    except IOError:
+        pass
 
 
 if __name__ == "__main__":
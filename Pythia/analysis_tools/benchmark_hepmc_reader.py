@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""
+Measure the throughput of hepmc_reader.py on a HepMC file, in MB/s of
+(uncompressed) input, events/s, and particles/s. Also reports the peak
+memory use, to check it doesn't grow with the file size.
+
+e.g.:
+./benchmark_hepmc_reader.py ggh125_2a_4tau_ma1_8_13TeV_n1000_seed0.hepmc.gz
+
+or make a test file with 10000 events, 200 particles each, first:
+
+./benchmark_hepmc_reader.py --generate 10000 --particles 200 test.hepmc.gz
+"""
+
+
+import os
+import sys
+import gzip
+import time
+import resource
+import argparse
+import logging
+import numpy as np
+import hepmc_reader
+
+
+logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+log = logging.getLogger(__name__)
+
+
+def benchmark_hepmc_reader(in_args=sys.argv[1:]):
+    """Main function"""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input',
+                        help='HepMC file to read')
+    parser.add_argument('--batchSize',
+                        type=int,
+                        default=1000,
+                        help='Number of events per batch')
+    parser.add_argument('--generate',
+                        type=int,
+                        default=0,
+                        help='Make the input file with this many random events first')
+    parser.add_argument('--particles',
+                        type=int,
+                        default=200,
+                        help='Number of particles per event for --generate')
+    args = parser.parse_args(args=in_args)
+
+    if args.generate:
+        generate_file(args.input, args.generate, args.particles)
+
+    size_on_disk = os.path.getsize(args.input)
+    n_bytes = get_uncompressed_size(args.input)
+
+    start = time.time()
+    n_events, n_particles, n_batches = 0, 0, 0
+    for particles in hepmc_reader.iterate(args.input, batch_size=args.batchSize):
+        n_batches += 1
+        n_particles += len(particles)
+        n_events += len(np.unique(particles['event']))
+    duration = time.time() - start
+
+    # ru_maxrss is in kB on Linux
+    peak_mem = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    mb = n_bytes / (1024. * 1024.)
+    print 'File: %s (%.1f MB on disk, %.1f MB uncompressed)' % (args.input,
+                                                                 size_on_disk / (1024. * 1024.),
+                                                                 mb)
+    print 'Read %d events, %d particles in %d batches in %.2f s' % (n_events, n_particles,
+                                                                   n_batches, duration)
+    print 'Throughput: %.1f MB/s, %.0f events/s, %.0f particles/s' % (mb / duration,
+                                                                      n_events / duration,
+                                                                      n_particles / duration)
+    print 'Peak memory: %.1f MB' % peak_mem
+
+
+def get_uncompressed_size(filename):
+    """Get the uncompressed size of a file in bytes, by streaming through it."""
+    if not filename.endswith('.gz'):
+        return os.path.getsize(filename)
+    n_bytes = 0
+    with gzip.open(filename, 'rb') as f:
+        while True:
+            block = f.read(1024 * 1024)
+            if not block:
+                break
+            n_bytes += len(block)
+    return n_bytes
+
+
+def generate_file(filename, n_events, n_particles):
+    """Write a HepMC2 file of random events, each with one vertex
+    with 2 incoming & n_particles - 2 outgoing particles."""
+    log.info('Generating %d events in %s' % (n_events, filename))
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'wb') as f:
+        f.write('\nHepMC::Version 2.06.09\n')
+        f.write('HepMC::IO_GenEvent-START_EVENT_LISTING\n')
+        barcode = 0
+        for i in xrange(n_events):
+            f.write('E %d 0 -1.0 -1.0 -1.0 0 -1 1 1 2 0 1 1\n' % i)
+            f.write('U GEV MM\n')
+            f.write('V -1 0 0 0 0 0 2 %d 0\n' % (n_particles - 2))
+            mom = np.random.normal(0, 50, (n_particles, 3))
+            for j in xrange(n_particles):
+                barcode = j + 1
+                px, py, pz = mom[j]
+                e = np.sqrt(px ** 2 + py ** 2 + pz ** 2)
+                f.write('P %d %d %.8e %.8e %.8e %.8e 0.0 %d 0 0 %d 0\n' %
+                        (barcode, 211, px, py, pz, e, 4 if j < 2 else 1, -1 if j < 2 else 0))
+        f.write('HepMC::IO_GenEvent-END_EVENT_LISTING\n')
+
+
+if __name__ == "__main__":
+    benchmark_hepmc_reader()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+"""
+Benchmark the NumPy functions in kinematics.py against the equivalent
+per-particle Python loops, for increasing numbers of particles.
+
+Each function is run on random four-vectors, and the results of the two
+methods are checked to agree.
+
+e.g.:
+./benchmark_kinematics.py --sizes 10000 100000 1000000 10000000
+
+Loops over 10^7 particles take a while, so use --maxLoopSize to skip them
+for large sizes.
+"""
+
+
+import sys
+import math
+import time
+import argparse
+import numpy as np
+import kinematics as kin
+
+
+def benchmark_kinematics(in_args=sys.argv[1:]):
+    """Main function"""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes',
+                        nargs='+',
+                        type=int,
+                        default=[10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7],
+                        help='Numbers of particles to test')
+    parser.add_argument('--maxLoopSize',
+                        type=int,
+                        default=10 ** 7,
+                        help='Only time the Python loops up to this number of particles')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=0,
+                        help='Random number seed')
+    args = parser.parse_args(args=in_args)
+
+    np.random.seed(args.seed)
+    print '%-16s %10s %12s %12s %10s' % ('Function', 'N', 'Loop [s]', 'NumPy [s]', 'Speedup')
+    for size in args.sizes:
+        p1 = make_four_vectors(size)
+        p2 = make_four_vectors(size)
+        # ~10 particles per event, for the same-sign selection
+        group = np.sort(np.random.randint(0, max(1, size // 10), size))
+        charge = np.random.choice([-1, 1], size)
+        for name, loop_func, np_func, loop_args in get_benchmarks(p1, p2, group, charge):
+            np_result, np_time = time_it(np_func)
+            if size > args.maxLoopSize:
+                print '%-16s %10d %12s %12.4f %10s' % (name, size, '-', np_time, '-')
+                continue
+            loop_result, loop_time = time_it(lambda: loop_func(*loop_args))
+            if not np.allclose(np.asarray(loop_result, dtype=float), np_result):
+                print 'WARNING: %s results differ' % name
+            speedup = loop_time / np_time if np_time > 0 else float('inf')
+            print '%-16s %10d %12.4f %12.4f %10.1f' % (name, size, loop_time, np_time, speedup)
+
+
+def make_four_vectors(size):
+    """Random massive four-vectors as (px, py, pz, e) arrays"""
+    px, py, pz = np.random.normal(0., 30., (3, size))
+    m = np.random.uniform(0., 10., size)
+    e = np.sqrt(px ** 2 + py ** 2 + pz ** 2 + m ** 2)
+    return px, py, pz, e
+
+
+def get_benchmarks(p1, p2, group, charge):
+    """List of (name, loop function, numpy function, loop function args)"""
+    px1, py1, pz1, e1 = p1
+    px2, py2, pz2, e2 = p2
+    # Loops work on lists, as they would when filled from a tree entry by entry
+    l1 = [x.tolist() for x in p1]
+    l2 = [x.tolist() for x in p2]
+    return [
+        ('pt', loop_pt, lambda: kin.pt(px1, py1), (l1,)),
+        ('eta', loop_eta, lambda: kin.eta(px1, py1, pz1), (l1,)),
+        ('phi', loop_phi, lambda: kin.phi(px1, py1), (l1,)),
+        ('delta_phi', loop_opening_phi, lambda: kin.opening_phi(px1, py1, px2, py2), (l1, l2)),
+        ('delta_r', loop_delta_r, lambda: kin.delta_r_p(px1, py1, pz1, px2, py2, pz2), (l1, l2)),
+        ('invariant_mass', loop_invariant_mass,
+         lambda: kin.invariant_mass(e1, px1, py1, pz1, e2, px2, py2, pz2), (l1, l2)),
+        ('pt_ratio', loop_pt_ratio, lambda: kin.pt_ratio(kin.pt(px1, py1), kin.pt(px2, py2)), (l1, l2)),
+        ('same_sign', loop_same_sign, lambda: kin.select_same_sign(group, charge),
+         (group.tolist(), charge.tolist())),
+    ]
+
+
+def time_it(func):
+    """Run func, return its result and the time taken"""
+    start = time.time()
+    result = func()
+    return result, time.time() - start
+
+
+def loop_pt(p):
+    return [math.hypot(px, py) for px, py in zip(p[0], p[1])]
+
+
+def scalar_eta(px, py, pz):
+    p_t = math.hypot(px, py)
+    if p_t == 0:
+        return math.copysign(kin.ETA_BEAM, pz)
+    return math.asinh(pz / p_t)
+
+
+def loop_eta(p):
+    return [scalar_eta(px, py, pz) for px, py, pz in zip(p[0], p[1], p[2])]
+
+
+def loop_phi(p):
+    return [math.atan2(py, px) for px, py in zip(p[0], p[1])]
+
+
+def loop_opening_phi(p1, p2):
+    result = []
+    for px1, py1, px2, py2 in zip(p1[0], p1[1], p2[0], p2[1]):
+        denom = math.sqrt(max(1E-20, (math.hypot(px1, py1) * math.hypot(px2, py2)) ** 2))
+        cos_phi = (px1 * px2 + py1 * py2) / denom
+        result.append(math.acos(max(-1., min(1., cos_phi))))
+    return result
+
+
+def loop_delta_r(p1, p2):
+    result = []
+    for px1, py1, pz1, px2, py2, pz2 in zip(p1[0], p1[1], p1[2], p2[0], p2[1], p2[2]):
+        d_eta = scalar_eta(px1, py1, pz1) - scalar_eta(px2, py2, pz2)
+        d_phi = abs(math.atan2(py1, px1) - math.atan2(py2, px2))
+        if d_phi > math.pi:
+            d_phi = 2. * math.pi - d_phi
+        result.append(math.sqrt(d_eta ** 2 + d_phi ** 2))
+    return result
+
+
+def loop_invariant_mass(p1, p2):
+    result = []
+    for px1, py1, pz1, e1, px2, py2, pz2, e2 in zip(p1[0], p1[1], p1[2], p1[3],
+                                                    p2[0], p2[1], p2[2], p2[3]):
+        m2 = (e1 + e2) ** 2 - (px1 + px2) ** 2 - (py1 + py2) ** 2 - (pz1 + pz2) ** 2
+        result.append(math.sqrt(max(m2, 0.)))
+    return result
+
+
+def loop_pt_ratio(p1, p2):
+    result = []
+    for px1, py1, px2, py2 in zip(p1[0], p1[1], p2[0], p2[1]):
+        den = math.hypot(px2, py2)
+        result.append(math.hypot(px1, py1) / den if den != 0 else float('nan'))
+    return result
+
+
+def loop_same_sign(group, charge):
+    """As generateMC.cc: +ve particles if a group has 2+, otherwise -ve ones"""
+    n_pos = {}
+    for g, c in zip(group, charge):
+        if c > 0:
+            n_pos[g] = n_pos.get(g, 0) + 1
+    return [(c > 0) if n_pos.get(g, 0) >= 2 else (c <= 0) for g, c in zip(group, charge)]
+
+
+if __name__ == "__main__":
+    benchmark_kinematics()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""
+Benchmark reading a tree with a per-entry PyROOT loop, against the chunked
+readers in tree_reader.py (via ROOT, and via the columnar cache).
+
+Each method computes the same thing, the sum of a branch for entries
+passing a selection, and the results are checked to agree.
+
+e.g. using a file from generateMC.exe:
+
+./benchmark_tree_reader.py ggh125_2a_4tau_ma1_8_13TeV_n1000_seed0.root
+
+or make a test file with 1M entries first:
+
+./benchmark_tree_reader.py --generate 1000000 test_tree.root
+"""
+
+
+import os
+import sys
+import time
+import argparse
+import logging
+import numpy as np
+import tree_reader
+import columnar_cache
+
+
+logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+log = logging.getLogger(__name__)
+
+
+def benchmark_tree_reader(in_args=sys.argv[1:]):
+    """Main function"""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input',
+                        help='ROOT file to read')
+    parser.add_argument('--tree',
+                        default='hVars',
+                        help='Tree to read')
+    parser.add_argument('--branch',
+                        default='hPt',
+                        help='Branch to sum')
+    parser.add_argument('--selection',
+                        default='abs(hEta) < 2.4',
+                        help='Selection to apply. Must be valid in both Python '
+                        'for a single entry and NumPy.')
+    parser.add_argument('--chunkSize',
+                        type=int,
+                        default=100000,
+                        help='Number of entries per chunk')
+    parser.add_argument('--generate',
+                        type=int,
+                        default=0,
+                        help='Make the input file with this many random entries '
+                        'in the tree first, with branches hPt & hEta')
+    args = parser.parse_args(args=in_args)
+
+    if args.generate:
+        generate_file(args.input, args.tree, args.generate)
+
+    results = []
+    results.append(('per-entry loop',) + time_it(sum_entry_loop, args.input, args.tree,
+                                                   args.branch, args.selection))
+    results.append(('tree_reader (ROOT)',) + time_it(sum_tree_reader, args.input, args.tree,
+                                                       args.branch, args.selection,
+                                                       args.chunkSize, False))
+    # Make the cache outside of the timing, as that only happens once
+    columnar_cache.convert_file(args.input, [args.tree])
+    results.append(('tree_reader (cache)',) + time_it(sum_tree_reader, args.input, args.tree,
+                                                        args.branch, args.selection,
+                                                        args.chunkSize, True))
+
+    ref_time = results[0][2]
+    print '%-22s %16s %10s %10s' % ('Method', 'Sum', 'Time [s]', 'Speedup')
+    for name, total, t in results:
+        print '%-22s %16.6g %10.3f %10.1f' % (name, total, t, ref_time / t if t > 0 else float('inf'))
+    ref_total = results[0][1]
+    for name, total, _ in results[1:]:
+        if not np.isclose(total, ref_total, rtol=1E-5):
+            log.warning('%s gives a different result: %g vs %g' % (name, total, ref_total))
+
+
+def time_it(func, *args):
+    """Run func, return its result and the time taken"""
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+def sum_entry_loop(filename, tree_name, branch, selection):
+    """The usual PyROOT way, looping over every entry"""
+    import ROOT
+    f = ROOT.TFile(filename)
+    tree = f.Get(tree_name)
+    code, sel_branches = tree_reader.compile_selection(selection)
+    namespace = dict(tree_reader.SELECTION_FUNCTIONS)
+    total = 0.
+    for entry in tree:
+        for b in sel_branches:
+            namespace[b] = getattr(entry, b)
+        if eval(code, {'__builtins__': {}}, namespace):
+            total += getattr(entry, branch)
+    f.Close()
+    return total
+
+
+def sum_tree_reader(filename, tree_name, branch, selection, chunk_size, use_cache):
+    """Using the chunked reader"""
+    total = 0.
+    for chunk in tree_reader.iterate(filename, tree_name, [branch], selection,
+                                     chunk_size=chunk_size, use_cache=use_cache):
+        total += chunk[branch].sum(dtype=np.float64)
+    return total
+
+
+def generate_file(filename, tree_name, n_entries):
+    """Make a file with a tree of random hPt, hEta values"""
+    import ROOT
+    from array import array
+    log.info('Generating %d entries in %s' % (n_entries, filename))
+    if os.path.dirname(filename) and not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    f = ROOT.TFile(filename, 'RECREATE')
+    tree = ROOT.TTree(tree_name, tree_name)
+    pt, eta = array('f', [0.]), array('f', [0.])
+    tree.Branch('hPt', pt, 'hPt/F')
+    tree.Branch('hEta', eta, 'hEta/F')
+    pts = np.random.exponential(30., n_entries)
+    etas = np.random.normal(0., 2.5, n_entries)
+    for i in xrange(n_entries):
+        pt[0], eta[0] = pts[i], etas[i]
+        tree.Fill()
+    tree.Write()
+    f.Close()
+
+
+if __name__ == "__main__":
+    benchmark_tree_reader()
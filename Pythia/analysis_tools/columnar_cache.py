@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+"""
+Columnar NumPy cache of the TTrees in ROOT files from generateMC.exe
+
+Reading the trees through PyROOT is slow, and needs ROOT installed. Instead,
+each tree is converted once into a directory of .npy files, one per branch,
+which can then be loaded (memory-mapped) with just NumPy:
+
+<stem>_columns/
+    manifest.json
+    hVars/hPt.npy
+    hVars/hEta.npy
+    ...
+
+The manifest records the size and modification time of the source ROOT file,
+so that the cache is remade if the source file changes.
+
+To convert files from the command line:
+
+./columnar_cache.py ggh125_2a_4tau_ma1_8_13TeV_n1000_seed0.root
+
+To use in a script (ROOT is only imported if the cache needs (re)making):
+
+import columnar_cache
+cols = columnar_cache.load_tree('ggh125_2a_4tau_ma1_8_13TeV_n1000_seed0.root', 'hVars')
+print cols['hPt'].mean()
+"""
+
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import logging
+import numpy as np
+
+
+logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+log = logging.getLogger(__name__)
+
+
+MANIFEST_NAME = 'manifest.json'
+
+# Map ROOT leaf types to NumPy types. Only branches with one of these
+# types (and one value per entry) are converted.
+LEAF_TYPES = {'Float_t': np.float32, 'Double_t': np.float64,
+              'Int_t': np.int32, 'UInt_t': np.uint32,
+              'Long64_t': np.int64, 'Bool_t': np.bool_}
+
+# Max number of expressions TTree::Draw can store for GetV1()...GetV4()
+DRAW_MAX_VARS = 4
+
+
+def columnar_cache(in_args=sys.argv[1:]):
+    """Main function to convert files from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input',
+                        nargs='+',
+                        help='ROOT file(s) to convert')
+    parser.add_argument('--trees',
+                        nargs='+',
+                        default=None,
+                        help='Trees to convert. Defaults to all trees in the file.')
+    parser.add_argument('--force',
+                        action='store_true',
+                        help='Remake the cache even if it is up to date')
+    parser.add_argument("-v",
+                        help="Display debug messages.",
+                        action='store_true')
+    args = parser.parse_args(args=in_args)
+
+    if args.v:
+        log.setLevel(logging.DEBUG)
+
+    for filename in args.input:
+        if not args.force and is_up_to_date(filename, args.trees):
+            log.info('Cache for %s is up to date' % filename)
+            continue
+        convert_file(filename, args.trees)
+
+
+def get_cache_dir(filename):
+    """Get the cache directory for a ROOT file (or a HepMC file, see
+    hepmc_to_trees.py)"""
+    stem = os.path.abspath(filename)
+    if stem.endswith('.gz'):
+        stem = stem[:-3]
+    return os.path.splitext(stem)[0] + '_columns'
+
+
+def get_source_stat(filename):
+    """Get the info used to tell if a source file has changed"""
+    stat = os.stat(filename)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def read_manifest(filename):
+    """Get the manifest for a ROOT file's cache. Returns None if there isn't one."""
+    manifest_name = os.path.join(get_cache_dir(filename), MANIFEST_NAME)
+    if not os.path.isfile(manifest_name):
+        return None
+    return read_manifest_file(manifest_name)
+
+
+def read_manifest_file(manifest_name):
+    """Read a manifest file"""
+    with open(manifest_name) as jfile:
+        return json.load(jfile)
+
+
+def is_up_to_date(filename, trees=None):
+    """Check if the cache for a ROOT file exists, was made from the current
+    version of the file, and has all the trees requested (if any)."""
+    manifest = read_manifest(filename)
+    if not manifest:
+        return False
+    source = get_source_stat(filename)
+    if manifest['source']['size'] != source['size'] or manifest['source']['mtime'] != source['mtime']:
+        return False
+    return all(t in manifest['trees'] for t in (trees or []))
+
+
+def convert_file(filename, trees=None):
+    """Convert trees in a ROOT file into columnar .npy files.
+
+    Any existing cache for the file is replaced.
+
+    filename: str
+        ROOT file to convert.
+    trees: list[str]
+        Names of trees to convert. If None, all trees in the file are converted.
+
+    Returns the manifest dict.
+    """
+    import ROOT
+    ROOT.PyConfig.IgnoreCommandLineOptions = True
+    ROOT.gROOT.SetBatch(1)
+
+    log.info('Converting %s' % filename)
+    source = get_source_stat(filename)
+    f = ROOT.TFile(filename)
+    if not f or f.IsZombie():
+        raise IOError('Cannot open file %s' % filename)
+
+    if trees is None:
+        trees = sorted(set(k.GetName() for k in f.GetListOfKeys()
+                           if k.GetClassName() == 'TTree'))
+
+    cache_dir = get_cache_dir(filename)
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.makedirs(cache_dir)
+
+    manifest = {'source': dict(filename=os.path.abspath(filename), **source),
+                'trees': {}}
+    for tree_name in trees:
+        tree = f.Get(tree_name)
+        if not tree:
+            raise RuntimeError('No tree %s in %s' % (tree_name, filename))
+        columns = read_tree_columns(tree)
+        tree_dir = os.path.join(cache_dir, tree_name)
+        os.makedirs(tree_dir)
+        for branch, arr in columns.iteritems():
+            np.save(os.path.join(tree_dir, branch + '.npy'), arr)
+        manifest['trees'][tree_name] = {'entries': int(tree.GetEntries()),
+                                        'branches': sorted(columns.keys())}
+        log.debug('%s: %d entries, branches: %s' % (tree_name, tree.GetEntries(), sorted(columns.keys())))
+    f.Close()
+
+    # Write the manifest last, so an incomplete cache is never used
+    write_manifest(cache_dir, manifest)
+    return manifest
+
+
+def write_manifest(cache_dir, manifest):
+    """Write the manifest for a cache directory"""
+    with open(os.path.join(cache_dir, MANIFEST_NAME), 'w') as jfile:
+        json.dump(manifest, jfile, indent=2, sort_keys=True)
+
+
+class ColumnWriter(object):
+    """Write trees to a cache directory incrementally, so that they never
+    need to be held in memory all at once.
+
+    Each branch is appended to a raw file, which is turned into a .npy file
+    when close() is called. The manifest is written last.
+
+    cache_dir: str
+        Output directory. Any existing contents are removed.
+    trees: dict
+        {tree name: list of branch names}
+    dtype: numpy dtype
+        Type to store all branches as.
+    """
+
+    # Number of entries to copy at once when making the .npy files
+    COPY_CHUNK = 1000000
+
+    def __init__(self, cache_dir, trees, dtype=np.float32):
+        self.cache_dir = cache_dir
+        self.dtype = np.dtype(dtype)
+        self.entries = {t: 0 for t in trees}
+        self.files = {}
+        if os.path.isdir(cache_dir):
+            shutil.rmtree(cache_dir)
+        for tree_name, branches in trees.iteritems():
+            os.makedirs(os.path.join(cache_dir, tree_name))
+            self.files[tree_name] = {b: open(self.raw_name(tree_name, b), 'wb') for b in branches}
+
+    def raw_name(self, tree_name, branch):
+        return os.path.join(self.cache_dir, tree_name, branch + '.raw')
+
+    def append(self, tree_name, columns):
+        """Add entries to a tree. columns is a dict of {branch: array or list},
+        with all the branches of the tree, each the same length."""
+        files = self.files[tree_name]
+        lengths = set(len(columns[b]) for b in files)
+        if len(lengths) != 1:
+            raise RuntimeError('Branches of %s have different lengths: %s' % (tree_name, lengths))
+        for branch, f in files.iteritems():
+            np.asarray(columns[branch], dtype=self.dtype).tofile(f)
+        self.entries[tree_name] += lengths.pop()
+
+    def close(self, source_filename):
+        """Make the .npy files, and write the manifest.
+
+        source_filename: str
+            File the trees were made from, for checking if the cache is up to date.
+        """
+        manifest = {'source': dict(filename=os.path.abspath(source_filename),
+                                   **get_source_stat(source_filename)),
+                    'trees': {}}
+        for tree_name, files in self.files.iteritems():
+            n_entries = self.entries[tree_name]
+            for branch, f in files.iteritems():
+                f.close()
+                raw_name = self.raw_name(tree_name, branch)
+                npy_name = os.path.join(self.cache_dir, tree_name, branch + '.npy')
+                if n_entries == 0:
+                    np.save(npy_name, np.zeros(0, dtype=self.dtype))
+                else:
+                    out = np.lib.format.open_memmap(npy_name, mode='w+', dtype=self.dtype,
+                                                    shape=(n_entries,))
+                    with open(raw_name, 'rb') as raw:
+                        for start in xrange(0, n_entries, self.COPY_CHUNK):
+                            chunk = np.fromfile(raw, dtype=self.dtype, count=self.COPY_CHUNK)
+                            out[start:start + len(chunk)] = chunk
+                    out.flush()
+                    del out
+                os.remove(raw_name)
+            manifest['trees'][tree_name] = {'entries': n_entries,
+                                            'branches': sorted(files.keys())}
+        self.files = {}
+        write_manifest(self.cache_dir, manifest)
+        return manifest
+
+
+def get_scalar_branches(tree):
+    """Get dict of {branch name: numpy dtype} for the branches in a tree
+    that hold one value per entry of a type in LEAF_TYPES."""
+    branches = {}
+    for branch in tree.GetListOfBranches():
+        leaves = branch.GetListOfLeaves()
+        if leaves.GetEntries() != 1:
+            continue
+        leaf = leaves.At(0)
+        if leaf.GetLenStatic() != 1 or leaf.GetLeafCount():
+            continue
+        dtype = LEAF_TYPES.get(leaf.GetTypeName())
+        if dtype is None:
+            log.debug('Skipping branch %s of type %s' % (branch.GetName(), leaf.GetTypeName()))
+            continue
+        branches[branch.GetName()] = dtype
+    return branches
+
+
+def read_tree_columns(tree, branches=None, first=0, n_entries=None):
+    """Read scalar branches of a tree into NumPy arrays.
+
+    Uses TTree::Draw to read up to DRAW_MAX_VARS branches at once, which is
+    much faster than looping over the entries in Python.
+
+    tree: ROOT.TTree
+        Tree to read.
+    branches: list[str]
+        Branches to read. If None, all scalar branches are read.
+    first: int
+        First entry to read.
+    n_entries: int
+        Number of entries to read. If None, read to the end of the tree.
+
+    Returns dict of {branch name: array}.
+    """
+    scalar_branches = get_scalar_branches(tree)
+    names = sorted(scalar_branches.keys()) if branches is None else list(branches)
+    missing = [b for b in names if b not in scalar_branches]
+    if missing:
+        raise KeyError('Branches %s not scalar branches of tree %s' % (missing, tree.GetName()))
+    total = int(tree.GetEntries())
+    first = min(first, total)
+    if n_entries is None or first + n_entries > total:
+        n_entries = total - first
+    columns = {}
+    if n_entries == 0:
+        return {name: np.zeros(0, dtype=scalar_branches[name]) for name in names}
+
+    # Ensure Draw stores all the entries, not just the default 1000000
+    if tree.GetEstimate() < n_entries + 1:
+        tree.SetEstimate(n_entries + 1)
+    for i in range(0, len(names), DRAW_MAX_VARS):
+        chunk = names[i:i + DRAW_MAX_VARS]
+        n_drawn = tree.Draw(':'.join(chunk), '', 'goff', n_entries, first)
+        if n_drawn != n_entries:
+            raise RuntimeError('Only read %d/%d entries of %s from tree %s' %
+                               (n_drawn, n_entries, chunk, tree.GetName()))
+        getters = [tree.GetV1, tree.GetV2, tree.GetV3, tree.GetV4]
+        for name, getter in zip(chunk, getters):
+            buf = getter()
+            buf.SetSize(n_entries)
+            columns[name] = np.frombuffer(buf, dtype=np.float64, count=n_entries).astype(scalar_branches[name])
+    return columns
+
+
+def load_tree(filename, tree_name, branches=None, convert=True, mmap=True):
+    """Get the branches of a tree as NumPy arrays, from the columnar cache.
+
+    ROOT is not imported unless the cache is missing or out of date.
+
+    filename: str
+        Source ROOT file.
+    tree_name: str
+        Name of tree.
+    branches: list[str]
+        Branches to load. If None, all cached branches are loaded.
+    convert: bool
+        If True, (re)make the cache if it is missing or out of date.
+        Otherwise raise a RuntimeError.
+    mmap: bool
+        If True, memory-map the arrays rather than reading them into memory.
+
+    Returns dict of {branch name: array}.
+    """
+    if not is_up_to_date(filename, [tree_name]):
+        if not convert:
+            raise RuntimeError('Cache for %s %s is missing or out of date' % (filename, tree_name))
+        if not filename.endswith('.root'):
+            raise RuntimeError('Cache for %s is missing or out of date, can only '
+                               'convert ROOT files (use hepmc_to_trees.py for HepMC)' % filename)
+        # Convert all trees the first time, or everything we had before plus
+        # this tree, to save repeating the conversion later
+        manifest = read_manifest(filename)
+        trees = sorted(set(manifest['trees']) | set([tree_name])) if manifest else None
+        convert_file(filename, trees)
+
+    return load_columns(get_cache_dir(filename), tree_name, branches, mmap)
+
+
+def load_columns(cache_dir, tree_name, branches=None, mmap=True):
+    """Get the branches of a tree from a cache directory, without checking
+    if it is up to date. See load_tree() for arguments.
+
+    Returns dict of {branch name: array}.
+    """
+    manifest_name = os.path.join(cache_dir, MANIFEST_NAME)
+    if not os.path.isfile(manifest_name):
+        raise RuntimeError('No manifest in %s' % cache_dir)
+    manifest = read_manifest_file(manifest_name)
+    if tree_name not in manifest['trees']:
+        raise RuntimeError('No tree %s in %s' % (tree_name, cache_dir))
+    available = manifest['trees'][tree_name]['branches']
+    if branches is None:
+        branches = available
+    missing = [b for b in branches if b not in available]
+    if missing:
+        raise KeyError('Branches %s not in cache for tree %s' % (missing, tree_name))
+
+    tree_dir = os.path.join(cache_dir, tree_name)
+    return {str(b): np.load(os.path.join(tree_dir, b + '.npy'), mmap_mode='r' if mmap else None)
+            for b in branches}
+
+
+if __name__ == "__main__":
+    columnar_cache()
@@ -0,0 +1,134 @@
+"""
+Streaming reader for HepMC2 (IO_GenEvent) ASCII files, e.g. from
+generateMC.exe --hepmc or MG5_aMC's events_PYTHIA8_0.hepmc.gz, that doesn't
+need ROOT or HepMC installed.
+
+Events are read in batches of batch_size events, and each batch is returned
+as a NumPy structured array with one row per particle (see PARTICLE_DTYPE).
+Only one batch is held in memory at a time, so memory use doesn't depend on
+the file size.
+
+e.g.:
+
+import hepmc_reader
+for particles in hepmc_reader.iterate('events.hepmc.gz', batch_size=1000):
+    higgs = particles[particles['id'] == 25]
+    pt = np.hypot(higgs['px'], higgs['py'])
+
+Gzipped files (.gz) are decompressed on the fly.
+
+Momenta & masses are always returned in GeV. A particle's prod_vtx is 0 if it
+has no production vertex (e.g. beam particles), and similarly for end_vtx.
+"""
+
+
+import gzip
+import numpy as np
+
+
+PARTICLE_DTYPE = np.dtype([('event', np.int64),
+                           ('barcode', np.int32),
+                           ('id', np.int32),
+                           ('status', np.int32),
+                           ('px', np.float64),
+                           ('py', np.float64),
+                           ('pz', np.float64),
+                           ('e', np.float64),
+                           ('m', np.float64),
+                           ('prod_vtx', np.int32),
+                           ('end_vtx', np.int32)])
+
+# Conversion factors to GeV for the momentum units in the U line
+MOMENTUM_UNITS = {'GEV': 1., 'MEV': 1E-3}
+
+
+def open_file(filename):
+    """Open file, using gzip if filename ends with .gz"""
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb')
+
+
+def iterate(filename, batch_size=1000, max_events=None):
+    """Iterate over batches of events in a HepMC2 file.
+
+    filename: str
+        HepMC file, optionally gzipped.
+    batch_size: int
+        Number of events per batch.
+    max_events: int
+        Stop after this many events. If None, read the whole file.
+
+    Yields a structured array of particles (PARTICLE_DTYPE) for each batch.
+    """
+    if batch_size < 1:
+        raise RuntimeError('batch_size must be > 0')
+    with open_file(filename) as f:
+        for batch in iterate_lines(f, batch_size, max_events):
+            yield batch
+
+
+def iterate_lines(lines, batch_size=1000, max_events=None):
+    """Iterate over batches of events from an iterable of lines of a
+    HepMC2 file. See iterate()."""
+    rows = []
+    n_events = 0
+    event_num = -1
+    vertex = 0
+    n_orphans = 0
+    unit_factor = 1.
+    started = False  # ignore anything before the first event
+
+    for line in lines:
+        if not line:
+            continue
+        tag = line[0]
+        if tag == 'P':
+            if not started:
+                continue
+            # P barcode id px py pz e m status theta phi end_vtx n_flow ...
+            parts = line.split()
+            if n_orphans > 0:
+                # incoming particles with no production vertex come first
+                prod_vtx = 0
+                n_orphans -= 1
+            else:
+                prod_vtx = vertex
+            rows.append((event_num, int(parts[1]), int(parts[2]), int(parts[8]),
+                         float(parts[3]) * unit_factor, float(parts[4]) * unit_factor,
+                         float(parts[5]) * unit_factor, float(parts[6]) * unit_factor,
+                         float(parts[7]) * unit_factor,
+                         prod_vtx, int(parts[11])))
+        elif tag == 'V':
+            # V barcode id x y z ctau n_orphan n_out ...
+            parts = line.split(None, 8)
+            vertex = int(parts[1])
+            n_orphans = int(parts[7])
+        elif tag == 'E':
+            if started and max_events is not None and n_events >= max_events:
+                break
+            if n_events and n_events % batch_size == 0:
+                yield np.array(rows, dtype=PARTICLE_DTYPE)
+                rows = []
+            started = True
+            event_num = int(line.split(None, 2)[1])
+            n_events += 1
+            vertex, n_orphans = 0, 0
+            # Units are per event, but if the line is missing assume GeV
+            unit_factor = 1.
+        elif tag == 'U':
+            unit = line.split()[1].upper()
+            if unit not in MOMENTUM_UNITS:
+                raise RuntimeError('Unknown momentum unit %s' % unit)
+            unit_factor = MOMENTUM_UNITS[unit]
+
+    if rows:
+        yield np.array(rows, dtype=PARTICLE_DTYPE)
+
+
+def split_events(particles):
+    """Split a batch of particles into one array per event."""
+    if len(particles) == 0:
+        return []
+    boundaries = np.flatnonzero(np.diff(particles['event'])) + 1
+    return np.split(particles, boundaries)
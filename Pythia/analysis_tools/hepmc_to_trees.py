@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+"""
+Make the same trees as generateMC.exe --root (hVars, a1Vars, a1DecayVars,
+a1DecayMuVars, tauDecayVars, tauDecayChargedVars) from existing HepMC files,
+so that events don't need to be regenerated to get them.
+
+The analysis in generateMC.cc is repeated on the HepMC record: find the h
+(id 25, with status 62 - the -62 from Pythia is stored as 62 in HepMC),
+its children (a1) and their descendants, and compute the same variables.
+
+Each input file is processed by a separate process, and is read in batches of
+events, with the trees written out incrementally in the columnar format of
+columnar_cache.py: <stem>_columns/<tree>/<branch>.npy, next to each input
+file (or in --oDir). Load them with columnar_cache.load_tree(hepmc_filename, tree)
+or columnar_cache.load_columns(cache_dir, tree).
+
+Files whose output is already up to date are skipped.
+
+e.g.:
+./hepmc_to_trees.py /hdfs/user/<username>/NMSSMPheno/Pythia8/13TeV/ggh125_2a_4tau/18_Nov_15/hepmc/*.hepmc.gz
+"""
+
+
+import os
+import sys
+import time
+import argparse
+import logging
+from collections import OrderedDict
+from multiprocessing import Pool, cpu_count
+import numpy as np
+import hepmc_reader
+import columnar_cache
+import kinematics as kin
+
+
+logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+log = logging.getLogger(__name__)
+
+
+# Trees & branches, as in generateMC.cc
+TREES = OrderedDict([
+    ('hVars', ['hPt', 'hEta', 'hPhi', 'a1DPhi', 'a1Dr']),
+    ('a1Vars', ['a1Pt', 'a1Eta', 'a1Phi', 'a1DecayDPhi', 'a1DecayDr']),
+    ('a1DecayVars', ['a1DecayPt', 'a1DecayEta', 'a1DecayPhi']),
+    ('a1DecayMuVars', ['a1DecayMuPt', 'a1DecayMuEta', 'a1DecayMuPhi']),
+    ('tauDecayVars', ['tauDecayPtRatio', 'tauDecayDr']),
+    ('tauDecayChargedVars', ['tauDecayChargedPtRatio', 'tauDecayChargedDr']),
+])
+
+H_ID = 25
+H_STATUS = 62
+FINAL_STATUS = 1
+
+# Value for variables that can't be calculated, as in generateMC.cc
+DEFAULT_VALUE = 99.
+
+# Lists of particle indices found by find_objects(), for each batch.
+# Pairs are stored as separate lists for the first & second particle.
+OBJECTS = ['h', 'h_child1', 'h_child2',
+           'a1', 'a1_child1', 'a1_child2',
+           'a1_decay',
+           'tau_product', 'tau_parent',
+           'mu']
+
+
+def hepmc_to_trees(in_args=sys.argv[1:]):
+    """Main function"""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input',
+                        nargs='+',
+                        help='HepMC file(s) to process')
+    parser.add_argument('--oDir',
+                        help='Directory to put the output in. If not specified, '
+                        'outputs are put next to each input file.')
+    parser.add_argument('--batchSize',
+                        type=int,
+                        default=1000,
+                        help='Number of events to read at once')
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=cpu_count(),
+                        help='Number of files to process in parallel. '
+                        'Defaults to the number of cores.')
+    parser.add_argument('--force',
+                        action='store_true',
+                        help='Remake outputs even if they are up to date')
+    parser.add_argument("-v",
+                        help="Display debug messages.",
+                        action='store_true')
+    args = parser.parse_args(args=in_args)
+
+    if args.v:
+        log.setLevel(logging.DEBUG)
+
+    if args.jobs < 1:
+        raise RuntimeError('--jobs must be >= 1')
+
+    tasks = []
+    for filename in args.input:
+        out_dir = get_output_dir(filename, args.oDir)
+        if not args.force and is_up_to_date(filename, out_dir):
+            log.info('%s is up to date, skipping' % out_dir)
+            continue
+        tasks.append((filename, out_dir, args.batchSize))
+
+    if not tasks:
+        log.info('Nothing to do')
+        return []
+
+    log.info('Processing %d files' % len(tasks))
+    pool = Pool(min(args.jobs, len(tasks)))
+    results = pool.map(process_file, tasks, chunksize=1)
+    pool.close()
+    pool.join()
+
+    for result in results:
+        log.info('%s: %d events, %d with an h, %.1f s' % (result['output'], result['events'],
+                                                         result['entries']['hVars'],
+                                                         result['time']))
+    return results
+
+
+def get_output_dir(filename, o_dir=None):
+    """Get output directory for an input file"""
+    cache_dir = columnar_cache.get_cache_dir(filename)
+    if o_dir:
+        return os.path.join(o_dir, os.path.basename(cache_dir))
+    return cache_dir
+
+
+def is_up_to_date(filename, out_dir):
+    """Check if out_dir has all the trees, made from the current version of filename"""
+    manifest_name = os.path.join(out_dir, columnar_cache.MANIFEST_NAME)
+    if not os.path.isfile(manifest_name):
+        return False
+    manifest = columnar_cache.read_manifest_file(manifest_name)
+    source = columnar_cache.get_source_stat(filename)
+    return (manifest['source']['size'] == source['size'] and
+            manifest['source']['mtime'] == source['mtime'] and
+            all(t in manifest['trees'] for t in TREES))
+
+
+def process_file(task):
+    """Make trees from a HepMC file.
+    A tuple so it can be used with Pool.map().
+
+    task: tuple(str, str, int)
+        Input filename, output directory, and number of events per batch.
+
+    Returns a dict of info about the file.
+    """
+    filename, out_dir, batch_size = task
+    start = time.time()
+    writer = columnar_cache.ColumnWriter(out_dir, TREES)
+    n_events = 0
+    for particles in hepmc_reader.iterate(filename, batch_size=batch_size):
+        objects = {name: [] for name in OBJECTS}
+        offset = 0
+        for event in hepmc_reader.split_events(particles):
+            find_objects(event, offset, objects)
+            offset += len(event)
+            n_events += 1
+        objects = {name: np.array(inds, dtype=np.int64) for name, inds in objects.iteritems()}
+        for tree, columns in make_columns(particles, objects).iteritems():
+            writer.append(tree, columns)
+    manifest = writer.close(filename)
+    return {'input': filename,
+            'output': out_dir,
+            'events': n_events,
+            'entries': {t: info['entries'] for t, info in manifest['trees'].iteritems()},
+            'time': time.time() - start}
+
+
+def find_objects(event, offset, objects):
+    """Find the particles used in the generateMC.cc analysis in one event.
+
+    The decay chain has to be followed event by event, but the variables are
+    then calculated for a whole batch at once in make_columns().
+
+    event: numpy structured array
+        Particles in the event, from hepmc_reader
+    offset: int
+        Index of the first particle of the event in its batch.
+    objects: dict
+        {object name: list}, to append the indices (in the batch) of
+        particles to. See OBJECTS. Missing particles have index -1.
+    """
+    status = event['status']
+    pdgid = event['id']
+    end_vtx = event['end_vtx']
+
+    # children of each vertex
+    vertex_children = {}
+    for ind, vtx in enumerate(event['prod_vtx']):
+        if vtx != 0:
+            vertex_children.setdefault(vtx, []).append(ind)
+
+    def get_children(ind):
+        vtx = end_vtx[ind]
+        return vertex_children.get(vtx, []) if vtx != 0 else []
+
+    def get_all_descendants(ind, final_state_only):
+        """As getAllDescendants() in generateMC.cc"""
+        descendants = []
+        intermediates = [ind]
+        while intermediates:
+            new_intermediates = []
+            for p in intermediates:
+                if status[p] == FINAL_STATUS:
+                    continue
+                kids = get_children(p)
+                for kid in kids:
+                    if not final_state_only or status[kid] == FINAL_STATUS:
+                        descendants.append(kid)
+                new_intermediates.extend(kids)
+            intermediates = new_intermediates
+        return descendants
+
+    def add(name, ind):
+        objects[name].append(ind + offset if ind >= 0 else -1)
+
+    h_inds = np.flatnonzero((np.abs(pdgid) == H_ID) & (np.abs(status) == H_STATUS))
+    if len(h_inds) == 0:
+        return
+    h1 = h_inds[0]
+
+    h_children = get_children(h1)
+    if len(h_children) < 2:
+        log.warning('h has %d children in event %d' % (len(h_children), event['event'][h1]))
+    add('h', h1)
+    add('h_child1', h_children[0] if len(h_children) >= 2 else -1)
+    add('h_child2', h_children[1] if len(h_children) >= 2 else -1)
+
+    for a1 in h_children:
+        a1_decays = get_children(a1)
+        if len(a1_decays) < 2:
+            log.warning('a1 has %d children in event %d' % (len(a1_decays), event['event'][a1]))
+        add('a1', a1)
+        add('a1_child1', a1_decays[0] if len(a1_decays) >= 2 else -1)
+        add('a1_child2', a1_decays[1] if len(a1_decays) >= 2 else -1)
+        for d in a1_decays:
+            add('a1_decay', d)
+
+        # tau decay products, for taus that decay properly (not gamma radiation)
+        for tau in get_all_descendants(a1, False):
+            if abs(pdgid[tau]) != 15 or len(get_children(tau)) <= 2:
+                continue
+            for p in get_all_descendants(tau, True):
+                add('tau_product', p)
+                add('tau_parent', tau)
+
+    # muons in the h1 decay, the same-sign selection is done in make_columns()
+    for p in get_all_descendants(h1, True):
+        if abs(pdgid[p]) == 13:
+            add('mu', p)
+
+
+def make_columns(particles, objects):
+    """Calculate the variables for each tree for a batch of events.
+
+    particles: numpy structured array
+        Particles in the batch, from hepmc_reader
+    objects: dict
+        {object name: array of indices}, from find_objects()
+
+    Returns {tree name: {branch name: array}}
+    """
+    px, py, pz = particles['px'], particles['py'], particles['pz']
+    all_pt = kin.pt(px, py)
+    all_eta = kin.eta(px, py, pz)
+    all_phi = kin.phi(px, py)
+
+    def pair_vars(ind1, ind2):
+        """Delta R and opening phi for pairs, DEFAULT_VALUE if either is missing"""
+        ok = (ind1 >= 0) & (ind2 >= 0)
+        i1, i2 = np.where(ok, ind1, 0), np.where(ok, ind2, 0)
+        d_r = kin.delta_r(all_eta[i1], all_phi[i1], all_eta[i2], all_phi[i2])
+        d_phi = kin.opening_phi(px[i1], py[i1], px[i2], py[i2])
+        return np.where(ok, d_r, DEFAULT_VALUE), np.where(ok, d_phi, DEFAULT_VALUE)
+
+    columns = {}
+    h = objects['h']
+    a1_dr, a1_dphi = pair_vars(objects['h_child1'], objects['h_child2'])
+    columns['hVars'] = {'hPt': all_pt[h], 'hEta': all_eta[h], 'hPhi': all_phi[h],
+                        'a1DPhi': a1_dphi, 'a1Dr': a1_dr}
+
+    a1 = objects['a1']
+    decay_dr, decay_dphi = pair_vars(objects['a1_child1'], objects['a1_child2'])
+    columns['a1Vars'] = {'a1Pt': all_pt[a1], 'a1Eta': all_eta[a1], 'a1Phi': all_phi[a1],
+                         'a1DecayDPhi': decay_dphi, 'a1DecayDr': decay_dr}
+
+    d = objects['a1_decay']
+    columns['a1DecayVars'] = {'a1DecayPt': all_pt[d], 'a1DecayEta': all_eta[d],
+                              'a1DecayPhi': all_phi[d]}
+
+    prod, tau = objects['tau_product'], objects['tau_parent']
+    ratio = kin.pt_ratio(all_pt[prod], all_pt[tau])
+    tau_dr = kin.delta_r(all_eta[prod], all_phi[prod], all_eta[tau], all_phi[tau])
+    columns['tauDecayVars'] = {'tauDecayPtRatio': ratio, 'tauDecayDr': tau_dr}
+    charged = kin.charge3(particles['id'][prod]) != 0
+    columns['tauDecayChargedVars'] = {'tauDecayChargedPtRatio': ratio[charged],
+                                      'tauDecayChargedDr': tau_dr[charged]}
+
+    # 2 SS muons, as in generateMC.cc
+    mu = objects['mu']
+    mu = mu[kin.select_same_sign(particles['event'][mu], kin.charge3(particles['id'][mu]))]
+    columns['a1DecayMuVars'] = {'a1DecayMuPt': all_pt[mu], 'a1DecayMuEta': all_eta[mu],
+                                'a1DecayMuPhi': all_phi[mu]}
+    return columns
+
+
+if __name__ == "__main__":
+    hepmc_to_trees()
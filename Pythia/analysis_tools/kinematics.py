@@ -0,0 +1,178 @@
+"""
+NumPy kinematics functions that work on whole arrays of particles at once,
+rather than one particle at a time.
+
+All functions take arrays of components (px, py, pz, e), so they can be used
+with the columns of a structured array from hepmc_reader, e.g.:
+
+import kinematics as kin
+p = particles  # from hepmc_reader
+pt = kin.pt(p['px'], p['py'])
+eta = kin.eta(p['px'], p['py'], p['pz'])
+
+Conventions follow Pythia8 where it matters for comparing with generateMC:
+delta_r() is REtaPhi(), and opening_phi() is phi(Vec4, Vec4).
+
+See benchmark_kinematics.py for a comparison with per-particle loops.
+"""
+
+
+import numpy as np
+
+
+# Value of eta for particles with no transverse momentum
+ETA_BEAM = 20.
+
+# 3 * charge of quarks, indexed by quark id
+QUARK_CHARGE3 = np.array([0, -1, 2, -1, 2, -1, 2, 0, 0, 0])
+# 3 * charge of non-quark particles, for +ve id
+OTHER_CHARGE3 = {11: -3, 12: 0, 13: -3, 14: 0, 15: -3, 16: 0,
+                 21: 0, 22: 0, 23: 0, 24: 3, 25: 0, 36: 0,
+                 130: 0, 310: 0}
+
+
+def pt(px, py):
+    """Transverse momentum"""
+    return np.hypot(px, py)
+
+
+def eta(px, py, pz):
+    """Pseudorapidity. +-ETA_BEAM for particles along the beam axis."""
+    p_t = pt(px, py)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = np.arcsinh(np.asarray(pz, dtype=float) / p_t)
+    return np.where(p_t > 0, result, np.copysign(ETA_BEAM, pz))
+
+
+def phi(px, py):
+    """Azimuthal angle, in [-pi, pi]"""
+    return np.arctan2(py, px)
+
+
+def delta_phi(phi1, phi2):
+    """Signed difference phi1 - phi2, wrapped into [-pi, pi)"""
+    return (np.asarray(phi1) - phi2 + np.pi) % (2. * np.pi) - np.pi
+
+
+def opening_phi(px1, py1, px2, py2):
+    """Angle between two momenta in the transverse plane, in [0, pi].
+    As phi(Vec4, Vec4) in Pythia8."""
+    denom = np.sqrt(np.maximum(1E-20, (pt(px1, py1) * pt(px2, py2)) ** 2))
+    cos_phi = (np.asarray(px1) * px2 + np.asarray(py1) * py2) / denom
+    return np.arccos(np.clip(cos_phi, -1., 1.))
+
+
+def delta_r(eta1, phi1, eta2, phi2):
+    """Delta R = sqrt(delta eta^2 + delta phi^2)"""
+    return np.hypot(np.asarray(eta1) - eta2, delta_phi(phi1, phi2))
+
+
+def delta_r_p(px1, py1, pz1, px2, py2, pz2):
+    """Delta R between two momenta. As REtaPhi() in Pythia8."""
+    return delta_r(eta(px1, py1, pz1), phi(px1, py1), eta(px2, py2, pz2), phi(px2, py2))
+
+
+def mass(e, px, py, pz):
+    """Invariant mass of four-vectors. Negative m^2 (from rounding) gives 0."""
+    m2 = np.asarray(e) ** 2 - (np.asarray(px) ** 2 + np.asarray(py) ** 2 + np.asarray(pz) ** 2)
+    return np.sqrt(np.maximum(m2, 0.))
+
+
+def invariant_mass(e1, px1, py1, pz1, e2, px2, py2, pz2):
+    """Invariant mass of the sum of two four-vectors"""
+    return mass(np.asarray(e1) + e2, np.asarray(px1) + px2,
+                np.asarray(py1) + py2, np.asarray(pz1) + pz2)
+
+
+def pt_ratio(pt_num, pt_den):
+    """pt_num / pt_den, with nan where pt_den is 0"""
+    pt_den = np.asarray(pt_den, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(pt_den != 0, np.asarray(pt_num) / pt_den, np.nan)
+
+
+def charge3(pdgid):
+    """3 * electric charge of particles from their PDG ids.
+
+    Uses the quark content for hadrons, following the PDG numbering scheme.
+    Unknown particles (e.g. nuclei, BSM) get 0.
+    """
+    pdgid = np.asarray(pdgid, dtype=np.int64)
+    abs_id = np.abs(pdgid)
+    sign = np.where(pdgid > 0, 1, -1)
+    q1 = (abs_id // 1000) % 10
+    q2 = (abs_id // 100) % 10
+    q3 = (abs_id // 10) % 10
+
+    # meson: q2 q3bar if q2 is up-type, q3 q2bar otherwise
+    meson = np.where(q2 % 2 == 0,
+                     QUARK_CHARGE3[q2] - QUARK_CHARGE3[q3],
+                     QUARK_CHARGE3[q3] - QUARK_CHARGE3[q2])
+    baryon = QUARK_CHARGE3[q1] + QUARK_CHARGE3[q2] + QUARK_CHARGE3[q3]
+    result = np.where(q1 == 0, meson, baryon)
+    result = np.where((q2 == 0) | (q3 == 0) | (abs_id >= 1000000000), 0, result)
+
+    quark = (abs_id >= 1) & (abs_id <= 6)
+    result = np.where(quark, QUARK_CHARGE3[np.where(quark, abs_id, 0)], result)
+    for other_id, other_charge in OTHER_CHARGE3.iteritems():
+        result = np.where(abs_id == other_id, other_charge, result)
+    return sign * result
+
+
+def select_same_sign(group, charge):
+    """Select same-sign particles in each group (e.g. event), as in generateMC:
+    the +ve particles if a group has at least 2, otherwise the -ve particles.
+
+    group: array of int
+        Group (e.g. event number) of each particle.
+    charge: array
+        Charge of each particle (only the sign matters).
+
+    Returns a boolean mask of the selected particles.
+    """
+    group = np.asarray(group)
+    charge = np.asarray(charge)
+    if len(group) == 0:
+        return np.zeros(0, dtype=bool)
+    _, inverse = np.unique(group, return_inverse=True)
+    n_pos = np.bincount(inverse, weights=(charge > 0))
+    use_pos = n_pos[inverse] >= 2
+    return np.where(use_pos, charge > 0, charge <= 0)
+
+
+def same_sign_pairs(group, charge):
+    """Find all pairs of particles with the same sign of charge in the
+    same group (e.g. event). Neutral particles are ignored.
+
+    group: array of int
+        Group (e.g. event number) of each particle.
+    charge: array
+        Charge of each particle (only the sign matters).
+
+    Returns two arrays of indices (i, j), with i < j, one entry per pair.
+    """
+    group = np.asarray(group)
+    sign = np.sign(charge).astype(np.int64)
+    charged = np.flatnonzero(sign != 0)
+    if len(charged) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    # Sort into runs of (group, sign), keeping the original order within each
+    order = charged[np.lexsort((charged, sign[charged], group[charged]))]
+    keys = np.column_stack((group[order], sign[order]))
+    new_run = np.concatenate(([True], np.any(keys[1:] != keys[:-1], axis=1)))
+    starts = np.flatnonzero(new_run)
+    lengths = np.diff(np.append(starts, len(order)))
+
+    # Handle all runs of the same length together
+    first, second = [], []
+    for length in np.unique(lengths):
+        if length < 2:
+            continue
+        run_starts = starts[lengths == length]
+        a, b = np.triu_indices(length, 1)
+        first.append(order[(run_starts[:, None] + a).ravel()])
+        second.append(order[(run_starts[:, None] + b).ravel()])
+    if not first:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(first), np.concatenate(second)
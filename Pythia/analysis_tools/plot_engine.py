@@ -0,0 +1,148 @@
+"""
+Make-like rebuilding of plots: only remake a plot if its inputs or its
+specification have changed since it was last made.
+
+Each plot is given a fingerprint, made from the size & modification time of
+its input files, and anything else that affects it (tree, variable, binning,
+style, the code that draws it...). The fingerprints of the plots made are
+stored in a JSON file, and on the next run a plot is only remade if its
+output is missing or its fingerprint has changed.
+
+e.g.:
+
+import plot_engine
+engine = plot_engine.PlotEngine(dry_run=args.dry)
+fp = plot_engine.make_fingerprint([filename], var='hPt', nbins=50,
+                                  code=plot_engine.code_fingerprint(make_plot))
+engine.build(['hPt.pdf'], fp, make_plot, filename, 'hPt')
+engine.save()
+"""
+
+
+import os
+import json
+import inspect
+import hashlib
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_STATE_FILE = '.plot_fingerprints.json'
+
+
+def make_fingerprint(input_files, **spec):
+    """Make a fingerprint from input files and a plot specification.
+
+    input_files: list[str]
+        Files the plot is made from. Their size and modification time are
+        used, so a regenerated file changes the fingerprint. Missing files
+        are allowed, and count as changed when they appear.
+    spec: keyword args
+        Anything else that determines the plot. Must be JSON serialisable.
+
+    Returns a hex string.
+    """
+    inputs = []
+    for filename in input_files:
+        if os.path.exists(filename):
+            stat = os.stat(filename)
+            inputs.append([os.path.abspath(filename), stat.st_size, stat.st_mtime])
+        else:
+            inputs.append([os.path.abspath(filename), None, None])
+    contents = json.dumps({'inputs': inputs, 'spec': spec}, sort_keys=True, default=repr)
+    return hashlib.sha1(contents).hexdigest()
+
+
+def code_fingerprint(*funcs):
+    """Fingerprint of the source code of some functions, so that plots are
+    remade when the code that draws them changes."""
+    sha = hashlib.sha1()
+    for func in funcs:
+        try:
+            sha.update(inspect.getsource(func))
+        except (IOError, TypeError):
+            sha.update(func.__name__)
+    return sha.hexdigest()
+
+
+class PlotEngine(object):
+    """Decide which plots need remaking, and keep track of fingerprints.
+
+    state_file: str
+        JSON file to store fingerprints in, keyed by output filename.
+    dry_run: bool
+        If True, only report what would be remade.
+    force: bool
+        If True, remake everything.
+    """
+
+    def __init__(self, state_file=DEFAULT_STATE_FILE, dry_run=False, force=False):
+        self.state_file = state_file
+        self.dry_run = dry_run
+        self.force = force
+        self.fingerprints = {}
+        self.n_built = 0
+        self.n_skipped = 0
+        if os.path.isfile(state_file):
+            with open(state_file) as jfile:
+                self.fingerprints = json.load(jfile)
+
+    def needs_rebuild(self, outputs, fingerprint):
+        """Check if any of the outputs is missing, or was made with a
+        different fingerprint."""
+        if self.force:
+            return True
+        for output in outputs:
+            key = os.path.abspath(output)
+            if not os.path.isfile(output) or self.fingerprints.get(key) != fingerprint:
+                return True
+        return False
+
+    def record(self, outputs, fingerprint):
+        """Store the fingerprint for outputs that have been made"""
+        for output in outputs:
+            if os.path.isfile(output):
+                self.fingerprints[os.path.abspath(output)] = fingerprint
+            else:
+                log.warning('Expected output %s was not made' % output)
+
+    def check(self, outputs, fingerprint):
+        """Like needs_rebuild(), but also counts the plots for summary(),
+        and lists them for a dry run. Use this if making the plots yourself,
+        e.g. in parallel, then call record() afterwards."""
+        if not self.needs_rebuild(outputs, fingerprint):
+            log.debug('Up to date: %s' % ', '.join(outputs))
+            self.n_skipped += 1
+            return False
+        self.n_built += 1
+        if self.dry_run:
+            log.info('Would remake: %s' % ', '.join(outputs))
+        return True
+
+    def build(self, outputs, fingerprint, func, *args, **kwargs):
+        """Call func(*args, **kwargs) to make outputs, if they need remaking.
+
+        Returns True if func was called (or would have been, for a dry run).
+        """
+        if not self.check(outputs, fingerprint):
+            return False
+        if self.dry_run:
+            return True
+        log.debug('Remaking: %s' % ', '.join(outputs))
+        func(*args, **kwargs)
+        self.record(outputs, fingerprint)
+        return True
+
+    def save(self):
+        """Write the fingerprints to the state file. Does nothing for a dry run."""
+        if self.dry_run:
+            return
+        with open(self.state_file, 'w') as jfile:
+            json.dump(self.fingerprints, jfile, indent=2, sort_keys=True)
+
+    def summary(self):
+        """Short description of what was (or would be) done"""
+        verb = 'would be remade' if self.dry_run else 'remade'
+        return '%d plots %s, %d up to date' % (self.n_built, verb, self.n_skipped)
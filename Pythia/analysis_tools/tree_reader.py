@@ -0,0 +1,162 @@
+"""
+Read TTree branches in bulk into NumPy arrays, rather than looping over
+entries in Python.
+
+Instead of:
+
+for entry in tree:
+    if abs(entry.hEta) < 2.4:
+        do_something(entry.hPt)
+
+do:
+
+import tree_reader
+for chunk in tree_reader.iterate('file.root', 'hVars', ['hPt'], selection='abs(hEta) < 2.4'):
+    do_something(chunk['hPt'])  # chunk['hPt'] is an array
+
+or, to get everything at once:
+
+cols = tree_reader.read('file.root', 'hVars', ['hPt'], selection='abs(hEta) < 2.4')
+
+Branches are read chunk_size entries at a time, so memory use is bounded.
+
+Selections are Python expressions evaluated on whole arrays, so use
+&, |, ~ (with brackets) instead of and, or, not:
+
+'(abs(hEta) < 2.4) & (hPt > 20)'
+
+Only branch names and the functions in SELECTION_FUNCTIONS can be used.
+
+By default the trees are read with ROOT. With use_cache=True, they are
+instead read from the columnar cache made by columnar_cache.py, which doesn't
+need ROOT once the cache exists.
+"""
+
+
+import numpy as np
+import columnar_cache
+
+
+# Names that can be used in selection expressions, along with branch names
+SELECTION_FUNCTIONS = {
+    'abs': np.abs,
+    'sqrt': np.sqrt,
+    'exp': np.exp,
+    'log': np.log,
+    'sin': np.sin,
+    'cos': np.cos,
+    'tan': np.tan,
+    'arctan2': np.arctan2,
+    'cosh': np.cosh,
+    'sinh': np.sinh,
+    'minimum': np.minimum,
+    'maximum': np.maximum,
+    'where': np.where,
+    'pi': np.pi,
+}
+
+
+def compile_selection(selection):
+    """Compile a selection expression.
+
+    Returns the code object, and the list of names it uses that aren't in
+    SELECTION_FUNCTIONS, i.e. the branches it needs.
+    """
+    code = compile(selection, '<selection>', 'eval')
+    if any(n.startswith('_') for n in code.co_names):
+        raise RuntimeError('Names starting with _ not allowed in selection: %s' % selection)
+    branches = [n for n in code.co_names if n not in SELECTION_FUNCTIONS]
+    return code, branches
+
+
+def evaluate_selection(code, columns):
+    """Evaluate a compiled selection on a dict of arrays.
+
+    Returns a boolean array, one entry per row.
+    """
+    namespace = dict(SELECTION_FUNCTIONS)
+    namespace.update(columns)
+    n_rows = len(columns.itervalues().next()) if columns else 0
+    mask = eval(code, {'__builtins__': {}}, namespace)
+    mask = np.asarray(mask, dtype=bool)
+    if mask.shape == ():
+        # e.g. a selection that doesn't depend on any branch
+        mask = np.repeat(mask, n_rows)
+    return mask
+
+
+def iterate(filename, tree_name, branches, selection=None, chunk_size=100000, use_cache=False):
+    """Iterate over a tree in chunks of entries.
+
+    filename: str
+        ROOT file.
+    tree_name: str
+        Name of tree.
+    branches: list[str]
+        Branches to read.
+    selection: str
+        Selection expression. Only entries that pass are returned.
+    chunk_size: int
+        Number of entries to read at once.
+    use_cache: bool
+        If True, read from the columnar cache instead of using ROOT.
+
+    Yields a dict of {branch name: array} for each chunk.
+    """
+    if chunk_size < 1:
+        raise RuntimeError('chunk_size must be > 0')
+    code, sel_branches = compile_selection(selection) if selection else (None, [])
+    to_read = list(branches) + [b for b in sel_branches if b not in branches]
+
+    if use_cache:
+        chunks = iterate_cache(filename, tree_name, to_read, chunk_size)
+    else:
+        chunks = iterate_root(filename, tree_name, to_read, chunk_size)
+
+    for columns in chunks:
+        if code is not None:
+            mask = evaluate_selection(code, columns)
+            yield {b: columns[b][mask] for b in branches}
+        else:
+            yield {b: columns[b] for b in branches}
+
+
+def iterate_root(filename, tree_name, branches, chunk_size):
+    """Iterate over chunks of a tree using ROOT."""
+    import ROOT
+    ROOT.PyConfig.IgnoreCommandLineOptions = True
+    ROOT.gROOT.SetBatch(1)
+
+    f = ROOT.TFile(filename)
+    if not f or f.IsZombie():
+        raise IOError('Cannot open file %s' % filename)
+    tree = f.Get(tree_name)
+    if not tree:
+        raise RuntimeError('No tree %s in %s' % (tree_name, filename))
+    n_entries = int(tree.GetEntries())
+    try:
+        for first in xrange(0, n_entries, chunk_size):
+            yield columnar_cache.read_tree_columns(tree, branches, first, chunk_size)
+    finally:
+        f.Close()
+
+
+def iterate_cache(filename, tree_name, branches, chunk_size):
+    """Iterate over chunks of a tree using the columnar cache."""
+    columns = columnar_cache.load_tree(filename, tree_name, branches)
+    n_entries = len(columns[branches[0]]) if branches else 0
+    for first in xrange(0, n_entries, chunk_size):
+        yield {b: np.asarray(arr[first:first + chunk_size]) for b, arr in columns.iteritems()}
+
+
+def read(filename, tree_name, branches, selection=None, chunk_size=100000, use_cache=False):
+    """Read branches of a tree into arrays, applying the selection if any.
+
+    Same arguments as iterate().
+
+    Returns dict of {branch name: array}.
+    """
+    chunks = list(iterate(filename, tree_name, branches, selection, chunk_size, use_cache))
+    if not chunks:
+        return {b: np.zeros(0) for b in branches}
+    return {b: np.concatenate([c[b] for c in chunks]) for b in branches}
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+"""
+Overlay the same histogram from several files, e.g. DeltaR distributions for
+different masses, as configured by a JSON file.
+
+e.g.:
+./overlay_hists.py a1a1_hists/a1a1_dr.json
+
+The config file looks like:
+
+{
+    "files": "hist_a1a1_*.root",
+    "mass_regex": "hist_a1a1_(?P<mass>[\\d.]+)\\.root$",
+    "hist": "bbDr",
+    "title": "h(450) #to a1a1, a1 #to b;#Delta R(bb);p.d.f.",
+    "legend": "m_{a1} = %(mass)s GeV",
+    "colors": ["kRed", "kBlue", "kGreen+2"],
+    "xrange": [0, 1.5],
+    "stack": false,
+    "output": "a1a1_dr.pdf"
+}
+
+Relative paths are relative to the config file. Files are sorted by the mass
+extracted from their name. Optional settings (and their defaults) are:
+fill_alpha (0.55), linestyle (1), legend_pos ([0.6, 0.55, 0.88, 0.88]),
+canvas_size ([800, 800]).
+
+The normalised histograms are cached in a ROOT file next to the output
+(<output stem>_cache.root), keyed by input file path and modification time,
+so re-styling a plot doesn't need every input file to be reread.
+"""
+
+
+import os
+import re
+import sys
+import glob
+import json
+import hashlib
+import argparse
+import logging
+import ROOT
+
+
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+ROOT.gStyle.SetOptStat(0)
+ROOT.gROOT.SetBatch(1)
+
+
+logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+log = logging.getLogger(__name__)
+
+
+DEFAULT_CONFIG = {
+    'mass_regex': r'_(?P<mass>[\d.]+)\.root$',
+    'legend': 'm = %(mass)s GeV',
+    'colors': ['kRed', 'kBlue', 'kMagenta', 'kGreen+2', 'kOrange', 'kViolet+7', 'kBlack'],
+    'fill_alpha': 0.55,
+    'linestyle': 1,
+    'legend_pos': [0.6, 0.55, 0.88, 0.88],
+    'canvas_size': [800, 800],
+    'xrange': None,
+    'stack': False,
+    'title': '',
+}
+
+
+def overlay_hists(in_args=sys.argv[1:]):
+    """Main function"""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('config',
+                        help='JSON config file')
+    parser.add_argument('--output',
+                        help='Override output filename from config')
+    stack_group = parser.add_mutually_exclusive_group()
+    stack_group.add_argument('--stack',
+                             dest='stack', action='store_true', default=None,
+                             help='Stack histograms on top of each other')
+    stack_group.add_argument('--noStack',
+                             dest='stack', action='store_false',
+                             help='Overlay histograms without stacking')
+    parser.add_argument('--noCache',
+                        action='store_true',
+                        help="Don't use the histogram cache")
+    parser.add_argument("-v",
+                        help="Display debug messages.",
+                        action='store_true')
+    args = parser.parse_args(args=in_args)
+
+    if args.v:
+        log.setLevel(logging.DEBUG)
+
+    config = load_config(args.config)
+    if args.output:
+        config['output'] = os.path.abspath(args.output)
+    if args.stack is not None:
+        config['stack'] = args.stack
+
+    inputs = find_inputs(config['files'], config['mass_regex'])
+    if not inputs:
+        raise RuntimeError('No files match %s' % config['files'])
+
+    cache_name = None if args.noCache else os.path.splitext(config['output'])[0] + '_cache.root'
+    hists = get_hists(inputs, config['hist'], cache_name)
+    plot_overlay(hists, config)
+
+
+def load_config(filename):
+    """Load config file, adding defaults & making paths absolute."""
+    with open(filename) as jfile:
+        user_config = json.load(jfile)
+    for key in ['files', 'hist', 'output']:
+        if key not in user_config:
+            raise KeyError('Config %s needs an entry for "%s"' % (filename, key))
+    config = dict(DEFAULT_CONFIG)
+    config.update(user_config)
+    config_dir = os.path.dirname(os.path.abspath(filename))
+    for key in ['files', 'output']:
+        config[key] = os.path.join(config_dir, config[key])
+    return config
+
+
+def find_inputs(pattern, mass_regex):
+    """Find files matching the glob pattern, and get the mass from each name.
+
+    Files whose name doesn't match mass_regex are skipped.
+    Returns list of (mass, filename), sorted by mass.
+    """
+    regex = re.compile(mass_regex)
+    inputs = []
+    for filename in glob.glob(pattern):
+        match = regex.search(os.path.basename(filename))
+        if not match:
+            log.warning('Cannot get mass from %s, skipping' % filename)
+            continue
+        inputs.append((match.group('mass'), filename))
+    return sorted(inputs, key=lambda x: (float(x[0]), x[1]))
+
+
+def get_color(color):
+    """Convert a color like "kGreen+2" or 632 into a ROOT color number"""
+    if isinstance(color, int):
+        return color
+    match = re.match(r'^(k\w+)\s*([+-]\s*\d+)?$', color)
+    if not match or not hasattr(ROOT, match.group(1)):
+        raise ValueError('Unknown color %s' % color)
+    offset = int(match.group(2).replace(' ', '')) if match.group(2) else 0
+    return getattr(ROOT, match.group(1)) + offset
+
+
+def get_cache_key(filename, hist_name):
+    """Name to store a histogram under in the cache file, and its stamp,
+    which changes when the input file changes."""
+    filename = os.path.abspath(filename)
+    key = 'h_' + hashlib.sha1('%s:%s' % (filename, hist_name)).hexdigest()[:16]
+    stat = os.stat(filename)
+    stamp = '%d %.6f' % (stat.st_size, stat.st_mtime)
+    return key, stamp
+
+
+def get_hists(inputs, hist_name, cache_name=None):
+    """Get normalised clones of a histogram from each input file.
+
+    inputs: list[(str, str)]
+        (mass, filename) for each input.
+    hist_name: str
+        Name of histogram in each file.
+    cache_name: str
+        ROOT file to cache normalised histograms in. If None, no cache is used.
+
+    Returns list of (mass, histogram).
+    """
+    cache = None
+    if cache_name:
+        mode = 'UPDATE' if os.path.isfile(cache_name) else 'RECREATE'
+        cache = ROOT.TFile(cache_name, mode)
+        if not cache or cache.IsZombie():
+            log.warning('Cannot open cache %s, not using it' % cache_name)
+            cache = None
+
+    hists = []
+    for mass, filename in inputs:
+        key, stamp = get_cache_key(filename, hist_name)
+        h = None
+        if cache:
+            cached_stamp = cache.Get(key + '_stamp')
+            if cached_stamp and cached_stamp.GetTitle() == stamp:
+                h = cache.Get(key)
+                if h:
+                    log.debug('Using cached %s for %s' % (hist_name, filename))
+        if not h:
+            h = read_normalised_hist(filename, hist_name)
+            if not h:
+                continue
+            if cache:
+                cache.WriteTObject(h, key, 'Overwrite')
+                cache.WriteTObject(ROOT.TNamed(key + '_stamp', stamp), key + '_stamp', 'Overwrite')
+        h = h.Clone('h_%s' % mass)
+        h.SetDirectory(0)  # VERY IMPORTANT otherwise TFile owns hist
+        hists.append((mass, h))
+
+    if cache:
+        cache.Close()
+    return hists
+
+
+def read_normalised_hist(filename, hist_name):
+    """Get a normalised clone of a histogram from a file. Returns None if it
+    can't be read."""
+    f = ROOT.TFile(filename)
+    if not f or f.IsZombie():
+        log.warning('Cannot open %s' % filename)
+        return None
+    h = f.Get(hist_name)
+    if not h:
+        log.warning('Cannot get %s from %s' % (hist_name, filename))
+        f.Close()
+        return None
+    h = h.Clone()
+    h.SetDirectory(0)
+    if h.Integral() != 0:
+        h.Scale(1. / h.Integral())
+    f.Close()
+    return h
+
+
+def plot_overlay(hists, config):
+    """Draw histograms on one canvas and save.
+
+    hists: list[(str, TH1)]
+        (mass, histogram) for each input, in the order to plot them.
+    config: dict
+        Plot settings.
+    """
+    stack = ROOT.THStack("stack", config['title'])
+    leg = ROOT.TLegend(*config['legend_pos'])
+    leg.SetLineWidth(0)
+    leg.SetLineColor(0)
+    leg.SetFillStyle(0)
+
+    colors = config['colors']
+    for i, (mass, h) in enumerate(hists):
+        color = get_color(colors[i % len(colors)])
+        h.SetLineColor(color)
+        h.SetFillColorAlpha(color, config['fill_alpha'])
+        h.SetLineStyle(config['linestyle'])
+        if config['xrange']:
+            h.SetAxisRange(config['xrange'][0], config['xrange'][1], 'X')
+        stack.Add(h)
+        leg.AddEntry(h, config['legend'] % {'mass': mass}, "LF")
+
+    c = ROOT.TCanvas("c", "", *config['canvas_size'])
+    c.SetTicks(1, 1)
+    stack.Draw("" if config['stack'] else "NOSTACK")
+    leg.Draw()
+    master = stack.GetHistogram()
+    if config['xrange']:
+        master.SetAxisRange(config['xrange'][0], config['xrange'][1], 'X')
+    master.SetTitle(config['title'])
+    out_dir = os.path.dirname(config['output'])
+    if out_dir and not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    c.SaveAs(config['output'])
+
+
+if __name__ == "__main__":
+    overlay_hists()
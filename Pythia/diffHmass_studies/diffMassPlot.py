@@ -5,7 +5,14 @@ Script to produce plots highlighting effect of changing H mass (125 vs ???)
 
 import ROOT
 import os
-from collections import namedtuple
+import sys
+import time
+import hashlib
+import argparse
+from collections import namedtuple, OrderedDict
+from multiprocessing import Pool, cpu_count
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'analysis_tools'))
+import plot_engine
 
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 ROOT.gStyle.SetOptStat(0)
@@ -13,33 +20,97 @@ ROOT.gROOT.SetBatch(1)
 ROOT.gStyle.SetLegendBorderSize(0)
 ROOT.TH1.SetDefaultSumw2(True)
 
-# files with TTrees
-# 8 TeV
-f_h125_ma4_8TeV = dict(file=ROOT.TFile('8TeV/ggh125_2a_4tau_ma1_4_8TeV_n50000.root'),
-                       label='m_{H} = 125 GeV, m_{a} = 4 GeV, #sqrt{s} = 8 TeV',
-                       color=ROOT.kBlack)
-f_h125_ma8_8TeV = dict(file=ROOT.TFile('8TeV/ggh125_2a_4tau_ma1_8_8TeV_n50000.root'),
-                       label='m_{H} = 125 GeV, m_{a} = 8 GeV, #sqrt{s} = 8 TeV',
-                       color=ROOT.kBlue)
-f_h300_ma4_8TeV = dict(file=ROOT.TFile('8TeV/ggh300_2a_4tau_ma1_4_8TeV_n50000.root'),
-                       label='m_{H} = 300 GeV, m_{a} = 4 GeV, #sqrt{s} = 8 TeV',
-                       color=ROOT.kRed)
-f_h300_ma8_8TeV = dict(file=ROOT.TFile('8TeV/ggh300_2a_4tau_ma1_8_8TeV_n50000.root'),
-                       label='m_{H} = 300 GeV, m_{a} = 8 GeV, #sqrt{s} = 8 TeV',
-                       color=ROOT.kGreen+3)
-# 13 TeV
-f_h125_ma4_13TeV = dict(file=ROOT.TFile('13TeV/ggh125_2a_4tau_ma1_4_13TeV_n50000.root'),
-                        label='m_{H} = 125 GeV, m_{a} = 4 GeV, #sqrt{s} = 13 TeV',
-                        color=ROOT.kBlack)
-f_h125_ma8_13TeV = dict(file=ROOT.TFile('13TeV/ggh125_2a_4tau_ma1_8_13TeV_n50000.root'),
-                        label='m_{H} = 125 GeV, m_{a} = 8 GeV, #sqrt{s} = 13 TeV',
-                        color=ROOT.kBlue)
-f_h300_ma4_13TeV = dict(file=ROOT.TFile('13TeV/ggh300_2a_4tau_ma1_4_13TeV_n50000.root'),
-                        label='m_{H} = 300 GeV, m_{a} = 4 GeV, #sqrt{s} = 13 TeV',
-                        color=ROOT.kRed)
-f_h300_ma8_13TeV = dict(file=ROOT.TFile('13TeV/ggh300_2a_4tau_ma1_8_13TeV_n50000.root'),
-                        label='m_{H} = 300 GeV, m_{a} = 8 GeV, #sqrt{s} = 13 TeV',
-                        color=ROOT.kGreen+3)
+# Handy structure to hold info about a sample (i.e. a file with TTrees)
+Sample = namedtuple('Sample', 'path label color energy mh ma')
+
+
+def make_sample(energy, mh, ma, color, n_events=50000):
+    """Make a Sample for a ggh -> 2a -> 4tau file from generateMC.exe"""
+    return Sample(path='%dTeV/ggh%d_2a_4tau_ma1_%g_%dTeV_n%d.root' % (energy, mh, ma, energy, n_events),
+                  label='m_{H} = %d GeV, m_{a} = %g GeV, #sqrt{s} = %d TeV' % (mh, ma, energy),
+                  color=color, energy=energy, mh=mh, ma=ma)
+
+
+# Declare the samples you want here. Comparisons are made between all samples
+# with the same energy and m_a (or same energy and m_H).
+samples = [
+    # 8 TeV
+    make_sample(energy=8, mh=125, ma=4, color=ROOT.kBlack),
+    make_sample(energy=8, mh=125, ma=8, color=ROOT.kBlue),
+    make_sample(energy=8, mh=300, ma=4, color=ROOT.kRed),
+    make_sample(energy=8, mh=300, ma=8, color=ROOT.kGreen+3),
+    # 13 TeV
+    make_sample(energy=13, mh=125, ma=4, color=ROOT.kBlack),
+    make_sample(energy=13, mh=125, ma=8, color=ROOT.kBlue),
+    make_sample(energy=13, mh=300, ma=4, color=ROOT.kRed),
+    make_sample(energy=13, mh=300, ma=8, color=ROOT.kGreen+3),
+]
+
+
+class FileCache(object):
+    """Opens ROOT files lazily, keeping at most max_open of them open at once.
+    The least recently used file is closed when the limit is reached.
+
+    Any objects that must outlive their file (e.g. histograms) should not be
+    owned by it.
+    """
+
+    def __init__(self, max_open=4):
+        if max_open < 1:
+            raise RuntimeError('FileCache must be able to hold at least 1 file')
+        self.max_open = max_open
+        self.files = OrderedDict()
+
+    def get(self, path):
+        """Get open TFile for path"""
+        if path in self.files:
+            # move to the end, as most recently used
+            f = self.files.pop(path)
+            self.files[path] = f
+            return f
+        f = ROOT.TFile(path)
+        if not f or f.IsZombie():
+            raise IOError('Cannot open file %s' % path)
+        self.files[path] = f
+        while len(self.files) > self.max_open:
+            _, old_file = self.files.popitem(last=False)
+            old_file.Close()
+        return f
+
+    def close(self):
+        """Close all open files"""
+        for f in self.files.itervalues():
+            f.Close()
+        self.files.clear()
+
+
+def generate_comparisons(samples):
+    """Generate list of comparisons to make from a list of samples.
+
+    For each energy, compares samples with different m_H and the same m_a,
+    and samples with different m_a and the same m_H.
+
+    Returns a list of (plot_dir, list of samples) tuples.
+
+    e.g. ('8TeV/mh125vs300_ma4', [<mH = 125 sample>, <mH = 300 sample>])
+    """
+    comparisons = []
+    for energy in sorted(set(s.energy for s in samples)):
+        e_samples = [s for s in samples if s.energy == energy]
+        # plot fixed ma, various mH
+        for ma in sorted(set(s.ma for s in e_samples)):
+            group = sorted([s for s in e_samples if s.ma == ma], key=lambda s: s.mh)
+            if len(group) > 1:
+                plot_dir = '%dTeV/mh%s_ma%g' % (energy, 'vs'.join('%d' % s.mh for s in group), ma)
+                comparisons.append((plot_dir, group))
+        # plot fixed mH, various ma
+        for mh in sorted(set(s.mh for s in e_samples)):
+            group = sorted([s for s in e_samples if s.mh == mh], key=lambda s: s.ma)
+            if len(group) > 1:
+                plot_dir = '%dTeV/mh%d_ma%s' % (energy, mh, 'vs'.join('%g' % s.ma for s in group))
+                comparisons.append((plot_dir, group))
+    return comparisons
+
 
 # Handy structure to hold info about a plot
 Plot = namedtuple('Plot', 'tree var nbins xlim xtitle ytitle title')
@@ -114,17 +185,165 @@ def normalise(h):
     h.Scale(1./h.Integral())
 
 
-def plot_compare(file_1, file_2, plot, plot_dir, oFormat='pdf'):
-    """Plot histogram from file_1 and file_2 on same canvas and save.
+class HistCache(object):
+    """Cache of histograms, so each (file, tree, var, binning) histogram is
+    only filled once.
+
+    Histograms are kept in memory, and (unless use_disk is False) saved to a
+    cache ROOT file next to each source file, <source stem>_histcache.root,
+    so later runs don't need to read the trees at all. A cache file is
+    rebuilt if the size or modification time of its source file has changed.
+
+    The variables needed from a tree are filled by TTree::Draw in C++, up to
+    4 at a time, so there is one pass over its entries per 4 variables.
+    """
+
+    def __init__(self, file_cache, use_disk=True):
+        self.file_cache = file_cache
+        self.use_disk = use_disk
+        self.hists = {}
+
+    @staticmethod
+    def make_key(sample, plot):
+        return (sample.path, plot.tree, plot.var, plot.nbins, plot.xlim[0], plot.xlim[1])
+
+    @staticmethod
+    def make_hist_name(key):
+        """Unique name for histogram in cache file."""
+        return 'h_' + hashlib.sha1(repr(key[1:])).hexdigest()[:16]
+
+    @staticmethod
+    def get_cache_filename(sample):
+        return os.path.splitext(sample.path)[0] + '_histcache.root'
+
+    @staticmethod
+    def get_source_stamp(sample):
+        """Identify the state of the source file by its size and modification time."""
+        stat = os.stat(sample.path)
+        return '%d %.6f' % (stat.st_size, stat.st_mtime)
+
+    def fill(self, samples, plots):
+        """Ensure histograms for all samples and plots are in the cache."""
+        for sample in samples:
+            missing = [p for p in plots if self.make_key(sample, p) not in self.hists]
+            if not missing:
+                continue
+            if self.use_disk:
+                self.load_from_disk(sample, missing)
+                missing = [p for p in missing if self.make_key(sample, p) not in self.hists]
+            if not missing:
+                continue
+            new_keys = []
+            for tree_name in sorted(set(p.tree for p in missing)):
+                new_keys.extend(self.fill_tree(sample, tree_name,
+                                               [p for p in missing if p.tree == tree_name]))
+            if self.use_disk:
+                self.save_to_disk(sample, new_keys)
+
+    def get(self, sample, plot):
+        """Get cached histogram for sample & plot, filling it if necessary.
+        Do not modify the returned histogram, Clone() it instead."""
+        key = self.make_key(sample, plot)
+        if key not in self.hists:
+            self.fill([sample], [plot])
+        return self.hists[key]
 
-    file_1, file_2: dict
-        Dict of information about files, including filename, label (for legend),
+    def fill_tree(self, sample, tree_name, plots):
+        """Fill histograms for several plots from one tree, with one pass
+        over its entries per 4 plots. Returns list of keys for new histograms."""
+        tree = self.file_cache.get(sample.path).Get(tree_name)
+        if not tree:
+            print 'No tree %s in file %s' % (tree_name, sample.path)
+            exit(1)
+
+        # Make the hists in memory, not in the file, since the file may get
+        # closed by the file cache
+        ROOT.gROOT.cd()
+        fills, keys = [], []
+        for plot in plots:
+            key = self.make_key(sample, plot)
+            h = ROOT.TH1D(self.make_hist_name(key), '', plot.nbins, plot.xlim[0], plot.xlim[1])
+            h.SetDirectory(0)
+            self.hists[key] = h
+            fills.append((plot.var, h))
+            keys.append(key)
+
+        # Loop over the entries in C++ with TTree::Draw, for up to 4 variables
+        # at once (only their branches are read). The values are kept in the
+        # tree's buffers, so make those big enough for every entry, then copy
+        # them into the histograms.
+        tree.SetEstimate(tree.GetEntries() + 1)
+        for start in xrange(0, len(fills), 4):
+            group = fills[start:start + 4]
+            n_values = tree.Draw(':'.join(var for var, _ in group), '', 'goff')
+            if n_values > tree.GetEstimate():
+                # more values than entries, from array branches, so they don't
+                # all fit in the buffers: let Draw fill each histogram instead
+                for var, h in group:
+                    h.SetDirectory(ROOT.gROOT)
+                    tree.Draw('%s>>%s' % (var, h.GetName()), '', 'goff')
+                    h.SetDirectory(0)
+                continue
+            for ind, (_, h) in enumerate(group):
+                if n_values > 0:
+                    h.FillN(n_values, tree.GetVal(ind), ROOT.nullptr)
+        return keys
+
+    def load_from_disk(self, sample, plots):
+        """Load any histograms for plots from the cache file for sample,
+        if it is up to date."""
+        cache_name = self.get_cache_filename(sample)
+        if not os.path.isfile(cache_name):
+            return
+        f = ROOT.TFile(cache_name)
+        if not f or f.IsZombie():
+            return
+        stamp = f.Get('source_stamp')
+        if stamp and stamp.GetTitle() == self.get_source_stamp(sample):
+            for plot in plots:
+                key = self.make_key(sample, plot)
+                h = f.Get(self.make_hist_name(key))
+                if h:
+                    h.SetDirectory(0)
+                    self.hists[key] = h
+        f.Close()
+
+    def save_to_disk(self, sample, keys):
+        """Add histograms to the cache file for sample, starting it afresh
+        if it is for an older version of the source file."""
+        cache_name = self.get_cache_filename(sample)
+        stamp = self.get_source_stamp(sample)
+        mode = 'RECREATE'
+        if os.path.isfile(cache_name):
+            f = ROOT.TFile(cache_name)
+            old_stamp = f.Get('source_stamp') if f and not f.IsZombie() else None
+            if old_stamp and old_stamp.GetTitle() == stamp:
+                mode = 'UPDATE'
+            if f:
+                f.Close()
+        f = ROOT.TFile(cache_name, mode)
+        if not f or f.IsZombie():
+            print 'WARNING: cannot write histogram cache %s' % cache_name
+            return
+        f.WriteTObject(ROOT.TNamed('source_stamp', stamp), 'source_stamp', 'Overwrite')
+        for key in keys:
+            f.WriteTObject(self.hists[key], self.make_hist_name(key), 'Overwrite')
+        f.Close()
+
+
+def plot_compare(samples, plot, plot_dir, hist_cache, oFormat='pdf'):
+    """Plot histograms from several samples on same canvas and save.
+
+    samples: list[Sample]
+        Samples to compare, including filename, label (for legend),
         and color (for histograms).
     plot: Plot namedtuple
         Information about histogram plotting options, including x & y
         axis titles, overall title, rebin value, and x-axis limit (if desired).
     plot_dir: str
         Directory in which to save plots
+    hist_cache: HistCache
+        Cache of histograms to take the plots from.
     oFormat: Optional[str]
         Output format for plot files.
     """
@@ -137,19 +356,17 @@ def plot_compare(file_1, file_2, plot, plot_dir, oFormat='pdf'):
     leg.SetFillStyle(0)
 
     h_title = ';'.join([plot.title, plot.xtitle, plot.ytitle])
-    for i, f in enumerate([file_1, file_2]):
-        # Get required TTree, fill hist
-        tree = f['file'].Get(plot.tree)
-        if not tree:
-            print 'No tree %s in file %s' % (plot.tree, f['file'])
-            exit(1)
-        h_name = '%s_%d' % (unique_name, i)
-        h = ROOT.TH1D(h_name, h_title, plot.nbins, plot.xlim[0], plot.xlim[1])
-        tree.Draw('%s>>%s' % (plot.var, h_name), "", "")
-        h.SetLineColor(f['color'])
+    hists = []  # to keep the clones alive until the plot is saved
+    for i, sample in enumerate(samples):
+        # Restyle a copy of the cached hist, leave the original untouched
+        h = hist_cache.get(sample, plot).Clone('%s_%d' % (unique_name, i))
+        h.SetDirectory(0)
+        h.SetTitle(h_title)
+        h.SetLineColor(sample.color)
         normalise(h)
+        hists.append(h)
         hst.Add(h)
-        leg.AddEntry(h, f['label'],"L")
+        leg.AddEntry(h, sample.label, "L")
     hst.Draw('NOSTACK HISTE')
     leg.Draw()
     h_draw = hst.GetHistogram()
@@ -162,25 +379,127 @@ def plot_compare(file_1, file_2, plot, plot_dir, oFormat='pdf'):
     c.SaveAs('%s/%s.%s' % (plot_dir, plot.var, oFormat))
 
 
+def get_available_samples(samples):
+    """Return samples whose file exists, warning about any that don't"""
+    available = []
+    for sample in samples:
+        if os.path.isfile(sample.path):
+            available.append(sample)
+        else:
+            print 'WARNING: file %s does not exist, skipping it' % sample.path
+    return available
+
+
+# Histogram cache used by plot_task() in worker processes.
+# Filled in the main process before the pool is made, so that the workers
+# inherit it and don't have to read any trees themselves.
+worker_hist_cache = None
+
+
+def init_worker():
+    """Setup ROOT in each worker process"""
+    ROOT.gROOT.SetBatch(1)
+    ROOT.gErrorIgnoreLevel = ROOT.kWarning
+
+
+def plot_task(task):
+    """Make one comparison plot. A tuple so it can be used with Pool.map().
+
+    task: tuple(str, list[Sample], Plot, str)
+        Plot directory, samples to compare, plot, and output format.
+
+    Returns the output filename and the time taken in seconds.
+    """
+    plot_dir, comp_samples, plot, oFormat = task
+    start = time.time()
+    plot_compare(comp_samples, plot, plot_dir, worker_hist_cache, oFormat)
+    return '%s/%s.%s' % (plot_dir, plot.var, oFormat), time.time() - start
+
+
+def report_timing(timings, n_slowest=10):
+    """Print the slowest tasks and the total time"""
+    timings = sorted(timings, key=lambda x: x[1], reverse=True)
+    print 'Made %d plots, total plotting time %.1f s' % (len(timings), sum(t for _, t in timings))
+    print 'Slowest plots:'
+    for filename, t in timings[:n_slowest]:
+        print '  %6.2f s  %s' % (t, filename)
+
+
 if __name__ == "__main__":
-    for hist in plots:
-        # 8TeV
-        # plot ma = 4, various mH
-        plot_compare(f_h125_ma4_8TeV, f_h300_ma4_8TeV, hist, '8TeV/mh125vs300_ma4')
-        # plot ma = 8, various mH
-        plot_compare(f_h125_ma8_8TeV, f_h300_ma8_8TeV, hist, '8TeV/mh125vs300_ma8')
-        # plot mH = 125, various ma
-        plot_compare(f_h125_ma4_8TeV, f_h125_ma8_8TeV, hist, '8TeV/mh125_ma4vs8')
-        # plot mH = 300, various ma
-        plot_compare(f_h300_ma4_8TeV, f_h300_ma8_8TeV, hist, '8TeV/mh300_ma4vs8')
-
-        # 13 TeV
-        # plot ma = 4, various mH
-        plot_compare(f_h125_ma4_13TeV, f_h300_ma4_13TeV, hist, '13TeV/mh125vs300_ma4')
-        # plot ma = 8, various mH
-        plot_compare(f_h125_ma8_13TeV, f_h300_ma8_13TeV, hist, '13TeV/mh125vs300_ma8')
-        # plot mH = 125, various ma
-        plot_compare(f_h125_ma4_13TeV, f_h125_ma8_13TeV, hist, '13TeV/mh125_ma4vs8')
-        # plot mH = 300, various ma
-        plot_compare(f_h300_ma4_13TeV, f_h300_ma8_13TeV, hist, '13TeV/mh300_ma4vs8')
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--maxOpen",
+                        help="Maximum number of ROOT files to have open at once",
+                        default=4, type=int)
+    parser.add_argument("--format",
+                        help="Output format for plots",
+                        default="pdf")
+    parser.add_argument("--noDiskCache",
+                        help="Don't read or write the on-disk histogram cache files",
+                        action='store_true')
+    parser.add_argument("-j", "--jobs",
+                        help="Number of plots to make in parallel. "
+                        "Defaults to the number of cores.",
+                        default=cpu_count(), type=int)
+    parser.add_argument("--dry",
+                        help="Dry run, only list the plots that would be remade",
+                        action='store_true')
+    parser.add_argument("--force",
+                        help="Remake all plots, even if they are up to date",
+                        action='store_true')
+    args = parser.parse_args()
+
+    # Only remake plots whose inputs, settings, or drawing code have changed
+    engine = plot_engine.PlotEngine(dry_run=args.dry, force=args.force)
+    code = plot_engine.code_fingerprint(plot_compare, normalise)
+    available_samples = get_available_samples(samples)
+    comparisons = generate_comparisons(available_samples)
+    tasks, fingerprints = [], {}
+    for plot_dir, comp_samples in comparisons:
+        for hist in plots:
+            output = '%s/%s.%s' % (plot_dir, hist.var, args.format)
+            fp = plot_engine.make_fingerprint([s.path for s in comp_samples],
+                                              plot=hist._asdict(),
+                                              samples=[s._asdict() for s in comp_samples],
+                                              code=code)
+            if engine.check([output], fp):
+                tasks.append((plot_dir, comp_samples, hist, args.format))
+                fingerprints[output] = fp
+
+    print engine.summary()
+    if args.dry:
+        for output in sorted(fingerprints):
+            print '  would remake %s' % output
+    if args.dry or not tasks:
+        sys.exit(0)
+
+    file_cache = FileCache(args.maxOpen)
+    hist_cache = HistCache(file_cache, use_disk=not args.noDiskCache)
+    # Fill all needed hists up front, so each tree is only read once
+    needed_samples, needed_plots = [], []
+    for _, comp_samples, hist, _ in tasks:
+        needed_samples.extend(s for s in comp_samples if s not in needed_samples)
+        if hist not in needed_plots:
+            needed_plots.append(hist)
+    hist_cache.fill(needed_samples, needed_plots)
+    file_cache.close()
+
+    for plot_dir in set(task[0] for task in tasks):
+        # make dirs here, to avoid workers racing to make them
+        if not os.path.isdir(plot_dir):
+            os.makedirs(plot_dir)
+
+    worker_hist_cache = hist_cache
+    start = time.time()
+    if args.jobs > 1 and len(tasks) > 1:
+        pool = Pool(min(args.jobs, len(tasks)), initializer=init_worker)
+        timings = pool.map(plot_task, tasks, chunksize=1)
+        pool.close()
+        pool.join()
+    else:
+        timings = [plot_task(task) for task in tasks]
+    report_timing(timings)
+    print 'Wall time: %.1f s using %d process(es)' % (time.time() - start, max(1, min(args.jobs, len(tasks))))
 
+    for output, _ in timings:
+        engine.record([output], fingerprints[output])
+    engine.save()
@@ -12,6 +12,10 @@ or since it's an executable:
 
 ./basicPlotter.py <ROOT file>
 
+Plots are only remade if the ROOT file (or the code that makes them) has
+changed since last time. Add --dry to see which plots would be remade,
+or --force to remake them all anyway.
+
 The triple quotes mark a 'block comment'
 
 Also I try to keep lines to about ~80 characters long. Makes things more
@@ -20,8 +24,15 @@ readable on a small screen, and allows for side-by-side windows.
 
 
 # Here we load both standard and third-party packages.
+import os
 import sys  # allows us to get any commandline options
+import argparse  # makes handling commandline options much easier
+import logging
 import ROOT
+# plot_engine lives in ../analysis_tools, so we tell python where to find it
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'analysis_tools'))
+import plot_engine
 
 
 # ROOT likes to screw up the user's arguments, stop this:
@@ -288,6 +299,34 @@ def print_tree_vars(filename):
     rf.Close()
 
 
+def print_tree_vars_fast(filename):
+    """
+    Looping over every entry in Python, like in print_tree_vars(), gets
+    very slow for big trees.
+
+    Instead, we can read the branches we need into NumPy arrays in big chunks,
+    and do the maths on whole arrays at once.
+    """
+    # tree_reader also lives in ../analysis_tools
+    import tree_reader
+
+    # Get the branches we want as arrays, for entries passing a selection.
+    # The selection is evaluated on the whole arrays, so use & and | with
+    # brackets, instead of 'and' and 'or'.
+    cols = tree_reader.read(filename, 'a1Vars', ['a1Pt', 'a1Phi'],
+                            selection='abs(a1Eta) < 2.4')
+
+    # Maths on the whole array in one go - no loop!
+    a1_phi_degrees = cols['a1Phi'] * 180. / ROOT.TMath.Pi()
+
+    # Slicing gets the first 10 entries
+    for ind, (pt, phi) in enumerate(zip(cols['a1Pt'][:10], a1_phi_degrees[:10])):
+        print "Entry", ind, ":: "
+        print "\ta1 pt = %.3f, a1 phi(degrees) = %.3f" % (pt, phi)
+
+    print "Mean a1 pt for |eta| < 2.4: %.3f" % cols['a1Pt'].mean()
+
+
 if __name__ == "__main__":
     """
     This part only runs if script is executed.
@@ -295,14 +334,41 @@ if __name__ == "__main__":
     If we import it into another script, this bit won't run.
     """
 
-    # sys.argv is a list of all the user's command line arguments
-    # The first one is the program name.
-    # The second argument will be the ROOT filename.
-    # len() counts the size of iterable things like lists
-    if len(sys.argv) != 2:
-        raise RuntimeError("Need to specify 1 filename to process")
-
-    make_easy_plot(sys.argv[1])  # [1] means 'get the 2nd element', since the first is at [0]
-    make_easy_2d_plot(filename=sys.argv[1], fmt='png')  # We can use the argument name when calling it! Make things SO much clearer
-    make_harder_plot(sys.argv[1])
-    print_tree_vars(sys.argv[1])
+    # argparse handles the user's command line arguments for us,
+    # and makes a --help message for free.
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("filename", help="ROOT file to process")
+    parser.add_argument("--dry", action='store_true',
+                        help="Only list the plots that would be remade")
+    parser.add_argument("--force", action='store_true',
+                        help="Remake all plots, even if they are up to date")
+    args = parser.parse_args()
+
+    # Show the engine's messages, e.g. which plots a dry run would remake
+    logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+
+    # The engine remembers a 'fingerprint' for each plot it makes, built from
+    # the input file's size & modification time, and anything else we give it.
+    # If the fingerprint hasn't changed, the plot is up to date and is skipped.
+    engine = plot_engine.PlotEngine(dry_run=args.dry, force=args.force)
+
+    # A list of tuples: (plot function, output format, output files it makes)
+    plot_jobs = [
+        (make_easy_plot, 'pdf', ['what_a_fantastic_first_plot.pdf']),
+        (make_easy_2d_plot, 'png', ['a_stunning_2d_plot.png']),
+        (make_harder_plot, 'pdf', ['complicated_plot.pdf', 'complicated_plot_better.pdf']),
+    ]
+    for func, fmt, outputs in plot_jobs:
+        # Including the function's code means editing it will remake its plots
+        fp = plot_engine.make_fingerprint([args.filename], fmt=fmt,
+                                          code=plot_engine.code_fingerprint(func))
+        # build() only calls func(filename=..., fmt=...) if it needs to.
+        # We can use the argument name when calling it! Make things SO much clearer
+        engine.build(outputs, fp, func, filename=args.filename, fmt=fmt)
+    engine.save()
+    print engine.summary()
+
+    if not args.dry:
+        print_tree_vars(args.filename)
+        print_tree_vars_fast(args.filename)
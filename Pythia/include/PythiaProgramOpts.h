@@ -102,6 +102,7 @@ class PythiaProgramOpts
     bool verbose_;
 
     bool zip_;
+    bool noZip_;
 
     po::options_description desc_;
 };
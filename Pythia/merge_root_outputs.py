@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+"""
+Merge the per-seed ROOT files from Pythia jobs, using hadd.
+
+Files in --iDir (usually <oDir>/root from submit_py8_jobs_htcondor.py) are
+grouped by channel & mass, i.e. by their filename without the number of
+events and seed. Each group is merged in a parallel tree reduction: pairs of
+files are merged at the same time across local cores, then pairs of those,
+and so on until one file is left.
+
+If --size is given, each group is first split into several outputs of about
+that size, <stem>_part<N>.root, otherwise each group goes into <stem>.root.
+
+A manifest of the inputs (with their size and modification time) used for
+each output is stored in <oDir>/merge_manifest.json, so outputs whose inputs
+haven't changed aren't remade.
+
+e.g.:
+./merge_root_outputs.py --iDir /hdfs/user/<username>/NMSSMPheno/Pythia8/13TeV/ggh125_2a_4tau/18_Nov_15/root --mass 8
+"""
+
+
+import os
+import re
+import sys
+import json
+import shutil
+import argparse
+import logging
+import subprocess
+from multiprocessing import Pool, cpu_count
+
+
+logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+log = logging.getLogger(__name__)
+
+
+# Get the parts of filenames from generateMC.exe (see generate_filename() in
+# the submission scripts), e.g. ggh125_2a_4tau_ma1_8_13TeV_n10000_seed12.root
+FILENAME_RE = re.compile(r'^(?P<stem>(?P<channel>.+)_ma1_(?P<mass>[^_]+)_(?P<energy>\d+)TeV)'
+                         r'_n(?P<nevents>\d+)_seed(?P<seed>\d+)\.root$')
+
+MANIFEST_NAME = 'merge_manifest.json'
+
+
+def merge_root_outputs(in_args=sys.argv[1:]):
+    """Main function. Find inputs, plan outputs, and merge."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iDir',
+                        required=True,
+                        help='Input directory of per-seed ROOT files')
+    parser.add_argument('--oDir',
+                        help='Output directory for merged files. If not '
+                        'specified, one will be created automatically at '
+                        '<iDir>/../root_merged')
+    parser.add_argument('--channel',
+                        help='Only merge files for this channel')
+    parser.add_argument('--mass',
+                        help='Only merge files for this a1 mass')
+    parser.add_argument('--size',
+                        type=float,
+                        help='Target size per output file in MB. If not '
+                        'specified, each channel & mass is merged into one file.')
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=cpu_count(),
+                        help='Number of hadd processes to run at once. '
+                        'Defaults to the number of cores.')
+    parser.add_argument('--hadd',
+                        default='hadd',
+                        help='hadd executable')
+    parser.add_argument('--force',
+                        action='store_true',
+                        help='Remake outputs even if their inputs are unchanged')
+    parser.add_argument("--dry",
+                        help="Dry run, only print the outputs that would be made.",
+                        action='store_true')
+    parser.add_argument("-v",
+                        help="Display debug messages.",
+                        action='store_true')
+    args = parser.parse_args(args=in_args)
+
+    if args.v:
+        log.setLevel(logging.DEBUG)
+
+    log.debug('program args: %s' % args)
+
+    if not os.path.isdir(args.iDir):
+        raise RuntimeError('--iDir arg does not correspond to an actual directory')
+    if args.jobs < 1:
+        raise RuntimeError('--jobs must be >= 1')
+
+    args.iDir = args.iDir.rstrip('/')
+    if not args.oDir:
+        args.oDir = os.path.join(os.path.dirname(args.iDir), 'root_merged')
+
+    groups = get_input_groups(args.iDir, args.channel, args.mass)
+    if not groups:
+        raise RuntimeError('No matching ROOT files in %s' % args.iDir)
+
+    # Plan the outputs
+    # -------------------------------------------------------------------------
+    max_size = args.size * 1024 * 1024 if args.size else None
+    outputs = {}
+    for stem, inputs in groups.iteritems():
+        parts = plan_parts(inputs, [os.path.getsize(f) for f in inputs], max_size)
+        for ind, part in enumerate(parts):
+            name = '%s_part%d.root' % (stem, ind) if max_size else '%s.root' % stem
+            outputs[os.path.join(args.oDir, name)] = part
+
+    manifest_name = os.path.join(args.oDir, MANIFEST_NAME)
+    manifest = {}
+    if os.path.isfile(manifest_name):
+        with open(manifest_name) as jfile:
+            manifest = json.load(jfile)
+
+    to_merge = {}
+    for out_name, inputs in sorted(outputs.iteritems()):
+        stamps = get_stamps(inputs)
+        if not args.force and os.path.isfile(out_name) and manifest.get(out_name) == stamps:
+            log.info('%s is up to date, skipping' % out_name)
+            continue
+        to_merge[out_name] = inputs
+
+    if not to_merge:
+        log.info('Nothing to do')
+        return {}
+
+    if args.dry:
+        log.warning('Dry run - not merging any files.')
+        for out_name, inputs in sorted(to_merge.iteritems()):
+            log.info('%s <- %d files' % (out_name, len(inputs)))
+        return to_merge
+
+    # Do the merging
+    # -------------------------------------------------------------------------
+    check_create_dir(args.oDir, args.v)
+    tree_reduce(to_merge, args.hadd, args.jobs)
+
+    for out_name, inputs in to_merge.iteritems():
+        manifest[out_name] = get_stamps(inputs)
+    with open(manifest_name, 'w') as jfile:
+        json.dump(manifest, jfile, indent=2, sort_keys=True)
+    return to_merge
+
+
+def get_input_groups(directory, channel=None, mass=None):
+    """Get the per-seed ROOT files in a directory, grouped by filename stem
+    (i.e. channel, mass, and energy), optionally only those for a given
+    channel and/or mass.
+
+    Returns a dict of {stem: list of filenames sorted by seed}.
+    """
+    groups = {}
+    for filename in os.listdir(directory):
+        match = FILENAME_RE.match(filename)
+        if not match:
+            continue
+        if channel and match.group('channel') != channel:
+            continue
+        if mass and float(match.group('mass')) != float(mass):
+            continue
+        groups.setdefault(match.group('stem'), []).append((int(match.group('seed')),
+                                                           os.path.join(directory, filename)))
+    return {stem: [f for _, f in sorted(files)] for stem, files in groups.iteritems()}
+
+
+def plan_parts(filenames, sizes, max_size=None):
+    """Split files into parts of no more than max_size bytes. A file is never
+    split, so a single file larger than max_size gets its own part.
+
+    Returns a list of lists of filenames.
+
+    >>> plan_parts(['a', 'b', 'c'], [10, 10, 10], max_size=20)
+    [['a', 'b'], ['c']]
+    """
+    parts = []
+    current, current_size = [], 0
+    for filename, size in zip(filenames, sizes):
+        if current and max_size and current_size + size > max_size:
+            parts.append(current)
+            current, current_size = [], 0
+        current.append(filename)
+        current_size += size
+    if current:
+        parts.append(current)
+    return parts
+
+
+def get_stamps(filenames):
+    """Get [size, mtime] for each file, to spot changed inputs"""
+    stamps = {}
+    for filename in filenames:
+        stat = os.stat(filename)
+        stamps[filename] = [stat.st_size, stat.st_mtime]
+    return stamps
+
+
+def tree_reduce(to_merge, hadd, n_jobs):
+    """Merge each list of inputs into its output, pairwise, using a Pool.
+
+    At each step, all the pairs from all outputs are merged in parallel, into
+    intermediate files in a temporary directory next to each output. An odd
+    file out goes on to the next step unchanged.
+
+    to_merge: dict
+        {output filename: list of input filenames}
+    hadd: str
+        hadd executable
+    n_jobs: int
+        Number of processes to use
+    """
+    current = {out_name: list(inputs) for out_name, inputs in to_merge.iteritems()}
+    tmp_dirs = {out_name: os.path.splitext(out_name)[0] + '_tmp' for out_name in to_merge}
+    for tmp_dir in tmp_dirs.itervalues():
+        check_create_dir(tmp_dir)
+
+    pool = Pool(n_jobs)
+    step = 0
+    try:
+        while any(len(files) > 1 for files in current.itervalues()):
+            tasks, next_files = [], {}
+            for out_name, files in sorted(current.iteritems()):
+                next_files[out_name] = []
+                for ind in range(0, len(files) - 1, 2):
+                    tmp_name = os.path.join(tmp_dirs[out_name], 'step%d_%d.root' % (step, ind // 2))
+                    tasks.append((hadd, files[ind:ind + 2], tmp_name))
+                    next_files[out_name].append(tmp_name)
+                if len(files) % 2:
+                    next_files[out_name].append(files[-1])
+            log.info('Merge step %d: %d hadd jobs' % (step, len(tasks)))
+            results = pool.map(run_hadd, tasks)
+            failed = [(out, msg) for out, rc, msg in results if rc != 0]
+            if failed:
+                for out, msg in failed:
+                    log.error('hadd failed for %s:\n%s' % (out, msg))
+                raise RuntimeError('%d hadd jobs failed' % len(failed))
+
+            # Delete intermediate files that have been merged
+            for _, inputs, _ in tasks:
+                for filename in inputs:
+                    if os.path.dirname(filename) in tmp_dirs.values():
+                        os.remove(filename)
+            current = next_files
+            step += 1
+    finally:
+        pool.close()
+        pool.join()
+
+    for out_name, files in current.iteritems():
+        if files[0].startswith(tmp_dirs[out_name]):
+            shutil.move(files[0], out_name)
+        else:
+            # only one input, so nothing to merge
+            shutil.copy2(files[0], out_name)
+        shutil.rmtree(tmp_dirs[out_name])
+        log.info('Written %s from %d files' % (out_name, len(to_merge[out_name])))
+
+
+def run_hadd(task):
+    """Run hadd on some input files.
+    A tuple so it can be used with Pool.map().
+
+    task: tuple(str, list[str], str)
+        hadd executable, input files, output file
+
+    Returns the output filename, return code, and hadd's output.
+    """
+    hadd, inputs, out_name = task
+    cmds = [hadd, '-f', out_name] + inputs
+    log.debug(' '.join(cmds))
+    proc = subprocess.Popen(cmds, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    out, _ = proc.communicate()
+    return out_name, proc.returncode, out
+
+
+def check_create_dir(directory, info=False):
+    """Check to see if directory exists, if not make it.
+
+    Can optionally display message to user.
+    """
+    if not os.path.isdir(directory):
+        if os.path.isfile(directory):
+            raise RuntimeError("Cannot create directory %s, already "
+                               "exists as a file object" % directory)
+        os.makedirs(directory)
+        if info:
+            print "Making dir %s" % directory
+
+
+if __name__ == "__main__":
+    merge_root_outputs()
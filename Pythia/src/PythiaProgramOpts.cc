@@ -26,6 +26,7 @@ PythiaProgramOpts::PythiaProgramOpts(int argc, char* argv[]):
   printEvent_(false),
   verbose_(false),
   zip_(true),
+  noZip_(false),
   desc_("\nProduces MC for p-p collisions.\n"
     "User must specify the physics process(es) to be generated \nvia an input"
     " card (see input_cards directory for examples).\nDefaults for beams, "
@@ -68,7 +69,9 @@ PythiaProgramOpts::PythiaProgramOpts(int argc, char* argv[]):
     ("verbose,v", po::bool_switch(&verbose_)->default_value(verbose_),
       "Output debugging statements")
     ("zip", po::bool_switch(&zip_)->default_value(zip_),
-      "Compress LHE and HepMC outputs using gzip")
+      "Compress LHE and HepMC outputs using gzip [default]")
+    ("noZip", po::bool_switch(&noZip_)->default_value(noZip_),
+      "Don't compress LHE and HepMC outputs, e.g. if they are compressed afterwards")
   ;
 
   po::variables_map vm;
@@ -82,6 +85,10 @@ PythiaProgramOpts::PythiaProgramOpts(int argc, char* argv[]):
 
   po::notify(vm);
 
+  if (noZip_) {
+    zip_ = false;
+  }
+
   // Check input card exists
   if (!fs::exists(fs::path(cardName_))) {
     throw std::runtime_error("Input card \"" + cardName_+ "\" does not exist");
@@ -18,6 +18,7 @@
 #include <boost/algorithm/string.hpp>
 #include <boost/algorithm/string/predicate.hpp>
 #include <boost/lexical_cast.hpp>
+#include <boost/filesystem.hpp>
 
 // Own headers
 #include "PythiaProgramOpts.h"
@@ -330,6 +331,11 @@ int main(int argc, char *argv[]) {
     if (opts.writeToHEPMC()) filenames.push_back(opts.filenameHEPMC());
 
     for (const auto & fname : filenames) {
+      // Don't try to zip e.g. a named pipe being read by another program
+      if (!boost::filesystem::is_regular_file(fname)) {
+        cout << "Not zipping " << fname << " as it is not a regular file" << endl;
+        continue;
+      }
       int res = gzip_file(fname);
       if (res != 0) return res;
     }
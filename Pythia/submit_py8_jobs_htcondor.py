@@ -22,10 +22,23 @@ set up, but the job is not submitted.
 
 Note that this submits the jobs not one-by-one but as a DAG, to allow easier
 monitoring of job status.
+
+With --delphes, each job also runs Delphes on the same worker node, reading
+the HepMC events as they are generated through a named pipe, so the HepMC file
+doesn't need to be zipped, copied to /hdfs, and copied back for Delphes.
+Only the Delphes ROOT file is kept, plus the (zipped) HepMC file if --keepHepMC
+is used.
+
+HepMC & LHE outputs are gzipped by the worker script once the program has
+finished, using --cpus threads (see common/compress.py), rather than by the
+program itself with a single-threaded gzip.
+
+Each output file is registered in the production catalog (see
+common/catalog.py) as pending, and is marked as done by the job once it has
+been copied to its destination.
 """
 
 
-import shutil
 from time import strftime
 from subprocess import call
 import argparse
@@ -33,6 +46,10 @@ import sys
 import os
 import getpass
 import logging
+from collections import OrderedDict
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import catalog
+import storage
 
 
 logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
@@ -43,6 +60,9 @@ def submit_mc_jobs_htcondor(in_args=sys.argv[1:]):
     """
     Main function. Sets up all the relevant directories, makes condor
     job and DAG files, then submits them if necessary.
+
+    Returns an OrderedDict of {DAG filename: {node name: [output files]}},
+    as from write_dag_file().
     """
 
     # Handle user options. The user can pass all the same options as they
@@ -73,15 +93,35 @@ def submit_mc_jobs_htcondor(in_args=sys.argv[1:]):
                         "This will superseed any --mass option passed via --args",
                         nargs=3, type=float,
                         metavar=('startMass', 'endMass', 'massStep'))
+    parser.add_argument("--delphes",
+                        help="Also run Delphes in each job, using this Delphes card, "
+                        "e.g. ../Delphes/input_cards/delphes_card_CMS.tcl")
+    parser.add_argument("--delphesDir",
+                        help="Delphes installation to use with --delphes. "
+                        "Defaults to DELPHES_DIR in submit_delphes_jobs_htcondor.py")
+    parser.add_argument("--keepHepMC",
+                        help="With --delphes, also keep the HepMC files",
+                        action='store_true')
+    parser.add_argument("--cpus",
+                        help="Number of cores to request per job. "
+                        "Used to compress the outputs in parallel.",
+                        type=int, default=1)
     # All other program arguments to pass to program directly.
     parser.add_argument("--args",
                         help="All other program arguments. "
                         "You MUST specify this after all other options",
                         nargs=argparse.REMAINDER)
+    parser.add_argument("--catalog",
+                        help="Catalog file to register output files in. "
+                        "Defaults to $%s, or %s" % (catalog.CATALOG_ENV, catalog.DEFAULT_CATALOG))
     # Some generic script options
     parser.add_argument("--dry",
                         help="Dry run, don't submit to queue.",
                         action='store_true')
+    parser.add_argument("--noSubmit",
+                        help="Copy files & write the DAG(s), but don't submit them, "
+                        "e.g. to include them in a bigger workflow.",
+                        action='store_true')
     parser.add_argument("-v",
                         help="Display debug messages.",
                         action='store_true')
@@ -105,6 +145,9 @@ def submit_mc_jobs_htcondor(in_args=sys.argv[1:]):
     if args.jobIdRange[1] < args.jobIdRange[0]:
         raise RuntimeError('The second jobIdRange argument must be >= the first.')
 
+    if args.cpus < 1:
+        raise RuntimeError('--cpus must be >= 1')
+
     # Get the input card from user's options & check it exists
     try:
         card = get_option_in_args(args.args, "--card")
@@ -117,11 +160,25 @@ def submit_mc_jobs_htcondor(in_args=sys.argv[1:]):
         raise RuntimeError('Input card %s does not exist!' % card)
     args.card = card
     args.channel = os.path.splitext(os.path.basename(card))[0]
+    args.card_hash = catalog.card_hash([card])
+
+    # Make sure output zipped. This is done by the worker script in parallel,
+    # so stop the program doing it.
+    # -------------------------------------------------------------------------
+    if '--zip' in args.args:
+        args.args.remove('--zip')
+    if '--noZip' not in args.args:
+        args.args.append('--noZip')
 
-    # Make sure output zipped
+    # Delphes needs HepMC output
     # -------------------------------------------------------------------------
-    if '--zip' not in args.args:
-        args.args.append("--zip")
+    if args.delphes:
+        if not os.path.isfile(args.delphes):
+            raise RuntimeError('Delphes card %s does not exist!' % args.delphes)
+        if '--hepmc' not in args.args:
+            args.args.append('--hepmc')
+    elif args.keepHepMC:
+        raise RuntimeError('--keepHepMC only makes sense with --delphes')
 
     # Get CoM energy
     # -------------------------------------------------------------------------
@@ -135,21 +192,33 @@ def submit_mc_jobs_htcondor(in_args=sys.argv[1:]):
     if args.oDir == "":
         args.oDir = generate_dir_soolin(args.channel, args.energy)
 
-    check_create_dir(args.oDir)
+    # Directories to make & files to copy to /hdfs are queued up, and done
+    # all at once before submitting, with as few hadoop commands as possible
+    store = storage.get_storage()
+    store.queue_mkdir([args.oDir])
 
-    # Copy across input cards to hdfs to sandbox them
+    # Input cards & executable to copy to outputdir to sandbox them
     # -------------------------------------------------------------------------
-    if not args.dry:
-        log.debug('Copying across input_cards...')
-        call(['hadoop', 'fs', '-copyFromLocal', '-f',
-              'input_cards', args.oDir.replace('/hdfs', '')])
+    sandbox_exe = os.path.join(args.oDir, os.path.basename(args.exe))
+    sandbox = [('input_cards', os.path.join(args.oDir, 'input_cards')),
+               (args.exe, sandbox_exe)]
 
-    # Copy executable to outputdir to sandbox it
+    # Zip up Delphes installation, and add the card to the sandbox
     # -------------------------------------------------------------------------
-    sandbox_exe = os.path.join(args.oDir, os.path.basename(args.exe))
+    if args.delphes:
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Delphes'))
+        import submit_delphes_jobs_htcondor as delphes_submit
+        delphes_dir = args.delphesDir or delphes_submit.DELPHES_DIR
+        if not os.path.isdir(delphes_dir):
+            raise RuntimeError('Delphes directory %s does not exist' % delphes_dir)
+        args.delphes_sandbox = os.path.join(args.oDir, os.path.basename(args.delphes))
+        args.delphes_zip = '/hdfs/user/%s/NMSSMPheno/zips/delphes.tgz' % os.environ['LOGNAME']
+        sandbox.append((args.delphes, args.delphes_sandbox))
+        if not args.dry:
+            args.delphes_zip = delphes_submit.create_delphes_tar(delphes_dir, args.v, store)
+
     if not args.dry:
-        log.debug('Copying across exe...')
-        shutil.copy2(args.exe, sandbox_exe)
+        store.queue_upload(sandbox)
 
     # Setup log directory
     # -------------------------------------------------------------------------
@@ -167,7 +236,12 @@ def submit_mc_jobs_htcondor(in_args=sys.argv[1:]):
     else:
         masses = [get_option_in_args(args.args, '--mass')]
 
+    # Open catalog to register output files, not for dry runs
+    # -------------------------------------------------------------------------
+    cat = None if args.dry else catalog.Catalog(args.catalog)
+
     status_files = []
+    dag_files = OrderedDict()
 
     for mass in masses:
 
@@ -183,15 +257,28 @@ def submit_mc_jobs_htcondor(in_args=sys.argv[1:]):
         dag_name = file_stem + '.dag'
         status_name = file_stem + '.status'
         status_files.append(status_name)
-        write_dag_file(dag_filename=dag_name,
-                       condor_filename='HTCondor/mcJob.condor',
-                       status_filename=status_name, exe=sandbox_exe,
-                       log_dir=log_dir, mass=mass_str, args=args)
+        dag_files[dag_name] = write_dag_file(dag_filename=dag_name,
+                                             condor_filename='HTCondor/mcJob.condor',
+                                             status_filename=status_name, exe=sandbox_exe,
+                                             log_dir=log_dir, mass=mass_str, args=args,
+                                             cat=cat, store=store)
 
-        # Submit it
-        # ---------------------------------------------------------------------
+    # Make the output directories & copy the sandbox files across
+    # -------------------------------------------------------------------------
+    if not args.dry:
+        log.debug('Copying across input_cards, exe...')
+        n_uploads = len(store.pending_uploads)
+        if len(store.flush()) != n_uploads:
+            raise RuntimeError('Failed to copy input files to %s' % args.oDir)
+        log.info(store.summary())
+
+    # Submit the DAGs
+    # -------------------------------------------------------------------------
+    for dag_name, status_name in zip(dag_files, status_files):
         if args.dry:
             log.warning('Dry run - not submitting jobs or copying files.')
+        elif args.noSubmit:
+            log.info('Not submitting %s' % dag_name)
         else:
             call(['condor_submit_dag', dag_name])
             log.info('Check status with:')
@@ -199,13 +286,15 @@ def submit_mc_jobs_htcondor(in_args=sys.argv[1:]):
             log.info('Condor log files written to: %s' % log_dir)
             print''
 
-    if len(status_files) > 1:
+    if len(status_files) > 1 and not args.noSubmit:
         log.info('Check all statuses with:')
         log.info('DAGstatus.py %s' % ' '.join(status_files))
 
+    return dag_files
+
 
 def write_dag_file(dag_filename, condor_filename, status_filename,
-                   log_dir, exe, mass, args):
+                   log_dir, exe, mass, args, cat=None, store=None):
     """Write a DAG file for a set of jobs.
 
     Creates a DAG file, adding extra flags for the worker node script.
@@ -225,6 +314,15 @@ def write_dag_file(dag_filename, condor_filename, status_filename,
     args: argparse.Namespace
         Contains info about output directory, job IDs, number of events per job,
         and args to pass to the executable.
+    cat: catalog.Catalog
+        Catalog to register output files in as pending. If None, files
+        are not registered.
+    store: storage.Storage
+        Storage to queue the output directories to make with. If None,
+        they are made straight away.
+
+    Returns an OrderedDict of {node name: [output files]}, with the
+    destination of each file the job copies from the worker node.
     """
     # get number of events to generate per job
     if '--number' in args.args:
@@ -243,6 +341,7 @@ def write_dag_file(dag_filename, condor_filename, status_filename,
 
     log.debug('args.args before: %s' % args.args)
 
+    node_outputs = OrderedDict()
     log.info("DAG file: %s" % dag_filename)
     with open(dag_filename, 'w') as dag_file:
         dag_file.write('# DAG for channel %s\n' % args.channel)
@@ -250,6 +349,7 @@ def write_dag_file(dag_filename, condor_filename, status_filename,
         for job_ind in xrange(args.jobIdRange[0], args.jobIdRange[1] + 1):
             job_name = '%d_%s' % (job_ind, args.channel)
             dag_file.write('JOB %s %s\n' % (job_name, condor_filename))
+            node_outputs[job_name] = []
 
             remote_exe = 'mc.exe'
             # args to pass to the script on the worker node
@@ -257,6 +357,9 @@ def write_dag_file(dag_filename, condor_filename, status_filename,
             job_opts = ['--copyToLocal', cards_sandbox, 'input_cards',
                         '--copyToLocal', exe, remote_exe,
                         '--exe', remote_exe]
+            if args.delphes:
+                job_opts.extend(['--copyToLocal', args.delphes_zip, 'delphes.tgz',
+                                 '--copyToLocal', args.delphes_sandbox, 'delphes_card.tcl'])
 
             exe_args = args.args[:]
             exe_args.extend(['--seed', str(job_ind)])  # RNG seed using job index
@@ -288,24 +391,59 @@ def write_dag_file(dag_filename, condor_filename, status_filename,
                     out_name = "%s_seed%d.%s" % (os.path.splitext(out_name)[0],
                                                  job_ind, fmt)
                     set_option_in_args(exe_args, flag, out_name)
-                    if '--zip' in exe_args:
+                    if fmt in ['hepmc', 'lhe']:
+                        # With --delphes the HepMC is zipped as it is streamed
+                        if not (fmt == 'hepmc' and args.delphes):
+                            job_opts.extend(['--compress', out_name])
                         out_name += ".gz"
 
+                    outputs = [(fmt, out_name, os.path.join(args.oDir, fmt), 'Pythia8', args.card_hash)]
+                    if fmt == 'hepmc' and args.delphes:
+                        # The HepMC goes straight into Delphes on the worker,
+                        # output dir as for submit_delphes_jobs_htcondor.py
+                        delphes_name = out_name.split('.hepmc')[0] + '.root'
+                        delphes_card = os.path.splitext(os.path.basename(args.delphes))[0]
+                        job_opts.extend(['--delphes', 'delphes_card.tcl', delphes_name])
+                        if args.keepHepMC:
+                            job_opts.append('--keepHepMC')
+                        else:
+                            outputs = []
+                        outputs.append(('root', delphes_name,
+                                        os.path.join(args.oDir, 'delphes', delphes_card),
+                                        'Delphes', catalog.card_hash([args.card, args.delphes])))
+
                     # transfer to hdfs after generating, to a subfolder
                     # depending on filetype
-                    oDir_fmt = os.path.join(args.oDir, fmt)
-                    check_create_dir(oDir_fmt)
-                    job_opts.extend(['--copyFromLocal', out_name, oDir_fmt])
+                    for out_fmt, out_file, out_dir, generator, out_hash in outputs:
+                        if store:
+                            store.queue_mkdir([out_dir])
+                        else:
+                            check_create_dir(out_dir)
+                        job_opts.extend(['--copyFromLocal', out_file, out_dir])
+                        node_outputs[job_name].append(os.path.join(out_dir, out_file))
+
+                        if cat:
+                            cat.register(os.path.join(out_dir, out_file),
+                                         generator=generator, channel=args.channel,
+                                         mass=float(mass) if mass else None,
+                                         energy=args.energy, seed=job_ind,
+                                         n_events=int(n_events), format=out_fmt,
+                                         card_hash=out_hash, status='pending')
+
+            if cat:
+                job_opts.extend(['--catalog', cat.filename])
 
             job_opts.append('--args')
             job_opts.extend(exe_args)
             log.debug('job_opts: %s' % job_opts)
             log_name = os.path.splitext(os.path.basename(dag_filename))[0]
             dag_file.write('VARS %s ' % job_name)
-            dag_file.write('opts="%s" logdir="%s" logfile="%s"\n' % (' '.join(job_opts),
-                                                                     log_dir,
-                                                                     log_name))
+            dag_file.write('opts="%s" logdir="%s" logfile="%s" cpus="%d"\n' % (' '.join(job_opts),
+                                                                               log_dir,
+                                                                               log_name,
+                                                                               args.cpus))
         dag_file.write('NODE_STATUS_FILE %s 30\n' % status_filename)
+    return node_outputs
 
 
 def check_create_dir(directory):
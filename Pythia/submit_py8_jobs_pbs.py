@@ -171,9 +171,9 @@ def submit_mc_jobs_pbs(in_args=sys.argv[1:]):
 
         # Set mass in args
         if '--mass' in exe_args:
-            set_option_in_args(exe_args, '--mass', str(mass))
+            set_option_in_args(exe_args, '--mass', mass_str)
         else:
-            exe_args.extend(['--mass', mass])
+            exe_args.extend(['--mass', mass_str])
 
         # Set filenames in args. Ensures seed and output directory
         # added to filenames.
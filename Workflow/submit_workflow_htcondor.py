@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+"""
+Submit the whole Pythia8 -> Delphes -> MadAnalysis chain to HTCondor as
+one DAG, so each stage starts as soon as its own inputs are ready, rather
+than waiting for the whole of the previous stage to finish.
+
+- each Pythia8 job makes a HepMC file,
+- each Delphes job runs over the HepMC files of --filesPerDelphesJob Pythia8
+  jobs of the same channel & mass, and starts as soon as they have finished,
+- (optionally) MadAnalysis runs over each channel & mass as soon as all of
+  its Delphes jobs have finished.
+
+The DAG for each stage is made by the usual submit script for that stage
+(submit_py8_jobs_htcondor.py, submit_delphes_jobs_htcondor.py, and
+run_ma.write_dag_file()), which are then joined into one DAG, with the node
+names prefixed by the stage, and PARENT/CHILD lines linking each node to
+those that make its input files, using the files for each node returned by
+the stage's write_dag_file().
+
+The options are as for submit_py8_jobs_htcondor.py, with paths relative to
+the Pythia directory, plus the Delphes card (relative to the Delphes
+directory) and the MadAnalysis exe. e.g.:
+
+./submit_workflow_htcondor.py 1 10 --massRange 4 8 2 \\
+--delphesCard input_cards/delphes_card_CMS.tcl --maExe /users/<username>/ma5/MadAnalysis5Job \\
+--args --card input_cards/ggh125_2a_4tau.cmnd -n 10000 --hepmc
+
+Use --dry to make the DAGs without copying files or submitting.
+"""
+
+
+import os
+import sys
+import argparse
+import logging
+from time import strftime
+from subprocess import call
+from contextlib import contextmanager
+from collections import OrderedDict
+
+
+TOP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PYTHIA_DIR = os.path.join(TOP_DIR, 'Pythia')
+DELPHES_DIR = os.path.join(TOP_DIR, 'Delphes')
+MA_DIR = os.path.join(TOP_DIR, 'MadAnalysis')
+for stage_dir in [PYTHIA_DIR, DELPHES_DIR, MA_DIR, os.path.join(TOP_DIR, 'common')]:
+    sys.path.insert(0, stage_dir)
+import submit_py8_jobs_htcondor as py8
+import submit_delphes_jobs_htcondor as delphes
+import run_ma
+import catalog
+
+
+logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+log = logging.getLogger(__name__)
+
+
+# Prefixes for node names from each stage, to keep them unique
+PY8_PREFIX = 'py8_'
+DELPHES_PREFIX = 'delphes_'
+MA_PREFIX = 'ana_'
+
+
+def submit_workflow_htcondor(in_args=sys.argv[1:]):
+    """Main function"""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("jobIdRange",
+                        help="Pythia8 job ID range, as for submit_py8_jobs_htcondor.py",
+                        nargs=2, type=int)
+    parser.add_argument("--oDir",
+                        help="Directory for Pythia8 output, as for submit_py8_jobs_htcondor.py",
+                        default="")
+    parser.add_argument("--exe",
+                        help="Pythia8 executable to run.",
+                        default="generateMC.exe")
+    parser.add_argument("--massRange",
+                        help="Mass range to run over, as for submit_py8_jobs_htcondor.py",
+                        nargs=3, type=float,
+                        metavar=('startMass', 'endMass', 'massStep'))
+    parser.add_argument("--delphesCard",
+                        required=True,
+                        help="Delphes card, relative to the Delphes directory")
+    parser.add_argument("--filesPerDelphesJob",
+                        help="Number of HepMC files for each Delphes job",
+                        type=int, default=1)
+    parser.add_argument("--maExe",
+                        help="MadAnalysis executable. If not specified, "
+                        "MadAnalysis is not run.")
+    parser.add_argument("--wDir",
+                        help="Directory for the workflow DAG, MadAnalysis filelists "
+                        "and output. Defaults to workflows/<date>_<time>",
+                        default=os.path.join('workflows', strftime("%d_%b_%y_%H%M%S")))
+    parser.add_argument("--catalog",
+                        help="Catalog file to register output files in. "
+                        "Defaults to $%s, or %s" % (catalog.CATALOG_ENV, catalog.DEFAULT_CATALOG))
+    parser.add_argument("--args",
+                        help="All other Pythia8 program arguments. "
+                        "You MUST specify this after all other options",
+                        nargs=argparse.REMAINDER, default=[])
+    parser.add_argument("--dry",
+                        help="Dry run, don't copy files or submit to queue.",
+                        action='store_true')
+    parser.add_argument("-v",
+                        help="Display debug messages.",
+                        action='store_true')
+    args = parser.parse_args(args=in_args)
+
+    if args.v:
+        log.setLevel(logging.DEBUG)
+
+    if args.filesPerDelphesJob < 1:
+        raise RuntimeError('--filesPerDelphesJob must be >= 1')
+    if args.maExe and not os.path.isfile(args.maExe):
+        raise RuntimeError('MadAnalysis exe %s does not exist' % args.maExe)
+
+    w_dir = os.path.abspath(args.wDir)
+    py8.check_create_dir(w_dir)
+    common_opts = ['--dry'] if args.dry else ['--noSubmit']
+    if args.v:
+        common_opts.append('-v')
+    if args.catalog:
+        common_opts.extend(['--catalog', os.path.abspath(args.catalog)])
+
+    # Pythia8 stage: one job per seed & mass, making a HepMC file each
+    # -------------------------------------------------------------------------
+    pythia_args = [str(x) for x in args.jobIdRange] + common_opts + ['--exe', args.exe]
+    if args.oDir:
+        pythia_args.extend(['--oDir', args.oDir])
+    if args.massRange:
+        pythia_args.extend(['--massRange'] + ['%g' % x for x in args.massRange])
+    if '--hepmc' not in args.args:
+        args.args.append('--hepmc')
+    pythia_args.extend(['--args'] + args.args)
+    log.info('>>> Pythia8 stage')
+    with working_dir(PYTHIA_DIR):
+        py8_dags = py8.submit_mc_jobs_htcondor(pythia_args)
+
+    # which node makes each HepMC file. Each mass has its own DAG with the
+    # same node names, so they get the DAG name as well, e.g. py8_ma4_1_<card>.
+    # The HepMC files of each DAG (i.e. channel & mass) are kept together,
+    # so a Delphes job never mixes samples
+    stage_dags = []
+    hepmc_nodes = OrderedDict()
+    hepmc_groups = []
+    for dag, node_outputs in py8_dags.iteritems():
+        dag = os.path.join(PYTHIA_DIR, dag)
+        prefix = '%s%s_' % (PY8_PREFIX, os.path.basename(dag).split('_')[0])
+        stage_dags.append((dag, prefix, PYTHIA_DIR))
+        group = []
+        for node, outputs in node_outputs.iteritems():
+            for out_file in outputs:
+                if '.hepmc' in os.path.basename(out_file):
+                    hepmc_nodes[out_file] = prefix + node
+                    group.append(out_file)
+        if group:
+            hepmc_groups.append(group)
+    if not hepmc_nodes:
+        raise RuntimeError('No HepMC files made by the Pythia8 stage')
+
+    # Delphes stage: each job waits for the jobs making its input files
+    # -------------------------------------------------------------------------
+    log.info('>>> Delphes stage')
+    delphes_args = common_opts + ['--card', args.delphesCard, '--type', 'hepmc',
+                                  '--filesPerJob', str(args.filesPerDelphesJob)]
+    for group in hepmc_groups:
+        delphes_args.extend(['--inputFiles'] + group)
+    with working_dir(DELPHES_DIR):
+        delphes_dag, delphes_nodes = delphes.submit_delphes_jobs_htcondor(delphes_args)
+    delphes_dag = os.path.join(DELPHES_DIR, delphes_dag)
+
+    dependencies = []
+    root_nodes = OrderedDict()
+    for node, files in delphes_nodes.iteritems():
+        parents = []
+        for in_file, out_file in files:
+            parents.append(hepmc_nodes[in_file])
+            root_nodes[out_file] = DELPHES_PREFIX + node
+        dependencies.append((parents, [DELPHES_PREFIX + node]))
+
+    stage_dags.append((delphes_dag, DELPHES_PREFIX, DELPHES_DIR))
+
+    # MadAnalysis stage: one job per channel & mass, waiting for all its
+    # Delphes jobs
+    # -------------------------------------------------------------------------
+    if args.maExe:
+        log.info('>>> MadAnalysis stage')
+        filelists, filelist_files = write_filelists(root_nodes.keys(),
+                                                    os.path.join(w_dir, 'filelists'))
+        ma_dag = os.path.join(w_dir, 'madanalysis.dag')
+        ma_log_dir = os.path.join(w_dir, 'logs')
+        py8.check_create_dir(ma_log_dir)
+        ma_nodes = run_ma.write_dag_file(dag_filename=ma_dag,
+                                         status_filename=os.path.join(w_dir, 'madanalysis.status'),
+                                         log_dir=ma_log_dir, filelists=filelists,
+                                         exe=os.path.abspath(args.maExe),
+                                         run_dir=os.path.join(w_dir, 'run_dir'))
+        for node, flist in ma_nodes.iteritems():
+            parents = set(root_nodes[f] for f in filelist_files[flist])
+            dependencies.append((sorted(parents), [MA_PREFIX + node]))
+        stage_dags.append((ma_dag, MA_PREFIX, MA_DIR))
+
+    # Join them into one DAG
+    # -------------------------------------------------------------------------
+    dag_name = os.path.join(w_dir, 'workflow.dag')
+    status_name = os.path.join(w_dir, 'workflow.status')
+    write_workflow_dag(dag_name, status_name, stage_dags, dependencies)
+
+    if args.dry:
+        log.warning('Dry run - not submitting jobs or copying files.')
+    else:
+        call(['condor_submit_dag', dag_name])
+        log.info('Check status with:')
+        log.info('DAGstatus.py %s' % status_name)
+    return dag_name
+
+
+@contextmanager
+def working_dir(directory):
+    """Run a block of code in directory, since each stage's submit script
+    expects to be run from its own directory."""
+    old_dir = os.getcwd()
+    os.chdir(directory)
+    try:
+        yield
+    finally:
+        os.chdir(old_dir)
+
+
+def write_filelists(root_files, out_dir):
+    """Write a MadAnalysis filelist for each channel & mass, with the files
+    that the Delphes jobs will make.
+
+    Returns an OrderedDict of {<channel>_ma1_<mass>: [filelist filename]},
+    as from run_ma.generate_filelists(), and a dict of
+    {filelist filename: [ROOT files]}.
+    """
+    py8.check_create_dir(out_dir)
+    samples = OrderedDict()
+    for filename in root_files:
+        info = catalog.parse_filename(filename)
+        if info.get('mass') is not None:
+            name = '%s_ma1_%g' % (info['channel'], info['mass'])
+        else:
+            name = info.get('channel', 'unknown')
+        samples.setdefault(name, []).append(filename)
+
+    filelists = OrderedDict()
+    filelist_files = {}
+    for name, files in samples.iteritems():
+        flist = os.path.join(out_dir, name)
+        with open(flist, 'w') as f:
+            f.write('\n'.join(files) + '\n')
+        filelists[name] = [flist]
+        filelist_files[flist] = files
+    return filelists, filelist_files
+
+
+def prefix_dag_line(line, prefix, stage_dir):
+    """Modify a line from a stage DAG file for the workflow DAG.
+
+    Node names are prefixed, JOB lines are given the stage directory (as the
+    condor job files are relative to it), and NODE_STATUS_FILE lines are
+    removed, since the workflow has its own.
+
+    Returns the modified line, or None if it should be removed.
+    """
+    parts = line.split()
+    if not parts or parts[0].startswith('#'):
+        return line.rstrip('\n')
+    keyword = parts[0]
+    if keyword == 'NODE_STATUS_FILE':
+        return None
+    if keyword == 'JOB':
+        parts[1] = prefix + parts[1]
+        if 'DIR' not in parts[3:]:
+            parts.extend(['DIR', stage_dir])
+        return ' '.join(parts)
+    if keyword == 'VARS':
+        # keep the original spacing & quoting of the values
+        _, node, values = line.rstrip('\n').split(' ', 2)
+        return ' '.join([keyword, prefix + node, values])
+    if keyword == 'PARENT':
+        return ' '.join(p if p in ['PARENT', 'CHILD'] else prefix + p for p in parts)
+    return line.rstrip('\n')
+
+
+def write_workflow_dag(dag_filename, status_filename, stage_dags, dependencies):
+    """Join the stage DAGs into one workflow DAG.
+
+    dag_filename: str
+        Name of the workflow DAG file.
+    status_filename: str
+        Name to be used for the DAG status file.
+    stage_dags: list[(str, str, str)]
+        DAG filename, node name prefix, and directory for each stage DAG.
+    dependencies: list[(list[str], list[str])]
+        Parent & child node names (with prefixes) for the links between stages.
+    """
+    log.info("DAG file: %s" % dag_filename)
+    with open(dag_filename, 'w') as dag_file:
+        dag_file.write('# Workflow DAG, made by %s\n' % os.path.basename(__file__))
+        for stage_dag, prefix, stage_dir in stage_dags:
+            dag_file.write('# From %s\n' % stage_dag)
+            with open(stage_dag) as f:
+                for line in f:
+                    new_line = prefix_dag_line(line, prefix, stage_dir)
+                    if new_line is not None:
+                        dag_file.write(new_line + '\n')
+        dag_file.write('# Links between stages\n')
+        for parents, children in dependencies:
+            if parents and children:
+                dag_file.write('PARENT %s CHILD %s\n' % (' '.join(parents), ' '.join(children)))
+        dag_file.write('NODE_STATUS_FILE %s 30\n' % status_filename)
+
+
+if __name__ == "__main__":
+    submit_workflow_htcondor()
@@ -0,0 +1,542 @@
+#!/usr/bin/env python
+"""
+Time the tooling itself (not the physics programs): writing DAGs and
+submitting jobs, making MG5 cards, making MadAnalysis filelists, and the
+stage-in & stage-out done by the worker scripts, for increasing numbers of jobs.
+
+Everything runs on synthetic fixtures in a temporary directory:
+fake cards & executables, and a directory standing in for /hdfs.
+The scripts in shims/ are put first in PATH, so `hadoop` copies to & from
+that directory, and `condor_submit_dag` & `qsub` don't submit anything.
+Python code that creates directories or copies files under /hdfs directly
+is redirected there as well.
+
+The storage backend (see common/storage.py) is chosen with --storage.
+For webhdfs, shims/webhdfs_server.py serves the fake /hdfs.
+
+Each benchmark is run --repeat times, and the fastest time is kept, along
+with the number of hadoop calls (each a JVM launch on the cluster).
+Results are appended to a history file, and compared to the best previous
+result on the same machine & storage backend, to catch regressions.
+
+e.g.:
+./run_benchmarks.py --sizes 10 100 1000
+
+./run_benchmarks.py --only py8_htcondor delphes_htcondor --noSave
+
+./run_benchmarks.py --only py8_worker --storage webhdfs
+"""
+
+
+import os
+import sys
+import imp
+import json
+import time
+import shutil
+import socket
+import getpass
+import logging
+import argparse
+import tempfile
+from subprocess import check_output, CalledProcessError
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+log = logging.getLogger(__name__)
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+SHIM_DIR = os.path.join(BENCH_DIR, 'shims')
+DEFAULT_HISTORY = os.path.join(BENCH_DIR, 'history.json')
+
+# The submitters need LOGNAME when they are imported
+os.environ.setdefault('LOGNAME', getpass.getuser())
+for subdir in ['common', 'Pythia', 'MG5_aMC', 'Delphes', 'MadAnalysis']:
+    sys.path.insert(0, os.path.join(REPO_DIR, subdir))
+import catalog
+import storage
+import submit_py8_jobs_htcondor as py8_htcondor
+import submit_py8_jobs_pbs as py8_pbs
+import submit_mg5_jobs_htcondor as mg5_htcondor
+import submit_delphes_jobs_htcondor as delphes_htcondor
+import run_mg5
+import run_ma
+py8_worker = imp.load_source('py8_mcJob', os.path.join(REPO_DIR, 'Pythia', 'HTCondor', 'mcJob.py'))
+
+
+FAKE_USER = 'bench'
+
+MG5_CARD = """set automatic_html_opening False
+set pythia8_path /users/$LOGNAME/Pythia8/pythia8212
+generate p p > b b~ [QCD]
+output pp13_bench
+launch
+  set run_card nevents 200
+  set run_card parton_shower PYTHIA8
+  set run_card ebeam1 6500
+  set run_card ebeam2 6500
+  set run_card iseed 0
+  set shower_card extralibs dl
+  set shower_card extrapaths ../lib /users/$LOGNAME/HepMC/install/lib
+  set shower_card includepaths /users/$LOGNAME/HepMC/install/include
+"""
+
+PY8_CARD = """Main:numberOfEvents = 100
+Beams:eCM = 13000.
+HiggsSM:gg2H = on
+"""
+
+# Makes the files given in its args, each of a given size
+FAKE_EXE = """#!/bin/sh
+size=$1
+shift
+for f in "$@"; do
+    head -c $size /dev/zero > $f
+done
+"""
+
+
+def run_benchmarks(in_args=sys.argv[1:]):
+    """Main function"""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes',
+                        nargs='+',
+                        type=int,
+                        default=[10, 100, 1000],
+                        help='Numbers of jobs to benchmark the submitters with')
+    parser.add_argument('--workerSizes',
+                        nargs='+',
+                        type=int,
+                        default=[1, 10, 50],
+                        help='Numbers of files to stage in & out in the worker benchmark')
+    parser.add_argument('--fileSize',
+                        type=int,
+                        default=1024 * 1024,
+                        help='Size of each file staged in & out by the worker, in bytes')
+    parser.add_argument('--only',
+                        nargs='+',
+                        choices=BENCHMARKS.keys(),
+                        help='Only run these benchmarks')
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=3,
+                        help='Number of times to run each benchmark. The fastest is kept.')
+    parser.add_argument('--hadoopLatency',
+                        type=float,
+                        default=0.,
+                        help='Seconds the fake hadoop command sleeps for on each call, '
+                        'to mimic the JVM startup time')
+    parser.add_argument('--storage',
+                        choices=sorted(storage.BACKENDS.keys()),
+                        default=storage.DEFAULT_BACKEND,
+                        help='Storage backend for the scripts to use')
+    parser.add_argument('--history',
+                        default=DEFAULT_HISTORY,
+                        help='JSON file to store results in')
+    parser.add_argument('--noSave',
+                        action='store_true',
+                        help="Don't add the results to the history file")
+    parser.add_argument('--tolerance',
+                        type=float,
+                        default=0.5,
+                        help='Fractional slowdown w.r.t. the best previous result '
+                        'that counts as a regression')
+    parser.add_argument('--minDiff',
+                        type=float,
+                        default=0.05,
+                        help='Ignore slowdowns smaller than this many seconds')
+    parser.add_argument('--keep',
+                        action='store_true',
+                        help="Don't delete the directory with the fixtures & outputs")
+    parser.add_argument("-v",
+                        help="Display debug messages.",
+                        action='store_true')
+    args = parser.parse_args(args=in_args)
+
+    if args.v:
+        log.setLevel(logging.DEBUG)
+
+    if args.repeat < 1:
+        raise RuntimeError('--repeat must be >= 1')
+    if any(n < 1 for n in args.sizes + args.workerSizes):
+        raise RuntimeError('Sizes must be >= 1')
+
+    names = args.only or BENCHMARKS.keys()
+    work_dir = tempfile.mkdtemp(prefix='nmssm_bench_')
+    log.info('Fixtures & outputs in %s' % work_dir)
+    results = OrderedDict()
+    try:
+        fix = Fixtures(work_dir, args.fileSize)
+        with fix.environment(args.hadoopLatency, args.storage):
+            for name in names:
+                results[name] = OrderedDict()
+                sizes = args.workerSizes if name == 'py8_worker' else args.sizes
+                for size in sizes:
+                    seconds, hadoop_calls = time_benchmark(fix, name, size, args.repeat)
+                    results[name][str(size)] = {'seconds': seconds, 'hadoop_calls': hadoop_calls}
+    finally:
+        if args.keep:
+            log.info('Kept %s' % work_dir)
+        else:
+            shutil.rmtree(work_dir)
+
+    history = load_history(args.history)
+    run = {'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+           'commit': get_commit(),
+           'host': socket.gethostname(),
+           'storage': args.storage,
+           'results': results}
+    regressions = print_results(run, history, args.tolerance, args.minDiff)
+
+    if not args.noSave:
+        history.append(run)
+        with open(args.history, 'w') as jfile:
+            json.dump(history, jfile, indent=2)
+        log.info('Results added to %s' % args.history)
+
+    if regressions:
+        log.error('%d regression(s) found' % len(regressions))
+        sys.exit(1)
+    return run
+
+
+class Fixtures(object):
+    """Synthetic inputs for the benchmarks, and the fake /hdfs.
+
+    work_dir: str
+        Directory to put everything in.
+    file_size: int
+        Size of each file the fake executable makes, in bytes.
+    """
+
+    def __init__(self, work_dir, file_size):
+        self.work_dir = work_dir
+        self.file_size = file_size
+        self.hdfs_root = os.path.join(work_dir, 'hdfs')
+        self.hdfs_user = '/hdfs/user/%s/NMSSMPheno' % FAKE_USER
+        os.makedirs(self.hdfs_root)
+        self.catalog = os.path.join(work_dir, 'catalog.sqlite')
+
+        # Installations that get tarred up & copied to /hdfs
+        self.mg5_dir = os.path.join(work_dir, 'MG5_aMC', 'MG5_aMC_v2_3_3')
+        self.delphes_dir = os.path.join(work_dir, 'delphes')
+        for install in [self.mg5_dir, self.delphes_dir]:
+            os.makedirs(install)
+            write_file(os.path.join(install, 'README'), 'Fake installation\n')
+
+        self.exe = os.path.join(work_dir, 'fake.exe')
+        write_file(self.exe, FAKE_EXE)
+        os.chmod(self.exe, 0755)
+
+    def hdfs_path(self, path):
+        """Map a path on /hdfs to the fake /hdfs directory"""
+        if path == '/hdfs' or path.startswith('/hdfs/'):
+            return self.hdfs_root + path[len('/hdfs'):]
+        return path
+
+    @contextmanager
+    def environment(self, hadoop_latency=0., backend=storage.DEFAULT_BACKEND):
+        """Put the shims in PATH, point the storage backend at the fake /hdfs,
+        and redirect python code that works on /hdfs directly there too."""
+        env_vars = ['PATH', 'FAKE_HDFS_ROOT', 'FAKE_HADOOP_LATENCY',
+                    storage.STORAGE_ENV, storage.HDFS_ROOT_ENV, storage.WEBHDFS_ENV]
+        old_env = {k: os.environ.get(k) for k in env_vars}
+        os.environ['PATH'] = SHIM_DIR + os.pathsep + os.environ['PATH']
+        os.environ['FAKE_HDFS_ROOT'] = self.hdfs_root
+        os.environ['FAKE_HADOOP_LATENCY'] = str(hadoop_latency)
+        os.environ[storage.STORAGE_ENV] = backend
+        os.environ[storage.HDFS_ROOT_ENV] = self.hdfs_root
+        server = None
+        if backend == 'webhdfs':
+            webhdfs_server = imp.load_source('webhdfs_server', os.path.join(SHIM_DIR, 'webhdfs_server.py'))
+            server, os.environ[storage.WEBHDFS_ENV] = webhdfs_server.start_server(self.hdfs_root)
+
+        # (object, attribute, replacement), to undo afterwards
+        patches = [(shutil, 'copy2', self._redirect(shutil.copy2, 2))]
+        for module in [py8_htcondor, mg5_htcondor, delphes_htcondor]:
+            patches.append((module, 'check_create_dir', self._redirect(module.check_create_dir, 1)))
+        originals = [(obj, attr, getattr(obj, attr)) for obj, attr, _ in patches]
+        for obj, attr, new in patches:
+            setattr(obj, attr, new)
+        try:
+            yield
+        finally:
+            if server:
+                server.shutdown()
+            for obj, attr, old in originals:
+                setattr(obj, attr, old)
+            for key, value in old_env.iteritems():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+
+    def _redirect(self, func, n_paths):
+        """Wrap func so that its first n_paths args are mapped with hdfs_path()"""
+        def wrapper(*args, **kwargs):
+            args = [self.hdfs_path(a) for a in args[:n_paths]] + list(args[n_paths:])
+            return func(*args, **kwargs)
+        return wrapper
+
+    def hadoop_calls(self):
+        """Number of times the fake hadoop has been called so far"""
+        call_log = os.path.join(self.hdfs_root, '.hadoop_calls')
+        if not os.path.isfile(call_log):
+            return 0
+        with open(call_log) as f:
+            return sum(1 for _ in f)
+
+    def make_hdfs_files(self, directory, names):
+        """Make (empty) files on the fake /hdfs, return their /hdfs paths"""
+        check_create_dir(self.hdfs_path(directory))
+        paths = [os.path.join(directory, name) for name in names]
+        for path in paths:
+            write_file(self.hdfs_path(path), '')
+        return paths
+
+    def make_run_dir(self, name, size):
+        """Make a fresh directory to run a benchmark in, like a checkout
+        of the repository with the cards etc that the scripts expect."""
+        run_dir = os.path.join(self.work_dir, 'run', '%s_%d' % (name, size))
+        os.makedirs(os.path.join(run_dir, 'input_cards'))
+        write_file(os.path.join(run_dir, 'input_cards', 'ggh125_bench.cmnd'), PY8_CARD)
+        write_file(os.path.join(run_dir, 'input_cards', 'pp13_bench.txt'), MG5_CARD)
+        write_file(os.path.join(run_dir, 'input_cards', 'delphes_card_bench.tcl'), '# Fake card\n')
+        write_file(os.path.join(run_dir, 'run_mg5.py'), '# Fake script\n')
+        os.makedirs(os.path.join(run_dir, 'PBS'))
+        write_file(os.path.join(run_dir, 'PBS', 'mcJob.sh'), '# Fake script\n')
+        shutil.copy2(self.exe, os.path.join(run_dir, 'generateMC.exe'))
+        return run_dir
+
+
+def bench_py8_htcondor(fix, size):
+    """Pythia8 HTCondor submitter, size jobs with HepMC, LHE & ROOT outputs"""
+    def run():
+        py8_htcondor.submit_mc_jobs_htcondor([
+            '1', str(size), '--oDir', fix.hdfs_user + '/Pythia8/bench', '--catalog', fix.catalog,
+            '--args', '--card', 'input_cards/ggh125_bench.cmnd', '-n', '100', '--mass', '8',
+            '--hepmc', '--lhe', '--root'])
+    return run
+
+
+def bench_py8_pbs(fix, size):
+    """Pythia8 PBS submitter, 10 jobs for each of size mass points"""
+    def run():
+        py8_pbs.submit_mc_jobs_pbs([
+            '1', '10', '--oDir', os.path.join(fix.work_dir, 'scratch'),
+            '--massRange', '1', str(size), '1',
+            '--args', '--card', 'input_cards/ggh125_bench.cmnd', '-n', '100', '--hepmc'])
+    return run
+
+
+def bench_mg5_htcondor(fix, size):
+    """MG5_aMC HTCondor submitter, size jobs"""
+    def run():
+        mg5_htcondor.submit_mc_jobs_htcondor([
+            '1', str(size), '--oDir', fix.hdfs_user + '/MG5_aMC/bench', '--catalog', fix.catalog,
+            '--args', 'input_cards/pp13_bench.txt', '-n', '100',
+            '--pythia8', '/users/bench/Pythia8', '--hepmc', '/users/bench/HepMC'],
+            mg5_dir=fix.mg5_dir)
+    return run
+
+
+def bench_mg5_cards(fix, size):
+    """Make MG5_aMC cards for size seeds, as run_mg5.py --seeds does"""
+    def run():
+        run_mg5.run_mg5(['input_cards/pp13_bench.txt', '--seeds', '1', str(size), '--dry',
+                         '-n', '100', '--pythia8', '/users/bench/Pythia8',
+                         '--hepmc', '/users/bench/HepMC'])
+    return run
+
+
+def bench_delphes_htcondor(fix, size):
+    """Delphes HTCondor submitter, size jobs of 2 HepMC files each, found by listing --iDir"""
+    in_dir = '%s/Pythia8/delphes_input_%d/hepmc' % (fix.hdfs_user, size)
+    fix.make_hdfs_files(in_dir, ['bench_ma1_8_13TeV_n100_seed%d.hepmc.gz' % i
+                                 for i in xrange(1, 2 * size + 1)])
+
+    def run():
+        delphes_htcondor.submit_delphes_jobs_htcondor([
+            '--card', 'input_cards/delphes_card_bench.tcl', '--iDir', fix.hdfs_path(in_dir),
+            '--oDir', fix.hdfs_user + '/Delphes/bench', '--catalog', fix.catalog],
+            delphes_dir=fix.delphes_dir)
+    return run
+
+
+def make_samples(fix, size, use_catalog):
+    """Make 5 channels of size ROOT files each, on the fake /hdfs,
+    optionally registered in the catalog.
+    Returns the samples dict and catalog to use."""
+    samples = {}
+    cat = catalog.Catalog(os.path.join(fix.work_dir, 'ma_catalog_%d.sqlite' % size)) if use_catalog else None
+    for ind in xrange(5):
+        channel = 'chan%d_%d' % (ind, size)
+        directory = '%s/Pythia8/%s/delphes' % (fix.hdfs_user, channel)
+        paths = fix.make_hdfs_files(directory, ['%s_ma1_8_13TeV_n100_seed%d.root' % (channel, i)
+                                               for i in xrange(1, size + 1)])
+        samples[channel] = {'num': -1, 'dirs': [fix.hdfs_path(directory)]}
+        if cat:
+            for path in paths:
+                cat.register(fix.hdfs_path(path), status='done')
+    return samples, cat
+
+
+def bench_ma_filelists(fix, size):
+    """run_ma.generate_filelists(), 5 channels of size files each, found by listing directories"""
+    samples, _ = make_samples(fix, size, False)
+    return lambda: run_ma.generate_filelists(samples, os.getcwd())
+
+
+def bench_ma_filelists_catalog(fix, size):
+    """run_ma.generate_filelists(), 5 channels of size files each, found in the catalog"""
+    samples, cat = make_samples(fix, size, True)
+    return lambda: run_ma.generate_filelists(samples, os.getcwd(), cat=cat)
+
+
+def bench_py8_worker(fix, size):
+    """Pythia8 worker script: stage in size files from /hdfs, make size output
+    files & copy them back to /hdfs"""
+    in_dir = '%s/worker_input_%d' % (fix.hdfs_user, size)
+    out_dir = '%s/worker_output_%d' % (fix.hdfs_user, size)
+    check_create_dir(fix.hdfs_path(out_dir))
+    inputs = fix.make_hdfs_files(in_dir, ['input%d.dat' % i for i in xrange(size)])
+    outputs = ['output%d.dat' % i for i in xrange(size)]
+    opts = ['--copyToLocal', fix.exe, 'mc.exe', '--exe', 'mc.exe']
+    for ind, path in enumerate(inputs):
+        opts.extend(['--copyToLocal', path, 'input%d.dat' % ind])
+    for name in outputs:
+        opts.extend(['--copyFromLocal', name, out_dir])
+    opts.append('--args')
+    opts.append(str(fix.file_size))
+    opts.extend(outputs)
+
+    def run():
+        # the worker moves into scratch/, time_benchmark() moves back out
+        if os.path.isdir('scratch'):
+            shutil.rmtree('scratch')
+        py8_worker.main(opts)
+    return run
+
+
+BENCHMARKS = OrderedDict([
+    ('py8_htcondor', bench_py8_htcondor),
+    ('py8_pbs', bench_py8_pbs),
+    ('mg5_htcondor', bench_mg5_htcondor),
+    ('mg5_cards', bench_mg5_cards),
+    ('delphes_htcondor', bench_delphes_htcondor),
+    ('ma_filelists', bench_ma_filelists),
+    ('ma_filelists_catalog', bench_ma_filelists_catalog),
+    ('py8_worker', bench_py8_worker),
+])
+
+
+def time_benchmark(fix, name, size, repeat):
+    """Run a benchmark repeat times, in its own directory.
+
+    Returns the fastest time, and the number of hadoop calls per run.
+    """
+    old_dir = os.getcwd()
+    run_dir = fix.make_run_dir(name, size)
+    os.chdir(run_dir)
+    times = []
+    try:
+        func = BENCHMARKS[name](fix, size)
+        calls_before = fix.hadoop_calls()
+        for _ in xrange(repeat):
+            with quiet():
+                start = time.time()
+                func()
+                times.append(time.time() - start)
+            os.chdir(run_dir)
+        hadoop_calls = (fix.hadoop_calls() - calls_before) // repeat
+    finally:
+        os.chdir(old_dir)
+    log.info('%-22s %6d: %8.3f s, %d hadoop calls' % (name, size, min(times), hadoop_calls))
+    return min(times), hadoop_calls
+
+
+@contextmanager
+def quiet():
+    """Hide the logging & printing of the code being timed,
+    including the output of any commands it calls"""
+    logging.disable(logging.WARNING)
+    sys.stdout.flush()
+    old_stdout = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(old_stdout, 1)
+        os.close(old_stdout)
+        os.close(devnull)
+        logging.disable(logging.NOTSET)
+
+
+def load_history(filename):
+    """Get the list of previous runs from the history file"""
+    if not os.path.isfile(filename):
+        return []
+    with open(filename) as jfile:
+        return json.load(jfile)
+
+
+def get_best_previous(history, host, backend, name, size):
+    """Get the fastest previous time for a benchmark on a host
+    with a storage backend, or None"""
+    times = [run['results'][name][size]['seconds'] for run in history
+             if run['host'] == host and run.get('storage', storage.DEFAULT_BACKEND) == backend
+             and size in run['results'].get(name, {})]
+    return min(times) if times else None
+
+
+def print_results(run, history, tolerance, min_diff):
+    """Print results, compared to the best previous results on the same host
+    & storage backend.
+
+    Returns a list of (benchmark, size) that have regressed.
+    """
+    regressions = []
+    print '%-22s %6s %10s %10s %8s %8s' % ('Benchmark', 'Size', 'Time [s]', 'Best [s]', 'Ratio', 'hadoop')
+    for name, sizes in run['results'].iteritems():
+        for size, result in sizes.iteritems():
+            best = get_best_previous(history, run['host'], run['storage'], name, size)
+            ratio = result['seconds'] / best if best else None
+            flag = ''
+            if best and result['seconds'] > best * (1 + tolerance) and result['seconds'] - best > min_diff:
+                flag = '  <-- REGRESSION'
+                regressions.append((name, size))
+            print '%-22s %6s %10.3f %10s %8s %8d%s' % (name, size, result['seconds'],
+                                                       '%.3f' % best if best else '-',
+                                                       '%.2f' % ratio if ratio else '-',
+                                                       result['hadoop_calls'], flag)
+    return regressions
+
+
+def get_commit():
+    """Current git commit of the repository, or None"""
+    try:
+        return check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR).strip()
+    except (CalledProcessError, OSError):
+        return None
+
+
+def check_create_dir(directory):
+    """Check to see if directory exists, if not make it."""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+
+def write_file(filename, contents):
+    with open(filename, 'w') as f:
+        f.write(contents)
+
+
+if __name__ == "__main__":
+    run_benchmarks()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+"""
+Stand-in WebHDFS server, for testing the webhdfs backend of common/storage.py
+(and benchmarking it) away from the cluster.
+
+It serves a local directory as the root of HDFS, with the part of the
+WebHDFS REST API that storage.py uses: CREATE & OPEN (with the redirect to a
+"datanode", which is this server again), MKDIRS, LISTSTATUS, GETFILESTATUS
+and DELETE.
+
+e.g.:
+./webhdfs_server.py --root /tmp/fake_hdfs --port 50070 &
+NMSSMPHENO_STORAGE=webhdfs NMSSMPHENO_WEBHDFS=http://localhost:50070 ../../common/storage.py ls /hdfs/user
+"""
+
+
+import os
+import sys
+import json
+import shutil
+import urllib
+import argparse
+import threading
+import urlparse
+import SocketServer
+import BaseHTTPServer
+
+
+PREFIX = '/webhdfs/v1'
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def webhdfs_server(in_args=sys.argv[1:]):
+    """Main function"""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--root',
+                        required=True,
+                        help='Directory to serve as the root of HDFS')
+    parser.add_argument('--port',
+                        type=int,
+                        default=50070,
+                        help='Port to listen on')
+    args = parser.parse_args(args=in_args)
+    server = make_server(args.root, args.port)
+    print 'Serving %s at http://localhost:%d' % (args.root, server.server_address[1])
+    server.serve_forever()
+
+
+class WebHDFSServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def make_server(root, port=0):
+    """Make a server for the directory root. Port 0 picks a free port."""
+    if not os.path.isdir(root):
+        os.makedirs(root)
+
+    class Handler(WebHDFSHandler):
+        pass
+    Handler.root = os.path.abspath(root)
+    return WebHDFSServer(('localhost', port), Handler)
+
+
+def start_server(root, port=0):
+    """Start a server in a background thread.
+
+    Returns the server (call shutdown() to stop it) and its URL.
+    """
+    server = make_server(root, port)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://localhost:%d' % server.server_address[1]
+
+
+class WebHDFSHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Handle WebHDFS requests, for files under root"""
+
+    root = None
+
+    def parse(self):
+        """Get the HDFS path, local path and query parameters of the request"""
+        parts = urlparse.urlsplit(self.path)
+        params = dict(urlparse.parse_qsl(parts.query))
+        path = urllib.unquote(parts.path)
+        if not path.startswith(PREFIX):
+            return None, None, params
+        hdfs_path = path[len(PREFIX):] or '/'
+        return hdfs_path, os.path.join(self.root, hdfs_path.lstrip('/')), params
+
+    def send_json(self, code, obj):
+        body = json.dumps(obj)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, code, exception, message):
+        self.send_json(code, {'RemoteException': {'exception': exception,
+                                                  'javaClassName': 'java.io.' + exception,
+                                                  'message': message}})
+
+    def redirect_to_data(self):
+        """Redirect to the same URL with data=true, as a namenode redirects to a datanode"""
+        self.send_response(307)
+        self.send_header('Location', 'http://%s:%d%s&data=true' % (self.server.server_address[0],
+                                                                    self.server.server_address[1],
+                                                                    self.path))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def file_status(self, local_path, suffix=''):
+        stat = os.stat(local_path)
+        is_dir = os.path.isdir(local_path)
+        return {'pathSuffix': suffix,
+                'type': 'DIRECTORY' if is_dir else 'FILE',
+                'length': 0 if is_dir else stat.st_size,
+                'modificationTime': int(stat.st_mtime * 1000),
+                'permission': oct(stat.st_mode & 0777)[1:],
+                'replication': 0 if is_dir else 1}
+
+    def do_GET(self):
+        hdfs_path, local_path, params = self.parse()
+        op = params.get('op', '').upper()
+        if hdfs_path is None:
+            return self.send_error_json(404, 'IllegalArgumentException', 'Not a WebHDFS path')
+        if not os.path.exists(local_path):
+            return self.send_error_json(404, 'FileNotFoundException', 'File %s does not exist.' % hdfs_path)
+        if op == 'GETFILESTATUS':
+            return self.send_json(200, {'FileStatus': self.file_status(local_path)})
+        if op == 'LISTSTATUS':
+            if os.path.isdir(local_path):
+                entries = [self.file_status(os.path.join(local_path, name), name)
+                           for name in sorted(os.listdir(local_path))]
+            else:
+                entries = [self.file_status(local_path)]
+            return self.send_json(200, {'FileStatuses': {'FileStatus': entries}})
+        if op == 'OPEN':
+            if os.path.isdir(local_path):
+                return self.send_error_json(400, 'FileNotFoundException', '%s is a directory' % hdfs_path)
+            if params.get('data') != 'true':
+                return self.redirect_to_data()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(os.path.getsize(local_path)))
+            self.end_headers()
+            with open(local_path, 'rb') as in_file:
+                shutil.copyfileobj(in_file, self.wfile, CHUNK_SIZE)
+            return
+        self.send_error_json(400, 'IllegalArgumentException', 'Unsupported GET op %s' % op)
+
+    def do_PUT(self):
+        hdfs_path, local_path, params = self.parse()
+        op = params.get('op', '').upper()
+        if hdfs_path is None:
+            return self.send_error_json(404, 'IllegalArgumentException', 'Not a WebHDFS path')
+        if op == 'MKDIRS':
+            if os.path.isfile(local_path):
+                return self.send_error_json(403, 'FileAlreadyExistsException', '%s is a file' % hdfs_path)
+            if not os.path.isdir(local_path):
+                os.makedirs(local_path)
+            return self.send_json(200, {'boolean': True})
+        if op == 'CREATE':
+            if params.get('data') != 'true':
+                return self.redirect_to_data()
+            if os.path.exists(local_path) and params.get('overwrite', 'false') != 'true':
+                return self.send_error_json(403, 'FileAlreadyExistsException', '%s already exists' % hdfs_path)
+            if not os.path.isdir(os.path.dirname(local_path)):
+                os.makedirs(os.path.dirname(local_path))
+            remaining = int(self.headers.get('Content-Length', 0))
+            with open(local_path, 'wb') as out_file:
+                while remaining > 0:
+                    block = self.rfile.read(min(CHUNK_SIZE, remaining))
+                    if not block:
+                        break
+                    out_file.write(block)
+                    remaining -= len(block)
+            self.send_response(201)
+            self.send_header('Location', 'hdfs://localhost%s' % hdfs_path)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_error_json(400, 'IllegalArgumentException', 'Unsupported PUT op %s' % op)
+
+    def do_DELETE(self):
+        hdfs_path, local_path, params = self.parse()
+        if hdfs_path is None or params.get('op', '').upper() != 'DELETE':
+            return self.send_error_json(400, 'IllegalArgumentException', 'Unsupported DELETE request')
+        if os.path.isdir(local_path):
+            if os.listdir(local_path) and params.get('recursive') != 'true':
+                return self.send_error_json(403, 'IOException', '%s is non empty' % hdfs_path)
+            shutil.rmtree(local_path)
+        elif os.path.exists(local_path):
+            os.remove(local_path)
+        else:
+            return self.send_json(200, {'boolean': False})
+        self.send_json(200, {'boolean': True})
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    webhdfs_server()
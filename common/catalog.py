@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+"""
+SQLite catalog of every file produced in the generation chain
+(Pythia8, MG5_aMC, Delphes), so that inputs can be found by querying,
+rather than walking directories on /hdfs.
+
+Each file has one row, keyed by its absolute path, with its channel, mass,
+energy, seed, number of events, format, size, checksum, the hash of the card
+that produced it, and a status ('pending' when a job is submitted,
+'done' once the worker has copied it to its final destination).
+
+The catalog filename is taken from (in order): the --catalog option,
+the NMSSMPHENO_CATALOG environment variable, or DEFAULT_CATALOG.
+It must be on a filesystem visible to the worker nodes (e.g. /users).
+
+Submitters register their outputs as pending, and pass --catalog to the
+worker scripts, which mark them as done. This file is transferred to the
+worker nodes with the job (see transfer_input_files in the .condor files).
+
+It can also be used from the command line, e.g. to list all finished
+HepMC files for a channel:
+
+./catalog.py query --channel ggh125_2a_4tau --format hepmc --status done
+
+or to add files that already exist on /hdfs:
+
+./catalog.py scan /hdfs/user/<username>/NMSSMPheno/Pythia8/13TeV/ggh125_2a_4tau/18_Nov_15/hepmc
+"""
+
+
+import os
+import re
+import sys
+import zlib
+import sqlite3
+import hashlib
+import argparse
+import logging
+from time import strftime
+
+
+logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+log = logging.getLogger(__name__)
+
+
+DEFAULT_CATALOG = os.path.join(os.path.expanduser('~'), 'NMSSMPheno_catalog.sqlite')
+
+CATALOG_ENV = 'NMSSMPHENO_CATALOG'
+
+# Columns, in order. path is the primary key.
+COLUMNS = [('path', 'TEXT PRIMARY KEY'),
+           ('directory', 'TEXT'),
+           ('generator', 'TEXT'),
+           ('channel', 'TEXT'),
+           ('mass', 'REAL'),
+           ('energy', 'INTEGER'),
+           ('seed', 'INTEGER'),
+           ('n_events', 'INTEGER'),
+           ('format', 'TEXT'),
+           ('size', 'INTEGER'),
+           ('checksum', 'TEXT'),
+           ('card_hash', 'TEXT'),
+           ('status', 'TEXT'),
+           ('created', 'TEXT'),
+           ('updated', 'TEXT')]
+COLUMN_NAMES = [c[0] for c in COLUMNS]
+
+INDICES = {'idx_sample': ['channel', 'energy', 'mass', 'format'],
+           'idx_directory': ['directory'],
+           'idx_status': ['status']}
+
+# Filenames as made by the submit scripts:
+# <channel>[_ma1_<mass>]_<energy>TeV_n<nevents>_seed<seed>.<format>[.gz]
+FILENAME_RE = re.compile(r'^(?P<channel>.+?)(_ma1_(?P<mass>[^_]+))?_(?P<energy>\d+)TeV'
+                         r'_n(?P<n_events>\d+)_seed(?P<seed>\d+)\.(?P<format>[^.]+)(\.gz)?$')
+
+# Generator, from the directory names made by generate_dir_soolin()
+GENERATOR_DIRS = ['Pythia8', 'MG5_aMC']
+
+CHECKSUM_CHUNK = 16 * 1024 * 1024
+
+
+def catalog(in_args=sys.argv[1:]):
+    """Main function"""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--catalog',
+                        help='Catalog file. Defaults to $%s, or %s' % (CATALOG_ENV, DEFAULT_CATALOG))
+    parser.add_argument("-v",
+                        help="Display debug messages.",
+                        action='store_true')
+    subparsers = parser.add_subparsers(dest='command')
+
+    query_parser = subparsers.add_parser('query', help='List files matching some criteria')
+    for col in ['generator', 'channel', 'format', 'status']:
+        query_parser.add_argument('--' + col)
+    query_parser.add_argument('--mass', type=float)
+    query_parser.add_argument('--energy', type=int)
+    query_parser.add_argument('--dir', help='Only files in this directory')
+    query_parser.add_argument('--long', action='store_true',
+                              help='Print all columns, not just the path')
+
+    scan_parser = subparsers.add_parser('scan', help='Add existing files in directories')
+    scan_parser.add_argument('dirs', nargs='+')
+    scan_parser.add_argument('--generator',
+                             help='Generator name, if it cannot be guessed from the path')
+    scan_parser.add_argument('--noChecksum', action='store_true',
+                             help="Don't calculate checksums (faster)")
+    args = parser.parse_args(args=in_args)
+
+    if args.v:
+        log.setLevel(logging.DEBUG)
+
+    cat = Catalog(args.catalog)
+    if args.command == 'query':
+        filters = {col: getattr(args, col) for col in ['generator', 'channel', 'format',
+                                                        'status', 'mass', 'energy']}
+        filters['directory'] = args.dir
+        for row in cat.query(**filters):
+            if args.long:
+                print ' '.join('%s=%s' % (col, row[col]) for col in COLUMN_NAMES)
+            else:
+                print row['path']
+    elif args.command == 'scan':
+        for directory in args.dirs:
+            n_files = scan_dir(cat, directory, args.generator, not args.noChecksum)
+            log.info('Added %d files from %s' % (n_files, directory))
+    cat.close()
+
+
+def get_catalog_path(filename=None):
+    """Get the catalog filename: filename if set, otherwise from the
+    environment variable, otherwise the default."""
+    return os.path.abspath(filename or os.environ.get(CATALOG_ENV) or DEFAULT_CATALOG)
+
+
+def parse_filename(filename):
+    """Get channel, mass, energy, number of events, seed, and format from
+    a filename. Returns a dict, empty if the filename is not recognised.
+
+    >>> parse_filename('ggh125_2a_4tau_ma1_8_13TeV_n1000_seed3.hepmc.gz')
+    {'channel': 'ggh125_2a_4tau', 'mass': 8.0, 'energy': 13, 'n_events': 1000,
+     'seed': 3, 'format': 'hepmc'}
+    """
+    match = FILENAME_RE.match(os.path.basename(filename))
+    if not match:
+        return {}
+    info = {'channel': match.group('channel'),
+            'energy': int(match.group('energy')),
+            'n_events': int(match.group('n_events')),
+            'seed': int(match.group('seed')),
+            'format': match.group('format')}
+    if match.group('mass'):
+        info['mass'] = float(match.group('mass'))
+    return info
+
+
+def guess_generator(path):
+    """Guess the generator from the directory structure, None if unknown"""
+    parts = os.path.abspath(path).split(os.sep)
+    if 'delphes' in parts:
+        return 'Delphes'
+    for generator in GENERATOR_DIRS:
+        if generator in parts:
+            return generator
+    return None
+
+
+def file_checksum(filename):
+    """Adler-32 checksum of a file, read in chunks. Cheap enough to run on
+    every output file, and the same as used by hadoop & grid tools."""
+    value = 1
+    with open(filename, 'rb') as f:
+        while True:
+            block = f.read(CHECKSUM_CHUNK)
+            if not block:
+                break
+            value = zlib.adler32(block, value)
+    return 'adler32:%08x' % (value & 0xffffffff)
+
+
+def card_hash(cards):
+    """SHA1 hash of the contents of card files (or directories of them)"""
+    sha = hashlib.sha1()
+    filenames = []
+    for card in cards:
+        if os.path.isdir(card):
+            for root, _, files in os.walk(card):
+                filenames.extend(os.path.join(root, f) for f in files)
+        else:
+            filenames.append(card)
+    for filename in sorted(filenames):
+        with open(filename, 'rb') as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+
+class Catalog(object):
+    """Interface to the SQLite catalog.
+
+    filename: str
+        Catalog file. See get_catalog_path() for the default.
+    timeout: float
+        Time in seconds to wait for other processes to release their lock
+        on the database, since many jobs may finish at the same time.
+    """
+
+    def __init__(self, filename=None, timeout=120.):
+        self.filename = get_catalog_path(filename)
+        directory = os.path.dirname(self.filename)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.conn = sqlite3.connect(self.filename, timeout=timeout)
+        self.conn.row_factory = sqlite3.Row
+        self.create_tables()
+
+    def create_tables(self):
+        """Make the table & indices if they don't exist"""
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS files (%s)' %
+                              ', '.join('%s %s' % col for col in COLUMNS))
+            for name, cols in INDICES.iteritems():
+                self.conn.execute('CREATE INDEX IF NOT EXISTS %s ON files (%s)' %
+                                  (name, ', '.join(cols)))
+
+    def register(self, path, **fields):
+        """Add a file to the catalog, or update the fields of an existing one.
+
+        Fields not given are guessed from the filename for new files
+        (see parse_filename()), and left unchanged for existing files.
+
+        path: str
+            Final location of the file.
+        fields: keyword args
+            Column values, see COLUMNS.
+        """
+        unknown = set(fields) - set(COLUMN_NAMES)
+        if unknown:
+            raise KeyError('Unknown catalog columns: %s' % ', '.join(sorted(unknown)))
+        path = os.path.abspath(path)
+        now = strftime('%Y-%m-%d %H:%M:%S')
+        new = parse_filename(path)
+        new.update({'directory': os.path.dirname(path),
+                    'generator': guess_generator(path),
+                    'status': 'pending',
+                    'created': now})
+        new.update(fields)
+        new['path'] = path
+        fields = dict(fields, updated=now)
+        with self.conn:
+            cols = sorted(new)
+            self.conn.execute('INSERT OR IGNORE INTO files (%s) VALUES (%s)' %
+                              (', '.join(cols), ', '.join('?' * len(cols))),
+                              [new[c] for c in cols])
+            cols = sorted(fields)
+            self.conn.execute('UPDATE files SET %s WHERE path = ?' %
+                              ', '.join('%s = ?' % c for c in cols),
+                              [fields[c] for c in cols] + [path])
+
+    def mark_done(self, path, local_file=None, checksum=True):
+        """Mark a registered file as done, with its size & checksum.
+
+        path: str
+            Final location of the file, as registered.
+        local_file: str
+            Local copy of the file to get the size & checksum from, if
+            the final location is not easily readable (e.g. on /hdfs).
+        checksum: bool
+            Calculate the checksum.
+
+        Returns False if the file was not registered.
+        """
+        path = os.path.abspath(path)
+        if not self.get(path):
+            return False
+        local_file = local_file or path
+        fields = {'status': 'done'}
+        if os.path.isfile(local_file):
+            fields['size'] = os.path.getsize(local_file)
+            if checksum:
+                fields['checksum'] = file_checksum(local_file)
+        self.register(path, **fields)
+        return True
+
+    def get(self, path):
+        """Get the row for a file, or None if not in the catalog"""
+        cur = self.conn.execute('SELECT * FROM files WHERE path = ?', (os.path.abspath(path),))
+        return cur.fetchone()
+
+    def query(self, **filters):
+        """Get rows matching all the filters, ordered by path.
+
+        filters: keyword args
+            Column = value. Values of None are ignored, and lists/tuples
+            match any of their values. directory is made absolute.
+
+        Returns a list of sqlite3.Row, which can be used like dicts.
+        """
+        clauses, values = [], []
+        for col, value in sorted(filters.iteritems()):
+            if value is None:
+                continue
+            if col not in COLUMN_NAMES:
+                raise KeyError('Unknown catalog column: %s' % col)
+            if col == 'directory':
+                value = os.path.abspath(value.rstrip('/'))
+            if isinstance(value, (list, tuple)):
+                clauses.append('%s IN (%s)' % (col, ', '.join('?' * len(value))))
+                values.extend(value)
+            else:
+                clauses.append('%s = ?' % col)
+                values.append(value)
+        sql = 'SELECT * FROM files'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        return self.conn.execute(sql + ' ORDER BY path', values).fetchall()
+
+    def paths(self, **filters):
+        """As query(), but only return the paths"""
+        return [str(row['path']) for row in self.query(**filters)]
+
+    def unfinished(self, directory, disk_paths):
+        """Find the files in a directory that the catalog does not have as done.
+
+        directory: str
+            Directory to check.
+        disk_paths: list[str]
+            Files that are in the directory on disk.
+
+        Returns the paths registered in the directory but not done (e.g. their
+        job is still running, or failed), and the paths in disk_paths that are
+        not in the catalog at all (e.g. made before it existed).
+        """
+        rows = self.query(directory=directory)
+        known = set(str(row['path']) for row in rows)
+        not_done = [str(row['path']) for row in rows if row['status'] != 'done']
+        missing = sorted(p for p in (os.path.abspath(p) for p in disk_paths) if p not in known)
+        return not_done, missing
+
+    def close(self):
+        self.conn.close()
+
+
+def scan_dir(cat, directory, generator=None, checksum=True):
+    """Add all recognised files in a directory to the catalog as done.
+    Returns the number of files added/updated."""
+    n_files = 0
+    for filename in sorted(os.listdir(directory)):
+        path = os.path.join(directory, filename)
+        if not os.path.isfile(path) or not parse_filename(filename):
+            continue
+        fields = {'status': 'done', 'size': os.path.getsize(path)}
+        if generator:
+            fields['generator'] = generator
+        if checksum:
+            fields['checksum'] = file_checksum(path)
+        log.debug('Adding %s' % path)
+        cat.register(path, **fields)
+        n_files += 1
+    return n_files
+
+
+def mark_outputs_done(catalog_filename, outputs):
+    """Mark the outputs of a job as done. For use in the worker scripts.
+
+    Any problem with the catalog is printed, but doesn't stop the job,
+    since the outputs themselves are safely copied.
+
+    catalog_filename: str
+        Catalog file.
+    outputs: list[(str, str)]
+        (final location, local copy) for each output.
+    """
+    try:
+        cat = Catalog(catalog_filename)
+        for path, local_file in outputs:
+            if cat.mark_done(path, local_file):
+                print 'Catalog: marked', path, 'as done'
+        cat.close()
+    except sqlite3.Error as err:
+        print 'WARNING: could not update catalog %s: %s' % (catalog_filename, err)
+
+
+if __name__ == "__main__":
+    catalog()
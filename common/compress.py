@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+"""
+Compress generator outputs (HepMC, LHE) using several threads.
+
+The file is split into blocks, and a pool of threads compresses each block
+into its own gzip member (zlib releases the GIL, so the threads really do run
+in parallel). The members are written out in order, one after the other.
+The result is a normal multi-member gzip file, as made by cat-ing gzip files
+together, so it can be read by gunzip, zcat, and Python's gzip module. DelphesHepMC reads it via gunzip, as for any other
+.gz file (see Delphes/HTCondor/runDelphes.py).
+
+bz2 (also compressed in parallel, one stream per block) and xz (using
+`xz -T <threads>`) are also available, for archival copies where size
+matters more than speed. Multi-stream bz2 files can be read by bunzip2,
+but Python 2's bz2 module only reads the first stream.
+
+The number of threads defaults to $OMP_NUM_THREADS, which HTCondor sets to
+request_cpus, otherwise to the number of cores.
+
+It can be used from the command line, e.g.:
+
+./compress.py events.hepmc events.lhe --threads 4
+
+./compress.py events.hepmc --method xz --keep
+
+or from the worker scripts:
+
+import compress
+compress.compress_file('events.hepmc')  # makes events.hepmc.gz
+"""
+
+
+import os
+import bz2
+import sys
+import zlib
+import shutil
+import argparse
+import logging
+from subprocess import check_call
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+
+logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+log = logging.getLogger(__name__)
+
+
+# Uncompressed size of each block/member. Each block costs a few bytes of
+# header, and a little compression as the history is reset, so don't make
+# them too small.
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+
+DEFAULT_LEVEL = 6
+
+EXTENSIONS = {'gzip': '.gz', 'bz2': '.bz2', 'xz': '.xz'}
+
+# zlib wbits value to make a gzip header & trailer
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def compress(in_args=sys.argv[1:]):
+    """Main function"""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input',
+                        nargs='+',
+                        help='File(s) to compress')
+    parser.add_argument('--method',
+                        choices=sorted(EXTENSIONS.keys()),
+                        default='gzip',
+                        help='Compression method')
+    parser.add_argument('--threads',
+                        type=int,
+                        help='Number of threads. Defaults to $OMP_NUM_THREADS, '
+                        'or the number of cores.')
+    parser.add_argument('--level',
+                        type=int,
+                        default=DEFAULT_LEVEL,
+                        help='Compression level, 1 (fastest) to 9 (smallest)')
+    parser.add_argument('--blockSize',
+                        type=int,
+                        default=DEFAULT_BLOCK_SIZE,
+                        help='Size of blocks compressed by each thread, in bytes')
+    parser.add_argument('--keep',
+                        action='store_true',
+                        help='Keep the input file(s)')
+    parser.add_argument("-v",
+                        help="Display debug messages.",
+                        action='store_true')
+    args = parser.parse_args(args=in_args)
+
+    if args.v:
+        log.setLevel(logging.DEBUG)
+
+    if not 1 <= args.level <= 9:
+        raise RuntimeError('--level must be between 1 and 9')
+
+    for filename in args.input:
+        if not os.path.isfile(filename):
+            raise RuntimeError('%s does not exist' % filename)
+
+    return [compress_file(filename, method=args.method, threads=args.threads,
+                          level=args.level, block_size=args.blockSize, keep=args.keep)
+            for filename in args.input]
+
+
+def get_default_threads():
+    """Number of threads to use: $OMP_NUM_THREADS if set, otherwise the number of cores"""
+    try:
+        return max(1, int(os.environ['OMP_NUM_THREADS']))
+    except (KeyError, ValueError):
+        return cpu_count()
+
+
+def gzip_block(args):
+    """Compress a block of data into a complete gzip member.
+
+    args: tuple(str, int)
+        Data & compression level. A tuple so it can be used with Pool.map().
+    """
+    data, level = args
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def bz2_block(args):
+    """Compress a block of data into a complete bz2 stream.
+
+    args: tuple(str, int)
+        Data & compression level. A tuple so it can be used with Pool.map().
+    """
+    data, level = args
+    return bz2.compress(data, level)
+
+
+BLOCK_COMPRESSORS = {'gzip': gzip_block, 'bz2': bz2_block}
+
+
+class ParallelWriter(object):
+    """File-like object that compresses what is written to it in parallel,
+    one block per thread, and writes the compressed blocks in order.
+
+    filename: str
+        Output filename.
+    method: str
+        'gzip' or 'bz2'
+    threads: int
+        Number of threads. Defaults to get_default_threads().
+    level: int
+        Compression level.
+    block_size: int
+        Uncompressed size of each block.
+
+    At most 2 blocks per thread are held in memory at once.
+    """
+
+    def __init__(self, filename, method='gzip', threads=None, level=DEFAULT_LEVEL,
+                 block_size=DEFAULT_BLOCK_SIZE):
+        if method not in BLOCK_COMPRESSORS:
+            raise RuntimeError('Cannot compress with %s in parallel, '
+                               'must be one of %s' % (method, BLOCK_COMPRESSORS.keys()))
+        self.filename = filename
+        self.level = level
+        self.block_size = block_size
+        self.threads = threads or get_default_threads()
+        self.compressor = BLOCK_COMPRESSORS[method]
+        self.pool = ThreadPool(self.threads) if self.threads > 1 else None
+        self.out_file = open(filename, 'wb')
+        self.buffer = []
+        self.buffer_size = 0
+        self.blocks = []
+        self.n_written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, data):
+        """Add data to the output"""
+        self.buffer.append(data)
+        self.buffer_size += len(data)
+        if self.buffer_size >= self.block_size:
+            data = ''.join(self.buffer)
+            n_blocks = len(data) // self.block_size
+            for ind in xrange(n_blocks):
+                self.blocks.append(data[ind * self.block_size:(ind + 1) * self.block_size])
+            leftover = data[n_blocks * self.block_size:]
+            self.buffer = [leftover] if leftover else []
+            self.buffer_size = len(leftover)
+            if len(self.blocks) >= 2 * self.threads:
+                self._flush_blocks()
+
+    def _flush_blocks(self):
+        """Compress the waiting blocks, and write them out"""
+        tasks = [(block, self.level) for block in self.blocks if block]
+        if self.pool:
+            results = self.pool.map(self.compressor, tasks, chunksize=1)
+        else:
+            results = [self.compressor(task) for task in tasks]
+        for result in results:
+            self.out_file.write(result)
+        self.n_written += len(results)
+        self.blocks = []
+
+    def close(self):
+        """Compress anything left, and close the output file"""
+        if self.out_file.closed:
+            return
+        if self.buffer:
+            self.blocks.append(''.join(self.buffer))
+            self.buffer = []
+            self.buffer_size = 0
+        self._flush_blocks()
+        if not self.n_written:
+            # An empty file isn't valid gzip/bz2, so write one empty member
+            self.out_file.write(self.compressor(('', self.level)))
+        self.out_file.close()
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+
+
+def compress_file(filename, method='gzip', threads=None, level=DEFAULT_LEVEL,
+                  block_size=DEFAULT_BLOCK_SIZE, keep=False):
+    """Compress a file, as gzip or bzip2 would, but using several threads.
+
+    filename: str
+        File to compress. The output is filename + .gz/.bz2/.xz
+    method: str
+        'gzip', 'bz2' or 'xz'
+    threads: int
+        Number of threads. Defaults to get_default_threads().
+    level: int
+        Compression level, 1 - 9.
+    block_size: int
+        Uncompressed size of each block (gzip & bz2 only).
+    keep: bool
+        If False, the input file is removed afterwards, as gzip does.
+
+    Returns the output filename.
+    """
+    if method not in EXTENSIONS:
+        raise RuntimeError('Unknown compression method %s, '
+                           'must be one of %s' % (method, EXTENSIONS.keys()))
+    threads = threads or get_default_threads()
+    out_name = filename + EXTENSIONS[method]
+    log.info('Compressing %s to %s with %d threads' % (filename, out_name, threads))
+
+    if method == 'xz':
+        # No lzma module in Python 2, but xz can use several threads itself
+        with open(out_name, 'wb') as out_file:
+            check_call(['xz', '-%d' % level, '-T', str(threads), '-c', filename],
+                       stdout=out_file)
+    else:
+        writer = ParallelWriter(out_name, method=method, threads=threads,
+                                level=level, block_size=block_size)
+        with open(filename, 'rb') as in_file, writer:
+            shutil.copyfileobj(in_file, writer, block_size)
+
+    shutil.copystat(filename, out_name)
+    if not keep:
+        os.remove(filename)
+    return out_name
+
+
+if __name__ == "__main__":
+    compress()
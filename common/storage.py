@@ -0,0 +1,615 @@
+#!/usr/bin/env python
+"""
+Copy files to & from /hdfs (and make & list directories there) through one
+interface, whatever the way of talking to HDFS:
+
+- local: /hdfs is a normal (e.g. FUSE mounted) directory, use shutil & os.
+  Set $NMSSMPHENO_HDFS_ROOT to use another directory in place of /hdfs,
+  e.g. for testing.
+- hadoop: the `hadoop fs` command (the default, as on the worker nodes).
+- webhdfs: the WebHDFS REST API, at the URL in $NMSSMPHENO_WEBHDFS,
+  e.g. http://<namenode>:50070. No JVM or process is needed.
+  benchmarks/shims/webhdfs_server.py is a stand-in server for testing.
+
+The backend is chosen with $NMSSMPHENO_STORAGE (local, hadoop or webhdfs).
+The worker scripts get the same backend, as the jobs use getenv = true.
+
+put(), get(), mkdir() and ls() take lists of paths, and each is issued as a
+single operation, e.g. one `hadoop fs -put` for all the files, rather than
+paying for a new process (& JVM) per file. WebHDFS has no multi-path requests,
+so the requests in a batch are made in parallel instead.
+upload() and download() copy lists of (source, destination) pairs, renaming
+as needed, with as few put() & get() calls as possible.
+Scripts can also queue up directories to make & files to copy as they go,
+with queue_mkdir() & queue_upload(), and do them all at once with flush().
+summary() says how many operations (e.g. JVM launches) batching has saved.
+
+Paths on HDFS are always given as they appear on the mount, i.e. /hdfs/user/...
+
+e.g.:
+
+import storage
+store = storage.get_storage()
+store.mkdir(['/hdfs/user/<username>/NMSSMPheno/zips'])
+store.put(['input_cards', 'generateMC.exe'], '/hdfs/user/<username>/NMSSMPheno/Pythia8/13TeV/xyz')
+store.download([('/hdfs/user/<username>/NMSSMPheno/zips/delphes.tgz', 'delphes.tgz')])
+store.queue_mkdir(['/hdfs/user/<username>/NMSSMPheno/Pythia8/13TeV/xyz/hepmc'])
+store.queue_upload([('out.hepmc', '/hdfs/user/<username>/NMSSMPheno/Pythia8/13TeV/xyz/hepmc/out.hepmc')])
+store.flush()
+print store.summary()
+
+or from the command line:
+
+./storage.py ls /hdfs/user/<username>/NMSSMPheno/zips
+"""
+
+
+import os
+import sys
+import json
+import shutil
+import urllib
+import httplib
+import getpass
+import logging
+import argparse
+import tempfile
+import urlparse
+from subprocess import call, check_output, CalledProcessError
+from multiprocessing.pool import ThreadPool
+
+
+logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+log = logging.getLogger(__name__)
+
+
+HDFS_MOUNT = '/hdfs'
+
+STORAGE_ENV = 'NMSSMPHENO_STORAGE'
+HDFS_ROOT_ENV = 'NMSSMPHENO_HDFS_ROOT'
+WEBHDFS_ENV = 'NMSSMPHENO_WEBHDFS'
+
+DEFAULT_BACKEND = 'hadoop'
+
+# Size of blocks when streaming files to & from WebHDFS
+CHUNK_SIZE = 1024 * 1024
+
+
+def storage(in_args=sys.argv[1:]):
+    """Main function"""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backend',
+                        choices=sorted(BACKENDS.keys()),
+                        help='Storage backend. Defaults to $%s, or %s' % (STORAGE_ENV, DEFAULT_BACKEND))
+    parser.add_argument("-v",
+                        help="Display debug messages.",
+                        action='store_true')
+    subparsers = parser.add_subparsers(dest='command')
+    put_parser = subparsers.add_parser('put', help='Copy local files to a directory on /hdfs')
+    put_parser.add_argument('paths', nargs='+', help='Local files, then the /hdfs directory')
+    get_parser = subparsers.add_parser('get', help='Copy files from /hdfs to a local directory')
+    get_parser.add_argument('paths', nargs='+', help='Files on /hdfs, then the local directory')
+    mkdir_parser = subparsers.add_parser('mkdir', help='Make directories on /hdfs')
+    mkdir_parser.add_argument('paths', nargs='+', help='Directories')
+    ls_parser = subparsers.add_parser('ls', help='List directories on /hdfs')
+    ls_parser.add_argument('paths', nargs='+', help='Directories')
+    args = parser.parse_args(args=in_args)
+
+    if args.v:
+        log.setLevel(logging.DEBUG)
+
+    store = get_storage(args.backend)
+    if args.command in ['put', 'get']:
+        if len(args.paths) < 2:
+            raise RuntimeError('Need at least one source and a destination')
+        getattr(store, args.command)(args.paths[:-1], args.paths[-1])
+    elif args.command == 'mkdir':
+        store.mkdir(args.paths)
+    elif args.command == 'ls':
+        for path in store.ls(args.paths):
+            print path
+
+
+def get_storage(backend=None):
+    """Make the storage backend to use.
+
+    backend: str
+        local, hadoop or webhdfs. Defaults to $NMSSMPHENO_STORAGE, or DEFAULT_BACKEND.
+    """
+    backend = backend or os.environ.get(STORAGE_ENV) or DEFAULT_BACKEND
+    if backend not in BACKENDS:
+        raise RuntimeError('Unknown storage backend %s, must be one of %s' %
+                           (backend, ', '.join(sorted(BACKENDS.keys()))))
+    log.debug('Using %s storage' % backend)
+    return BACKENDS[backend]()
+
+
+def is_hdfs(path):
+    """Check if a path is on /hdfs"""
+    return path == HDFS_MOUNT or path.startswith(HDFS_MOUNT + '/')
+
+
+def to_hdfs(path):
+    """Convert a path on the /hdfs mount to the path within HDFS.
+
+    >>> to_hdfs('/hdfs/user/rob/zips')
+    '/user/rob/zips'
+    """
+    if not is_hdfs(path):
+        raise RuntimeError('%s is not on %s' % (path, HDFS_MOUNT))
+    return path[len(HDFS_MOUNT):] or '/'
+
+
+def from_hdfs(path):
+    """Convert a path within HDFS to its path on the /hdfs mount"""
+    return HDFS_MOUNT + '/' + path.lstrip('/')
+
+
+def local_copy(source, dest):
+    """Copy a file or directory, replacing dest if it exists"""
+    if os.path.isdir(source):
+        if os.path.isdir(dest):
+            shutil.rmtree(dest)
+        shutil.copytree(source, dest)
+    else:
+        shutil.copy2(source, dest)
+
+
+class Storage(object):
+    """Base class for storage backends.
+
+    Subclasses implement _put(), _get(), _mkdir() and _ls() for paths on /hdfs,
+    each as a single operation, e.g. one hadoop command.
+
+    n_calls counts the operations made, e.g. the number of hadoop commands
+    (and so JVM launches) for HadoopStorage. n_paths counts the paths they
+    were for, i.e. the number of operations if each path had been done
+    separately.
+
+    Directories & uploads can also be queued with queue_mkdir() and
+    queue_upload(), to be done all together by flush().
+    """
+
+    name = None
+    call_name = 'operations'
+
+    def __init__(self):
+        self.n_calls = 0
+        self.n_paths = 0
+        self.pending_dirs = set()
+        self.pending_uploads = []
+        self.pending_removes = []
+
+    def _count(self, paths):
+        self.n_calls += 1
+        self.n_paths += len(paths)
+
+    def put(self, sources, dest_dir):
+        """Copy local files/directories into a directory on /hdfs,
+        keeping their names, and replacing any existing ones.
+
+        sources: list[str]
+            Local files/directories.
+        dest_dir: str
+            Directory on /hdfs. Must already exist.
+        """
+        sources = list(sources)
+        if sources:
+            self._count(sources)
+            self._put(sources, dest_dir)
+
+    def get(self, sources, dest_dir):
+        """Copy files/directories on /hdfs into a local directory, keeping their names.
+
+        sources: list[str]
+            Files/directories on /hdfs.
+        dest_dir: str
+            Local directory. Must already exist.
+        """
+        sources = list(sources)
+        if sources:
+            self._count(sources)
+            self._get(sources, dest_dir)
+
+    def mkdir(self, directories):
+        """Make directories on /hdfs, including any parent directories.
+
+        directories: list[str]
+            Directories on /hdfs.
+        """
+        directories = list(directories)
+        if directories:
+            self._count(directories)
+            self._mkdir(directories)
+
+    def ls(self, directories):
+        """List the contents of directories on /hdfs.
+
+        directories: list[str]
+            Directories on /hdfs.
+
+        Returns a sorted list of paths on /hdfs.
+        """
+        directories = list(directories)
+        if not directories:
+            return []
+        self._count(directories)
+        return self._ls(directories)
+
+    def make_dirs(self, directories):
+        """Make directories: those on /hdfs with one mkdir(), the others locally.
+
+        directories: list[str]
+            Directories, on /hdfs or not.
+        """
+        hdfs_dirs, local_dirs = set(), set()
+        for directory in directories:
+            (hdfs_dirs if is_hdfs(directory) else local_dirs).add(directory.rstrip('/') or '/')
+        for directory in sorted(local_dirs):
+            if not os.path.isdir(directory):
+                if os.path.isfile(directory):
+                    raise RuntimeError('%s already exists as a file' % directory)
+                os.makedirs(directory)
+        self.mkdir(sorted(hdfs_dirs))
+
+    def queue_mkdir(self, directories):
+        """Queue directories to be made by the next flush().
+
+        directories: list[str]
+            Directories, on /hdfs or not.
+        """
+        self.pending_dirs.update(directories)
+
+    def queue_upload(self, pairs, remove=False):
+        """Queue files to be copied by the next flush(), after the queued
+        directories have been made.
+
+        pairs: list[(str, str)]
+            (local source, full destination path) for each file.
+        remove: bool
+            Remove the sources after the flush, e.g. for temporary files.
+        """
+        self.pending_uploads.extend(pairs)
+        if remove:
+            self.pending_removes.extend(source for source, _ in pairs)
+
+    def flush(self):
+        """Make all the queued directories, then do all the queued uploads,
+        with as few operations as possible.
+
+        Returns the list of (source, destination) pairs that were copied.
+        """
+        directories, self.pending_dirs = self.pending_dirs, set()
+        pairs, self.pending_uploads = self.pending_uploads, []
+        removes, self.pending_removes = self.pending_removes, []
+        try:
+            self.make_dirs(directories)
+            return self.upload(pairs)
+        finally:
+            for source in removes:
+                if os.path.isdir(source):
+                    shutil.rmtree(source)
+                elif os.path.exists(source):
+                    os.remove(source)
+
+    def summary(self):
+        """Say how many operations were made, and how many batching saved"""
+        return '%s storage: %d %s for %d paths (%d saved by batching)' % (
+            self.name, self.n_calls, self.call_name, self.n_paths, self.n_paths - self.n_calls)
+
+    def upload(self, pairs):
+        """Copy local files to their destinations, renaming if needed.
+
+        Files going to the same directory on /hdfs are copied with one put().
+        Renamed files are hard-linked (or copied) to a temporary directory
+        under their new name first. Other destinations are copied locally.
+        Missing sources & failed copies are printed, but don't stop the others.
+
+        pairs: list[(str, str)]
+            (local source, full destination path) for each file.
+
+        Returns the list of pairs that were copied.
+        """
+        done = []
+        by_dir = {}
+        for source, dest in pairs:
+            if not os.path.exists(source):
+                print 'Not copying', source, 'as it does not exist'
+            elif is_hdfs(dest):
+                by_dir.setdefault(os.path.dirname(dest.rstrip('/')), []).append((source, dest))
+            else:
+                local_copy(source, dest)
+                done.append((source, dest))
+
+        for dest_dir, dir_pairs in sorted(by_dir.iteritems()):
+            stage_dir = None
+            sources = []
+            for source, dest in dir_pairs:
+                if os.path.basename(source.rstrip('/')) == os.path.basename(dest.rstrip('/')):
+                    sources.append(source)
+                    continue
+                if not stage_dir:
+                    stage_dir = tempfile.mkdtemp(prefix='.upload_', dir='.')
+                staged = os.path.join(stage_dir, os.path.basename(dest.rstrip('/')))
+                try:
+                    os.link(source, staged)
+                except OSError:
+                    local_copy(source, staged)
+                sources.append(staged)
+            try:
+                self.put(sources, dest_dir)
+                done.extend(dir_pairs)
+            except (RuntimeError, EnvironmentError) as err:
+                print 'Failed to copy to', dest_dir, ':', err
+            finally:
+                if stage_dir:
+                    shutil.rmtree(stage_dir)
+        return done
+
+    def download(self, pairs):
+        """Copy files to local destinations, renaming if needed.
+
+        All files on /hdfs are fetched with as few get() calls as possible,
+        into a temporary directory, then moved to their destinations.
+        Other sources are copied locally.
+
+        pairs: list[(str, str)]
+            (source, local destination path) for each file.
+        """
+        # Each get() can only take files with different names
+        batches = []
+        for source, dest in pairs:
+            if not is_hdfs(source):
+                local_copy(source, dest)
+                continue
+            name = os.path.basename(source.rstrip('/'))
+            for batch in batches:
+                if name not in batch:
+                    batch[name] = (source, dest)
+                    break
+            else:
+                batches.append({name: (source, dest)})
+
+        for batch in batches:
+            stage_dir = tempfile.mkdtemp(prefix='.download_', dir='.')
+            try:
+                self.get([source for source, _ in batch.itervalues()], stage_dir)
+                for name, (source, dest) in batch.iteritems():
+                    if os.path.isdir(dest):
+                        shutil.rmtree(dest)
+                    shutil.move(os.path.join(stage_dir, name), dest)
+            finally:
+                shutil.rmtree(stage_dir)
+
+
+class LocalStorage(Storage):
+    """Storage where /hdfs can be used as a normal directory.
+
+    root: str
+        Directory to use in place of /hdfs. Defaults to $NMSSMPHENO_HDFS_ROOT,
+        or /hdfs itself.
+    """
+
+    name = 'local'
+
+    def __init__(self, root=None):
+        super(LocalStorage, self).__init__()
+        self.root = root or os.environ.get(HDFS_ROOT_ENV)
+
+    def local_path(self, path):
+        """Get where a path on /hdfs actually is"""
+        if self.root and is_hdfs(path):
+            return os.path.join(self.root, to_hdfs(path).lstrip('/'))
+        return path
+
+    def _put(self, sources, dest_dir):
+        for source in sources:
+            local_copy(source, os.path.join(self.local_path(dest_dir),
+                                            os.path.basename(source.rstrip('/'))))
+
+    def _get(self, sources, dest_dir):
+        for source in sources:
+            if not os.path.exists(self.local_path(source)):
+                raise RuntimeError('%s does not exist' % source)
+            local_copy(self.local_path(source),
+                       os.path.join(dest_dir, os.path.basename(source.rstrip('/'))))
+
+    def _mkdir(self, directories):
+        for directory in directories:
+            if not os.path.isdir(self.local_path(directory)):
+                os.makedirs(self.local_path(directory))
+
+    def _ls(self, directories):
+        return sorted(os.path.join(directory, name) for directory in directories
+                      for name in os.listdir(self.local_path(directory)))
+
+
+class HadoopStorage(Storage):
+    """Storage using the `hadoop fs` command.
+
+    exe: str
+        hadoop command.
+    """
+
+    name = 'hadoop'
+    call_name = 'hadoop commands (JVM launches)'
+
+    def __init__(self, exe='hadoop'):
+        super(HadoopStorage, self).__init__()
+        self.exe = exe
+
+    def run(self, fs_args):
+        """Run hadoop fs with some args, raise a RuntimeError if it fails"""
+        cmds = [self.exe, 'fs'] + fs_args
+        log.debug(' '.join(cmds))
+        if call(cmds) != 0:
+            raise RuntimeError('%s failed' % ' '.join(cmds))
+
+    def _put(self, sources, dest_dir):
+        self.run(['-put', '-f'] + list(sources) + [to_hdfs(dest_dir)])
+
+    def _get(self, sources, dest_dir):
+        self.run(['-get'] + [to_hdfs(s) for s in sources] + [dest_dir])
+
+    def _mkdir(self, directories):
+        self.run(['-mkdir', '-p'] + [to_hdfs(d) for d in directories])
+
+    def _ls(self, directories):
+        cmds = [self.exe, 'fs', '-ls'] + [to_hdfs(d) for d in directories]
+        log.debug(' '.join(cmds))
+        try:
+            output = check_output(cmds)
+        except CalledProcessError:
+            raise RuntimeError('%s failed' % ' '.join(cmds))
+        # Lines are like `ls -l`, with the path last, plus "Found N items"
+        return sorted(from_hdfs(line.split()[-1]) for line in output.splitlines()
+                      if line.strip() and not line.startswith('Found '))
+
+
+class WebHDFSStorage(Storage):
+    """Storage using the WebHDFS REST API.
+
+    url: str
+        Namenode URL, e.g. http://<namenode>:50070. Defaults to $NMSSMPHENO_WEBHDFS.
+    user: str
+        User to act as. Defaults to $LOGNAME.
+    threads: int
+        Number of requests to make at once.
+    timeout: float
+        Timeout for each request, in seconds.
+    """
+
+    name = 'webhdfs'
+    call_name = 'batches of requests'
+
+    def __init__(self, url=None, user=None, threads=4, timeout=600.):
+        super(WebHDFSStorage, self).__init__()
+        self.url = url or os.environ.get(WEBHDFS_ENV)
+        if not self.url:
+            raise RuntimeError('No WebHDFS URL given, set $%s' % WEBHDFS_ENV)
+        self.url = self.url.rstrip('/')
+        self.user = user or os.environ.get('LOGNAME') or getpass.getuser()
+        self.threads = threads
+        self.timeout = timeout
+
+    def request(self, method, path, op, data=None, out_file=None, **params):
+        """Make a WebHDFS request for a path on /hdfs.
+
+        CREATE & OPEN are redirected to a datanode, which data (a file object)
+        is sent to, or the file is read from into out_file.
+
+        Returns the decoded JSON response, if any.
+        """
+        params.update({'op': op, 'user.name': self.user})
+        url = '%s/webhdfs/v1%s?%s' % (self.url, urllib.quote(to_hdfs(path)),
+                                      urllib.urlencode(sorted(params.items())))
+        conn, resp = self.open(method, url)
+        try:
+            if resp.status in [301, 302, 303, 307]:
+                location = resp.getheader('location')
+                resp.read()
+                conn.close()
+                conn, resp = self.open(method, location, data)
+            if resp.status >= 400:
+                raise RuntimeError('WebHDFS %s %s failed: %d %s' % (op, path, resp.status,
+                                                                    resp.read().strip()))
+            if out_file:
+                shutil.copyfileobj(resp, out_file, CHUNK_SIZE)
+                return None
+            body = resp.read()
+            return json.loads(body) if body.strip() else None
+        finally:
+            conn.close()
+
+    def open(self, method, url, data=None):
+        """Send a request, return the connection & response"""
+        parts = urlparse.urlsplit(url)
+        conn = httplib.HTTPConnection(parts.netloc, timeout=self.timeout)
+        target = parts.path + ('?' + parts.query if parts.query else '')
+        headers = {'Content-Type': 'application/octet-stream'} if data is not None else {}
+        conn.request(method, target, data, headers)
+        return conn, conn.getresponse()
+
+    def status(self, path):
+        """FileStatus of a path, as a dict"""
+        return self.request('GET', path, 'GETFILESTATUS')['FileStatus']
+
+    def list_status(self, path):
+        """FileStatus of everything in a directory, as a list of dicts"""
+        return self.request('GET', path, 'LISTSTATUS')['FileStatuses']['FileStatus']
+
+    def map(self, func, items):
+        """Apply func to items, several at once"""
+        if len(items) <= 1 or self.threads <= 1:
+            return [func(item) for item in items]
+        pool = ThreadPool(min(self.threads, len(items)))
+        try:
+            return pool.map(func, items, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _put(self, sources, dest_dir):
+        directories, files = [], []
+        for source in sources:
+            dest = dest_dir.rstrip('/') + '/' + os.path.basename(source.rstrip('/'))
+            if not os.path.isdir(source):
+                files.append((source, dest))
+                continue
+            directories.append(dest)
+            for dirpath, dirnames, filenames in os.walk(source):
+                rel = os.path.relpath(dirpath, source)
+                remote = dest if rel == '.' else dest + '/' + rel
+                directories.extend(remote + '/' + d for d in dirnames)
+                files.extend((os.path.join(dirpath, f), remote + '/' + f) for f in filenames)
+        # parents before children
+        for directory in sorted(directories):
+            self.request('PUT', directory, 'MKDIRS')
+        self.map(self._create, files)
+
+    def _create(self, pair):
+        source, dest = pair
+        with open(source, 'rb') as data:
+            self.request('PUT', dest, 'CREATE', data=data, overwrite='true')
+
+    def _get(self, sources, dest_dir):
+        files = []
+        for source in sources:
+            dest = os.path.join(dest_dir, os.path.basename(source.rstrip('/')))
+            files.extend(self._walk(source.rstrip('/'), dest))
+        self.map(self._open_file, files)
+
+    def _walk(self, source, dest):
+        """List (source, dest) for all the files in source, making local
+        directories as needed."""
+        if self.status(source)['type'] != 'DIRECTORY':
+            return [(source, dest)]
+        if not os.path.isdir(dest):
+            os.makedirs(dest)
+        files = []
+        for entry in self.list_status(source):
+            name = entry['pathSuffix'].encode('utf-8')
+            files.extend(self._walk(source + '/' + name, os.path.join(dest, name)))
+        return files
+
+    def _open_file(self, pair):
+        source, dest = pair
+        with open(dest, 'wb') as out_file:
+            self.request('GET', source, 'OPEN', out_file=out_file)
+
+    def _mkdir(self, directories):
+        self.map(lambda d: self.request('PUT', d, 'MKDIRS'), list(directories))
+
+    def _ls(self, directories):
+        listings = self.map(self.list_status, list(directories))
+        return sorted(directory.rstrip('/') + '/' + entry['pathSuffix'].encode('utf-8')
+                      for directory, entries in zip(directories, listings)
+                      for entry in entries)
+
+
+BACKENDS = {'local': LocalStorage, 'hadoop': HadoopStorage, 'webhdfs': WebHDFSStorage}
+
+
+if __name__ == "__main__":
+    storage()